@@ -1,5 +1,6 @@
 import logging
 import os
+import atexit
 from threading import Lock
 from flask import Flask, send_from_directory
 from flask_socketio import SocketIO
@@ -12,7 +13,7 @@ from config import state # Import shared state dictionary
 
 # --- Utility/Service Imports ---
 # Import necessary initialization functions or modules
-from services import tts_service, stt_service, history_manager
+from services import tts_service, stt_service, history_manager, ollama_residency, http_pool
 from sockets import init_sockets
 
 # --- Route Imports ---
@@ -21,6 +22,8 @@ from routes.comfyui import comfyui_bp
 from routes.models import models_bp
 from routes.settings import settings_bp
 from routes.tts import tts_bp
+from routes.stats import stats_bp
+from routes.blobs import blobs_bp
 
 # --- Configure Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -42,6 +45,8 @@ app.register_blueprint(comfyui_bp)
 app.register_blueprint(models_bp)
 app.register_blueprint(settings_bp)
 app.register_blueprint(tts_bp)
+app.register_blueprint(stats_bp)
+app.register_blueprint(blobs_bp)
 
 # --- Initialize SocketIO Handlers ---
 init_sockets(socketio)
@@ -50,6 +55,7 @@ init_sockets(socketio)
 stt_service.load_whisper_model()
 config.state["available_tts_models"] = tts_service.get_available_tts_models() # Fetch list initially
 tts_service.load_tts_model(config.state["current_tts_model_name"]) # Load initial model
+ollama_residency.start() # Warms OLLAMA_WARM_MODELS in the background, then keeps hot models loaded
 
 # --- Root Route for Frontend ---
 @app.route('/')
@@ -60,13 +66,17 @@ def serve_index():
 # --- Run the Application ---
 if __name__ == '__main__':
     os.makedirs(config.HISTORY_DIR, exist_ok=True)
+    history_manager.init_store() # First SQLite start imports existing JSON chats
+    atexit.register(http_pool.close_all_sessions)
 
     # Print final configuration summary
     print("----------------------------------------------------")
     print("Cosmo AI Server Configuration (Refactored):")
     print(f"  Default Device: {config.DEFAULT_DEVICE}")
     print(f"  History Directory: {config.HISTORY_DIR}")
+    print(f"  History Store: {config.HISTORY_BACKEND}{' (' + config.HISTORY_DB_PATH + ')' if config.HISTORY_BACKEND == 'sqlite' else ''}")
     print(f"  Ollama API: {config.OLLAMA_API}")
+    print(f"  Ollama Warm Models: {', '.join(config.OLLAMA_WARM_MODELS) if config.OLLAMA_RESIDENCY_ENABLED else 'Disabled'}")
     print(f"  Kobold API: {config.KOBOLD_API}")
     print(f"  ComfyUI API: {config.COMFYUI_API_BASE}")
     print(f"  Groq Key Set: {'Yes' if config.GROQ_API_KEY else 'No (Using Default)'}")
@@ -0,0 +1,125 @@
+"""Benchmarks the thread-per-request LLM client against the asyncio engine.
+
+Starts a local OpenAI-style SSE mock upstream, then opens N concurrent
+streams (default 50/200/500) with each engine and reports wall time,
+time-to-first-token percentiles, throughput, CPU time and peak thread count.
+
+Usage: python benchmarks/bench_llm_engines.py [--streams 50 200 500] [--tokens 50] [--token-delay 0.02]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+import config
+from services import async_llm
+from services.llm_backends import stream_llm_backend
+
+def start_mock_upstream(port, tokens, token_delay):
+    """Serves /v1/chat/completions as an OpenAI-style SSE stream on a background loop."""
+    async def chat_completions(request):
+        await request.json()
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for i in range(tokens):
+            await asyncio.sleep(token_delay)
+            chunk = {'choices': [{'delta': {'content': f"tok{i} "}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', chat_completions)
+        runner = web.AppRunner(app, access_log=None)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port, backlog=2048).start())
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+
+def summarize(name, streams, wall, ttfts, token_count, cpu, peak_threads):
+    ttfts = sorted(ttfts)
+    p50 = statistics.median(ttfts) if ttfts else float('nan')
+    p99 = ttfts[min(len(ttfts) - 1, int(len(ttfts) * 0.99))] if ttfts else float('nan')
+    print(f"{name:<8} streams={streams:<4} wall={wall:6.2f}s ttft_p50={p50*1000:7.1f}ms ttft_p99={p99*1000:7.1f}ms "
+          f"tokens/s={token_count / wall:9.1f} cpu={cpu:6.2f}s peak_threads={peak_threads}")
+
+def bench_threads(streams):
+    """One OS thread per stream, each blocking on the requests-based engine."""
+    config.LLM_ENGINE = 'threads'
+    ttfts, counts, lock = [], [], threading.Lock()
+    peak_threads = threading.active_count()
+
+    def worker():
+        start = time.perf_counter()
+        first, n = None, 0
+        for _ in stream_llm_backend("bench", [], 'custom_external', None):
+            if first is None:
+                first = time.perf_counter() - start
+            n += 1
+        with lock:
+            ttfts.append(first or 0.0)
+            counts.append(n)
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(streams)]
+    for t in threads:
+        t.start()
+    peak_threads = max(peak_threads, threading.active_count())
+    for t in threads:
+        t.join()
+    summarize('threads', streams, time.perf_counter() - wall_start, ttfts, sum(counts), time.process_time() - cpu_start, peak_threads)
+
+def bench_asyncio(streams):
+    """All streams multiplexed on the engine's single event loop."""
+    async def one():
+        start = time.perf_counter()
+        first, n = None, 0
+        async for _ in async_llm.astream_llm_backend("bench", [], 'custom_external', None):
+            if first is None:
+                first = time.perf_counter() - start
+            n += 1
+        return first or 0.0, n
+
+    async def run_all():
+        return await asyncio.gather(*(one() for _ in range(streams)))
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    results = asyncio.run_coroutine_threadsafe(run_all(), async_llm.get_event_loop()).result()
+    summarize('asyncio', streams, time.perf_counter() - wall_start, [r[0] for r in results], sum(r[1] for r in results),
+              time.process_time() - cpu_start, threading.active_count())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--streams', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--token-delay', type=float, default=0.02)
+    parser.add_argument('--port', type=int, default=18731)
+    args = parser.parse_args()
+
+    start_mock_upstream(args.port, args.tokens, args.token_delay)
+    config.CUSTOM_API_ENDPOINT = f"http://127.0.0.1:{args.port}/v1/chat/completions"
+    config.CUSTOM_API_MODEL_NAME = "bench-model"
+    config.HTTP_POOL_SIZES['custom_external'] = max(args.streams)
+
+    for streams in args.streams:
+        bench_threads(streams)
+        bench_asyncio(streams)
+    async_llm.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Benchmarks stream parsing and cancellation checks on the threads engine.
+
+Compares the previous consumer path (requests iter_lines + per-token task_lock
+lookup in active_tasks) with the byte-chunk StreamDecoder + cancel Event used
+by stream_llm_backend now. N concurrent OpenAI-style SSE streams are read from
+a local mock upstream, both chunked and close-delimited (no Transfer-Encoding,
+as some local servers send), with several tokens per socket write. Reports
+tokens/s and client CPU per stream (thread CPU time of the consumer threads,
+so the in-process mock server is excluded).
+
+Usage: python benchmarks/bench_stream_parsing.py [--streams 50 200] [--tokens 500] [--tokens-per-write 8]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from utils import make_request_with_retry
+from services.llm_backends import build_backend_request, parse_stream_line, stream_llm_backend
+
+def start_mock_upstream(port, tokens, tokens_per_write, chunked):
+    """Raw asyncio HTTP server streaming OpenAI-style SSE, tokens_per_write events per socket write."""
+    async def handle(reader, writer):
+        headers = await reader.readuntil(b"\r\n\r\n")
+        length = next((int(line.split(b":", 1)[1]) for line in headers.split(b"\r\n") if line.lower().startswith(b"content-length:")), 0)
+        await reader.readexactly(length)
+        framing = b"Transfer-Encoding: chunked\r\n" if chunked else b"Connection: close\r\n"
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n" + framing + b"\r\n")
+        events = [f"data: {json.dumps({'choices': [{'delta': {'content': f'tok{i} '}}]})}\n\n".encode() for i in range(tokens)]
+        events.append(b"data: [DONE]\n\n")
+        for start in range(0, len(events), tokens_per_write):
+            data = b"".join(events[start:start + tokens_per_write])
+            writer.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+            await writer.drain()
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', port, backlog=2048))
+        started.set()
+        loop.run_forever()
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+
+def legacy_stream(prompt, backend):
+    """The pre-StreamDecoder read loop: iter_lines and one parse per decoded line."""
+    api_endpoint, headers, payload = build_backend_request(prompt, [], backend, None, stream=True)
+    response = make_request_with_retry(api_endpoint, "POST", json_data=payload, headers=headers, stream=True, timeout=300, retries=1)
+    try:
+        for raw_line in response.iter_lines():
+            if not raw_line:
+                continue
+            line = raw_line.decode('utf-8') if isinstance(raw_line, bytes) else raw_line
+            try:
+                token, done = parse_stream_line(backend, line)
+            except json.JSONDecodeError:
+                continue
+            if token:
+                yield token
+            if done:
+                break
+    finally:
+        response.close()
+
+def run(name, streams, label):
+    task_lock = threading.Lock()
+    active_tasks = {}
+    results, results_lock = [], threading.Lock()
+
+    def worker(index):
+        cpu_start = time.thread_time()
+        tokens = 0
+        if name == 'legacy':
+            client_id = f"bench-{index}"
+            with task_lock:
+                active_tasks[client_id] = {}
+            for _ in legacy_stream("bench", 'custom_external'):
+                with task_lock: # Previous route: lock + registry lookup per token
+                    if client_id not in active_tasks:
+                        break
+                tokens += 1
+        else:
+            cancel_event = threading.Event()
+            for _ in stream_llm_backend("bench", [], 'custom_external', None, cancel_event=cancel_event):
+                if cancel_event.is_set():
+                    break
+                tokens += 1
+        with results_lock:
+            results.append((tokens, time.thread_time() - cpu_start))
+
+    wall_start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(streams)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - wall_start
+    total_tokens = sum(r[0] for r in results)
+    cpu_per_stream = sum(r[1] for r in results) / streams
+    print(f"{label:<8} {name:<8} streams={streams:<4} wall={wall:6.2f}s tokens/s={total_tokens / wall:10.1f} "
+          f"cpu/stream={cpu_per_stream * 1000:7.1f}ms cpu/token={cpu_per_stream / max(1, total_tokens / streams) * 1e6:6.1f}us")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--streams', type=int, nargs='+', default=[50, 200])
+    parser.add_argument('--tokens', type=int, default=500)
+    parser.add_argument('--tokens-per-write', type=int, default=8)
+    parser.add_argument('--port', type=int, default=18732)
+    args = parser.parse_args()
+
+    config.LLM_ENGINE = 'threads'
+    config.CUSTOM_API_MODEL_NAME = "bench-model"
+    config.HTTP_POOL_SIZES['custom_external'] = max(args.streams)
+    for offset, (label, chunked) in enumerate((('chunked', True), ('close', False))):
+        port = args.port + offset
+        start_mock_upstream(port, args.tokens, args.tokens_per_write, chunked)
+        config.CUSTOM_API_ENDPOINT = f"http://127.0.0.1:{port}/v1/chat/completions"
+        for streams in args.streams:
+            run('legacy', streams, label)
+            run('decoder', streams, label)
+
+if __name__ == '__main__':
+    main()
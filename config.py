@@ -4,11 +4,35 @@ import torch
 
 # --- Basic Server Config ---
 HISTORY_DIR = "chat_histories"
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "sqlite").lower() # "sqlite" (WAL database) or "file" (one JSON file per chat)
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", os.path.join(HISTORY_DIR, "history.db"))
+CHAT_LIST_MAX_LIMIT = int(os.getenv("CHAT_LIST_MAX_LIMIT", 500)) # Largest /api/chats page
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", 50)) # Messages per /api/chat/<id>?before= page when no limit is given
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_MAX_PAGE_SIZE", 1000))
+# Compression at rest: "auto" (zstd if the zstandard package is installed, else gzip), "zstd", "gzip" or "none"
+HISTORY_COMPRESSION = os.getenv("HISTORY_COMPRESSION", "auto").lower()
+HISTORY_COMPRESS_MIN_BYTES = int(os.getenv("HISTORY_COMPRESS_MIN_BYTES", 1024)) # SQLite store: smaller message/image rows stay plain JSON
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", 64 * 1024 * 1024)) # LRU cache of loaded chats (estimated size; 0 disables)
+# File store: appended turns are journaled, then folded into the chat file in the background
+HISTORY_COMPACT_INTERVAL = float(os.getenv("HISTORY_COMPACT_INTERVAL", 30)) # Seconds between compactor passes
+HISTORY_COMPACT_IDLE_SECONDS = float(os.getenv("HISTORY_COMPACT_IDLE_SECONDS", 120)) # Compact chats with no appends for this long
+HISTORY_COMPACT_MAX_JOURNAL_BYTES = int(os.getenv("HISTORY_COMPACT_MAX_JOURNAL_BYTES", 1024 * 1024)) # ...or whose journal grew this large
+# Full-text chat search (/api/chats/search): SQLite FTS5 index kept current on save, rebuilt from the store if deleted
+SEARCH_ENABLED = os.getenv("SEARCH_ENABLED", "true").lower() == "true"
+HISTORY_SEARCH_DB_PATH = os.getenv("HISTORY_SEARCH_DB_PATH", os.path.join(HISTORY_DIR, "search.db"))
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", 50)) # Largest search results page
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", 2000)) # Newest matching messages ranked per query
+# Content-addressed image blob store (/api/blobs/<sha256>), shared by all chats
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join(HISTORY_DIR, "blobs"))
+BLOB_MAX_BYTES = int(os.getenv("BLOB_MAX_BYTES", 20 * 1024 * 1024))
+BLOB_GC_INTERVAL = float(os.getenv("BLOB_GC_INTERVAL", 3600)) # Seconds between GC passes over unreferenced blobs
+BLOB_GC_GRACE_SECONDS = float(os.getenv("BLOB_GC_GRACE_SECONDS", 3600)) # Keep unreferenced blobs this long (e.g. generated, not yet saved)
 DEFAULT_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
 # --- API Endpoints ---
 OLLAMA_API = os.getenv("OLLAMA_API", "http://localhost:11435")
 KOBOLD_API = os.getenv("KOBOLD_API", "http://localhost:5001/api/v1/generate")
+KOBOLD_STREAM_API = os.getenv("KOBOLD_STREAM_API", "") # Derived from KOBOLD_API when empty
 # *** CORRECTED LINE: Added quotes around the default URL ***
 COMFYUI_API_BASE = os.getenv("COMFYUI_API", "http://127.0.0.1:8188")
 
@@ -25,8 +49,137 @@ CUSTOM_API_MODEL_NAME = os.getenv("CUSTOM_API_MODEL_NAME", "")
 CUSTOM_API_ENDPOINT = os.getenv("CUSTOM_API_ENDPOINT", "")
 CUSTOM_API_KEY = os.getenv("CUSTOM_API_KEY", "")
 
+# --- HTTP Connection Pool Config (keep-alive sessions per upstream host) ---
+HTTP_POOL_DEFAULT_SIZE = int(os.getenv("HTTP_POOL_DEFAULT_SIZE", 4))
+HTTP_POOL_SIZES = {
+    "ollama": int(os.getenv("OLLAMA_POOL_SIZE", 8)),
+    "kobold": int(os.getenv("KOBOLD_POOL_SIZE", 4)),
+    "comfyui": int(os.getenv("COMFYUI_POOL_SIZE", 4)),
+    "groq": int(os.getenv("GROQ_POOL_SIZE", 16)),
+    "openai": int(os.getenv("OPENAI_POOL_SIZE", 16)),
+    "anthropic": int(os.getenv("ANTHROPIC_POOL_SIZE", 16)),
+    "google": int(os.getenv("GOOGLE_POOL_SIZE", 16)),
+    "xai": int(os.getenv("XAI_POOL_SIZE", 16)),
+    "custom_external": int(os.getenv("CUSTOM_API_POOL_SIZE", 8)),
+}
+
+# --- LLM Client Engine ---
+# "threads": blocking requests per call (default); "asyncio": calls are multiplexed on one event loop (aiohttp)
+LLM_ENGINE = os.getenv("LLM_ENGINE", "threads").lower()
+ASYNC_LLM_MAX_CONNECTIONS = int(os.getenv("ASYNC_LLM_MAX_CONNECTIONS", 1000))
+ASYNC_LLM_MAX_CONNECTIONS_PER_HOST = int(os.getenv("ASYNC_LLM_MAX_CONNECTIONS_PER_HOST", 500))
+
+# --- LLM Response Cache (opt-in) ---
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 3600)) # Seconds; 0 disables expiry
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1000))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+LLM_CACHE_DISK_DIR = os.getenv("LLM_CACHE_DISK_DIR", "") # Empty disables the on-disk tier
+LLM_CACHE_DISK_MAX_ENTRIES = int(os.getenv("LLM_CACHE_DISK_MAX_ENTRIES", 10000))
+
+# --- Single-Flight Coalescing (identical concurrent /generate requests share one upstream call) ---
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# --- Generation Scheduler ---
+# Concurrent upstream calls per backend (0 = unlimited). Local GPU boxes are bounded by default.
+SCHEDULER_SLOTS = {
+    "ollama": int(os.getenv("OLLAMA_CONCURRENCY", 2)),
+    "kobold": int(os.getenv("KOBOLD_CONCURRENCY", 1)),
+    "custom_external": int(os.getenv("CUSTOM_API_CONCURRENCY", 0)),
+    "groq": int(os.getenv("GROQ_CONCURRENCY", 0)),
+    "openai": int(os.getenv("OPENAI_CONCURRENCY", 0)),
+    "anthropic": int(os.getenv("ANTHROPIC_CONCURRENCY", 0)),
+    "google": int(os.getenv("GOOGLE_CONCURRENCY", 0)),
+    "xai": int(os.getenv("XAI_CONCURRENCY", 0)),
+}
+SCHEDULER_RESERVED_SLOTS = int(os.getenv("SCHEDULER_RESERVED_SLOTS", 1)) # Slots bulk work may never occupy; if all are, bulk runs only when nothing else is active or queued
+SCHEDULER_MAX_QUEUE_DEPTH = int(os.getenv("SCHEDULER_MAX_QUEUE_DEPTH", 64)) # Per backend; beyond this requests get 429
+SCHEDULER_QUEUE_TIMEOUTS = { # Seconds a request may wait for a slot, per priority class
+    "voice": float(os.getenv("SCHEDULER_VOICE_QUEUE_TIMEOUT", 10)),
+    "interactive": float(os.getenv("SCHEDULER_INTERACTIVE_QUEUE_TIMEOUT", 30)),
+    "bulk": float(os.getenv("SCHEDULER_BULK_QUEUE_TIMEOUT", 600)),
+}
+
+# --- Batch Generation (/api/generate/batch) ---
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 4)) # Upper bound on per-batch parallelism
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 1000))
+
+# --- Upstream Retries ---
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 30)) # Cap on backoff; longer Retry-After hints are not waited out
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", 0.2)) # Retry tokens earned per request
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", 1)) # Floor refill so low traffic can still retry
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", 20))
+
+# --- Hedged Requests (non-streaming only) ---
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_BACKENDS = {b.strip() for b in os.getenv("HEDGE_BACKENDS", "groq,openai,anthropic,google,xai").split(",") if b.strip()}
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95)) # Hedge once the primary is slower than this latency percentile
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20)) # Observed calls needed before hedging a backend
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 0.25)) # Seconds; floor on the hedge delay
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", 0.05)) # Max fraction of requests that may be hedged
+
+# --- LLM Routing / Failover ---
+def _parse_failover_map(raw):
+    """Parses "backend:model=backend:model|backend:model;..." (model may be *) into {"backend:model": [(backend, model), ...]}."""
+    failover = {}
+    for entry in raw.split(";"):
+        if "=" not in entry:
+            continue
+        source, targets = entry.split("=", 1)
+        failover[source.strip()] = [tuple(t.strip().split(":", 1)) for t in targets.split("|") if ":" in t]
+    return failover
+
+LLM_FAILOVER = _parse_failover_map(os.getenv("LLM_FAILOVER", ""))
+LLM_ROUTING_POLICY = os.getenv("LLM_ROUTING_POLICY", "primary").lower() # "primary" or "fastest"
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", 0.2))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 3)) # Consecutive failures
+CIRCUIT_ERROR_RATE_THRESHOLD = float(os.getenv("CIRCUIT_ERROR_RATE_THRESHOLD", 0.5))
+CIRCUIT_MIN_SAMPLES = int(os.getenv("CIRCUIT_MIN_SAMPLES", 10))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 30))
+
+# --- Ollama Model Residency ---
+OLLAMA_RESIDENCY_ENABLED = os.getenv("OLLAMA_RESIDENCY_ENABLED", "true").lower() in ("1", "true", "yes")
+VOICE_LLM_MODEL = os.getenv("VOICE_LLM_MODEL", "llama3") # Ollama model answering voice turns
+# Models loaded at startup and always kept resident (the voice model by default)
+OLLAMA_WARM_MODELS = [m.strip() for m in os.getenv("OLLAMA_WARM_MODELS", VOICE_LLM_MODEL).split(",") if m.strip()]
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m") # keep_alive sent for hot/pinned models (Ollama's default is 5m)
+OLLAMA_RESIDENCY_BUDGET_BYTES = int(os.getenv("OLLAMA_RESIDENCY_BUDGET_BYTES", 0)) # VRAM/RAM for resident models; 0 = no limit
+OLLAMA_RESIDENCY_INTERVAL = float(os.getenv("OLLAMA_RESIDENCY_INTERVAL", 60)) # Seconds between refreshes
+OLLAMA_RESIDENCY_RATE_WINDOW = float(os.getenv("OLLAMA_RESIDENCY_RATE_WINDOW", 600)) # Seconds; decay window for request rates
+OLLAMA_WARMUP_TIMEOUT = float(os.getenv("OLLAMA_WARMUP_TIMEOUT", 300)) # Loading a large model can take minutes
+
+# --- Conversation State Reuse (Ollama context / stable prompt prefixes for local backends) ---
+CONVERSATION_STATE_ENABLED = os.getenv("CONVERSATION_STATE_ENABLED", "true").lower() in ("1", "true", "yes")
+CONVERSATION_STATE_MAX_SESSIONS = int(os.getenv("CONVERSATION_STATE_MAX_SESSIONS", 512)) # Ollama contexts / anchors kept (LRU)
+CONVERSATION_REANCHOR_KEEP = float(os.getenv("CONVERSATION_REANCHOR_KEEP", 0.5)) # Fraction of the window kept when the prefix must move
+
+# --- Model Catalog Cache (/api/models, /api/external-models) ---
+def _parse_ttl_map(raw):
+    """Parses "backend=seconds,..." into {backend: seconds}."""
+    ttls = {}
+    for entry in raw.split(","):
+        if "=" in entry:
+            backend, seconds = entry.split("=", 1)
+            ttls[backend.strip()] = float(seconds)
+    return ttls
+
+MODEL_CATALOG_DEFAULT_TTL = float(os.getenv("MODEL_CATALOG_DEFAULT_TTL", 3600)) # Seconds a provider's model list is served without revalidating
+MODEL_CATALOG_TTLS = {'ollama': 30, **_parse_ttl_map(os.getenv("MODEL_CATALOG_TTLS", ""))} # Local models get pulled/removed more often
+MODEL_CATALOG_MAX_STALE = float(os.getenv("MODEL_CATALOG_MAX_STALE", 86400)) # Older lists are refetched before answering
+MODEL_CATALOG_ERROR_TTL = float(os.getenv("MODEL_CATALOG_ERROR_TTL", 15)) # Seconds a failed fetch is reported without retrying
+MODEL_DISCOVERY_TIMEOUT = float(os.getenv("MODEL_DISCOVERY_TIMEOUT", 10)) # Seconds /api/models/all waits for each provider
+
 # --- Model Specific Config ---
 KOBOLD_CONTEXT_LIMIT = int(os.getenv("KOBOLD_CONTEXT_LIMIT", 4096))
+OLLAMA_CONTEXT_LIMIT = int(os.getenv("OLLAMA_CONTEXT_LIMIT", 4096)) # Sent to Ollama as options.num_ctx
+
+# --- Context Budgeting ---
+DEFAULT_CONTEXT_LIMIT = int(os.getenv("DEFAULT_CONTEXT_LIMIT", 8192)) # For models without a known window
+CONTEXT_RESERVED_TOKENS = int(os.getenv("CONTEXT_RESERVED_TOKENS", 1024)) # Generation budget kept free
+# "model-prefix=tokens,..." e.g. "qwen2.5=32768,my-finetune=16384"
+CONTEXT_LIMIT_OVERRIDES = {k.strip(): int(v) for k, v in (item.split("=", 1) for item in os.getenv("CONTEXT_LIMIT_OVERRIDES", "").split(",") if "=" in item)}
+# "model-family=/path/to/tokenizer.json,..." to count tokens with a model's real HF tokenizer
+CONTEXT_TOKENIZER_FILES = {k.strip().lower(): v.strip() for k, v in (item.split("=", 1) for item in os.getenv("CONTEXT_TOKENIZER_FILES", "").split(",") if "=" in item)}
 
 # --- STT (Whisper) Config ---
 WHISPER_MODEL_NAME = os.getenv("WHISPER_MODEL", "base.en")
@@ -0,0 +1,42 @@
+from flask import Blueprint, request, jsonify, send_file
+import logging
+import sqlite3
+from services import blob_store
+import config # Import full config for API endpoints etc.
+
+blobs_bp = Blueprint('blobs', __name__, url_prefix='/api')
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600 # A digest names its content forever
+
+@blobs_bp.route('/blobs/<digest>', methods=['GET'])
+def get_blob(digest):
+    """Serves a stored image. The digest is a strong ETag and the response never changes, so it is cacheable forever."""
+    if not blob_store.is_digest(digest):
+        return jsonify({'status': 'error', 'message': 'Invalid blob digest.'}), 400
+    try:
+        info = blob_store.get_info(digest)
+    except sqlite3.Error as e:
+        logging.error(f"Error looking up blob {digest}: {e}")
+        return jsonify({'status': 'error', 'message': 'Blob store is unavailable.'}), 503
+    if info is None:
+        return jsonify({'status': 'error', 'message': 'Blob not found.'}), 404
+    path, content_type, _ = info
+    response = send_file(path, mimetype=content_type, etag=digest, max_age=IMMUTABLE_MAX_AGE) # Answers If-None-Match with 304
+    response.cache_control.immutable = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+@blobs_bp.route('/blobs', methods=['POST'])
+def upload_blob():
+    """Stores the request body (an image, typed by its Content-Type) and returns its digest and URL.
+    Uploading content that is already stored only refreshes it."""
+    if request.content_length is not None and request.content_length > config.BLOB_MAX_BYTES:
+        return jsonify({'status': 'error', 'message': f'Blob too large; limit is {config.BLOB_MAX_BYTES} bytes.'}), 413
+    try:
+        digest = blob_store.put(request.get_data(), request.content_type)
+        return jsonify({'status': 'success', 'digest': digest, 'url': blob_store.blob_url(digest)})
+    except ValueError as e: # Unsupported type or too large
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except (OSError, sqlite3.Error) as e:
+        logging.error(f"Error storing blob: {e}")
+        return jsonify({'status': 'error', 'message': 'Could not store blob.'}), 500
@@ -1,16 +1,35 @@
 from flask import Blueprint, request, jsonify, Response
 import logging
 import json
+import time
 import uuid
-from utils import make_request_with_retry
-from services.llm_backends import call_llm_backend
-from services.history_manager import get_chat_list as get_chat_list_from_history, \
-                                     load_chat_data, save_chat_data, delete_chat_file
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from services.http_pool import get_session
+from services.llm_backends import is_error_response
+from services.llm_router import routed_call_llm_backend, routed_stream_llm_backend
+from services import response_cache, single_flight, scheduler, cancellation, chat_search
+from services.retry_policy import RequestCancelled
+from services.history_manager import get_chat_page, load_chat_data, load_chat_page, save_chat_data, delete_chat_file, append_chat_items
 from config import state # Import shared state
 import config # Import full config for API endpoints etc.
 
 chat_bp = Blueprint('chat', __name__, url_prefix='/api')
 
+def cache_bypass_requested():
+    """True if the client asked to skip cached responses (X-Cache-Bypass or Cache-Control: no-cache)."""
+    if request.headers.get('X-Cache-Bypass', '').lower() in ('1', 'true', 'yes'):
+        return True
+    cache_control = request.headers.get('Cache-Control', '').lower()
+    return 'no-cache' in cache_control or 'no-store' in cache_control
+
+def replay_cached_stream(response_text):
+    """Replays a cached response with the same SSE shape as a live stream."""
+    for chunk_content in response_cache.split_for_replay(response_text):
+        yield f"data: {json.dumps({'response': chunk_content})}\n\n"
+    yield "data: [DONE]\n\n"
+
 @chat_bp.route('/generate', methods=['POST'])
 def generate_text():
     """Generates text using the selected backend."""
@@ -25,7 +44,10 @@ def generate_text():
         backend = data.get('backend', 'ollama')
         model = data.get('model')
         history_context = data.get('history', []) # Newest first
-        stream = request.args.get('stream', 'false').lower() == 'true' and backend == 'ollama'
+        stream = request.args.get('stream', 'false').lower() == 'true'
+        priority = data.get('priority', scheduler.PRIORITY_INTERACTIVE)
+        if priority not in (scheduler.PRIORITY_INTERACTIVE, scheduler.PRIORITY_BULK): # Voice is reserved for socket turns
+            return jsonify({'status': 'error', 'message': f'Invalid priority: {priority}'}), 400
 
         logging.info(f"HTTP Route: /generate - backend={backend}, stream={stream}, client={client_id}, model={model}, prompt='{prompt[:50]}...'")
 
@@ -41,105 +63,141 @@ def generate_text():
             if not config.CUSTOM_API_ENDPOINT: return jsonify({'status': 'error', 'message': 'Custom API Endpoint not configured.'}), 400
             if not config.CUSTOM_API_MODEL_NAME: logging.warning("Custom backend selected, but model name not configured.")
 
+        # --- Response Cache ---
+        request_key = response_cache.make_cache_key(prompt, history_context, backend, model) # Also the single-flight key
+        cache_key = None
+        if config.LLM_CACHE_ENABLED:
+            cache_key = request_key
+            if cache_bypass_requested():
+                response_cache.record_bypass()
+            else:
+                cached_text = response_cache.get_cached_response(cache_key)
+                if cached_text is not None:
+                    logging.info(f"Serving cached {backend} response for client {client_id}.")
+                    if stream:
+                        cached_response = Response(replay_cached_stream(cached_text), mimetype='text/event-stream')
+                    else:
+                        cached_response = jsonify({'status': 'success', 'response': cached_text})
+                    cached_response.headers['X-Cache'] = 'HIT'
+                    return cached_response
+
+        # --- Fast rejection when the backend queue is already full ---
+        try:
+            scheduler.check_admission(backend)
+        except scheduler.SchedulerRejected as e:
+            rejected_response = jsonify({'status': 'error', 'message': str(e)})
+            rejected_response.headers['Retry-After'] = str(e.retry_after)
+            return rejected_response, 429
+
         # --- Task Management ---
+        cancel_event = cancellation.CancelHandle(f"text task {client_id}") # Set by /api/cancel; aborts the upstream call
         with state["task_lock"]:
-            state["active_tasks"][client_id] = {"type": "text", "backend": backend, "controller": None}
+            state["active_tasks"][client_id] = {"type": "text", "backend": backend, "controller": None, "cancel_event": cancel_event}
             logging.debug(f"Task {client_id} added (text/{backend})")
 
-        # --- Handle Ollama Streaming ---
-        if backend == 'ollama' and stream:
-            # Convert history (newest first) to Ollama format (oldest first)
-            messages_for_ollama = [{'role': msg.get('role','user'), 'content': msg.get('content','')} for msg in history_context]
-            messages_for_ollama.reverse()
-            messages_for_ollama.append({'role': 'user', 'content': prompt})
-            ollama_payload = {'model': model, 'messages': messages_for_ollama, 'stream': True}
-            endpoint = f"{config.OLLAMA_API}/api/chat"
-
-            def generate_ollama_stream():
-                response = None
+        # --- Handle Streaming (all backends) ---
+        if stream:
+            def generate_stream():
                 request_cancelled = False
-                try:
-                    logging.info(f"Initiating Ollama stream request to: {endpoint} for client {client_id}")
-                    stream_headers = {'Accept': 'text/event-stream', 'X-Client-ID': client_id}
-                    response = make_request_with_retry(endpoint, "POST", json_data=ollama_payload, headers=stream_headers, stream=True, timeout=300, retries=1)
-                    logging.info(f"Ollama stream connection established for {client_id}.")
+                stream_complete = False # Set only if the requested backend/model signalled the end of its reply
+                streamed_chunks = []
 
+                def register_stream_controller(response):
+                    nonlocal request_cancelled
                     with state["task_lock"]:
-                        if client_id in state["active_tasks"]:
-                            state["active_tasks"][client_id]["controller"] = getattr(response, 'raw', response)
-                            logging.debug(f"Assigned stream controller for client {client_id}")
-                        else:
+                        if client_id not in state["active_tasks"]:
                             logging.info(f"Task {client_id} removed before stream controller assignment.")
-                            if response: response.close()
                             request_cancelled = True
-                            return
-
-                    buffer = ""
-                    for line in response.iter_lines():
-                        with state["task_lock"]:
-                            if client_id not in state["active_tasks"]:
-                                logging.info(f"Cancellation detected during Ollama stream for client {client_id}.")
-                                request_cancelled = True
-                                break
-                        if line:
-                            try:
-                                decoded_line = line.decode('utf-8')
-                                buffer += decoded_line
-                                # Try parsing potential JSON object chunks
-                                while True:
-                                    try:
-                                        data_json, index = json.JSONDecoder().raw_decode(buffer)
-                                        buffer = buffer[index:].lstrip() # Remove processed part + leading whitespace
-
-                                        chunk_content = data_json.get('message', {}).get('content')
-                                        if chunk_content is None and 'response' in data_json:
-                                            chunk_content = data_json['response']
-
-                                        if chunk_content is not None:
-                                            sse_data = json.dumps({'response': chunk_content})
-                                            yield f"data: {sse_data}\n\n"
-
-                                        if data_json.get('done'):
-                                            logging.info(f"Ollama stream received 'done: true' marker for {client_id}.")
-                                            request_cancelled = True # Treat 'done' as end signal
-                                            break # Exit inner loop
-                                    except json.JSONDecodeError:
-                                        # Incomplete JSON object in buffer, break inner loop and wait for more data
-                                        break
-                                # Check outer loop break condition
-                                if request_cancelled:
-                                    break
-                            except Exception as e_parse:
-                                logging.error(f"Error processing Ollama stream line: {e_parse}", exc_info=True)
-                                buffer = "" # Clear buffer on error
-
-                    logging.info(f"Ollama stream loop finished for {client_id}. Cancelled: {request_cancelled}")
-                    if not request_cancelled: # If ended without 'done' or explicit cancel
+                            return False
+                        state["active_tasks"][client_id]["controller"] = getattr(response, 'raw', response)
+                        logging.debug(f"Assigned stream controller for client {client_id}")
+                    return True
+
+                def mark_complete():
+                    nonlocal stream_complete
+                    stream_complete = True
+
+                def open_upstream(on_connect, shared_cancel_event, on_complete):
+                    # A shared stream is closed by single_flight once its last subscriber leaves,
+                    # so only register this client's controller when the stream is not shared.
+                    return routed_stream_llm_backend(prompt, history_context, backend, model, on_connect=on_connect or register_stream_controller,
+                                                     priority=priority, cancel_event=shared_cancel_event or cancel_event, on_complete=on_complete)
+
+                try:
+                    # cancel_event also wakes a subscriber still queued or waiting for the first token
+                    for chunk_content in single_flight.stream(request_key, open_upstream, on_complete=mark_complete, cancel_event=cancel_event):
+                        if cancel_event.is_set(): # Set by /api/cancel; no lock needed per token
+                            logging.info(f"Cancellation detected during {backend} stream for client {client_id}.")
+                            request_cancelled = True
+                            break
+                        streamed_chunks.append(chunk_content)
+                        sse_data = json.dumps({'response': chunk_content})
+                        yield f"data: {sse_data}\n\n"
+
+                    logging.info(f"{backend} stream loop finished for {client_id}. Cancelled: {request_cancelled}")
+                    if not request_cancelled:
+                        if cache_key and streamed_chunks and stream_complete: # A truncated reply must not be served again
+                            response_cache.store_response(cache_key, "".join(streamed_chunks).strip())
                         yield "data: [DONE]\n\n"
                         logging.debug(f"Sent stream [DONE] marker for client {client_id}")
 
+                except scheduler.SchedulerRejected as e_busy:
+                    logging.warning(f"{backend} stream for client {client_id} rejected by scheduler: {e_busy}")
+                    yield f"data: {json.dumps({'status': 'error', 'message': str(e_busy), 'retry_after': e_busy.retry_after})}\n\n"
+                except RequestCancelled as e_cancel: # This client cancelled; a shared upstream goes on for the others
+                    logging.info(f"{backend} stream for client {client_id} cancelled: {e_cancel}")
+                    request_cancelled = True
+                except ValueError as e_cfg:
+                    logging.error(f"Configuration error starting {backend} stream for client {client_id}: {e_cfg}")
+                    yield f"data: {json.dumps({'status': 'error', 'message': f'[Error: {e_cfg}]'})}\n\n"
+                except requests.RequestException as e_req:
+                    logging.error(f"Error connecting to {backend} stream for client {client_id}: {e_req}")
+                    if not request_cancelled:
+                        yield f"data: {json.dumps({'status': 'error', 'message': f'Error connecting to {backend} API: {e_req}'})}\n\n"
                 except Exception as e_gen:
-                    logging.exception(f"Unexpected error during Ollama streaming for client {client_id}:")
+                    logging.exception(f"Unexpected error during {backend} streaming for client {client_id}:")
                     if not request_cancelled:
                         yield f"data: {json.dumps({'status': 'error', 'message': 'Internal server error during stream.'})}\n\n"
                 finally:
-                    logging.info(f"Cleaning up task {client_id} after Ollama stream (Cancelled: {request_cancelled}).")
-                    if response:
-                        try: response.close()
-                        except Exception as e_close: logging.warning(f"Error closing response: {e_close}")
+                    logging.info(f"Cleaning up task {client_id} after {backend} stream (Cancelled: {request_cancelled}).")
                     with state["task_lock"]:
                         state["active_tasks"].pop(client_id, None)
 
-            return Response(generate_ollama_stream(), mimetype='text/event-stream')
+            stream_response = Response(generate_stream(), mimetype='text/event-stream')
+            if cache_key:
+                stream_response.headers['X-Cache'] = 'MISS'
+            return stream_response
 
         # --- Handle Non-Streaming Backends ---
         else:
-            response_text = call_llm_backend(prompt, history_context, backend, model)
+            try:
+                # The shared handle is set only once every coalesced caller has cancelled
+                (response_text, served_backend, served_model), coalesced = single_flight.call(
+                    request_key, lambda shared_cancel_event: routed_call_llm_backend(prompt, history_context, backend, model, priority=priority,
+                                                                                     cancel_event=shared_cancel_event),
+                    cancel_event=cancel_event)
+            except RequestCancelled as e: # This client left; a shared upstream call goes on for the others
+                logging.info(f"Client {client_id} cancelled while waiting for {backend}: {e}")
+                (response_text, served_backend, served_model), coalesced = (f"[Error connecting to {backend} API: {e}]", backend, model), False
+            except scheduler.SchedulerRejected as e:
+                with state["task_lock"]:
+                    state["active_tasks"].pop(client_id, None)
+                rejected_response = jsonify({'status': 'error', 'message': str(e)})
+                rejected_response.headers['Retry-After'] = str(e.retry_after)
+                return rejected_response, 429
+            if coalesced:
+                logging.info(f"Client {client_id} shared an in-flight {backend} request.")
             with state["task_lock"]:
                 state["active_tasks"].pop(client_id, None) # Remove task on completion/error
 
-            if response_text and not response_text.startswith("[Error"):
-                return jsonify({'status': 'success', 'response': response_text})
+            if not is_error_response(response_text):
+                if cache_key and (served_backend, served_model) == (backend, model): # Never cache a failover reply under the requested key
+                    response_cache.store_response(cache_key, response_text)
+                success_response = jsonify({'status': 'success', 'response': response_text})
+                success_response.headers['X-Served-By'] = f"{served_backend}:{served_model}"
+                if cache_key:
+                    success_response.headers['X-Cache'] = 'MISS'
+                return success_response
             else:
                 error_message = response_text or f"{backend.capitalize()} call failed."
                 status_code = 400 if "[Error: " in error_message and ("API Key" in error_message or "Endpoint" in error_message or "Model name" in error_message) else 500
@@ -153,12 +211,127 @@ def generate_text():
         return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
 
 
+def run_batch_item(item, backend, model, cancel_event):
+    """Generates one batch item; returns its NDJSON result record."""
+    start_time = time.monotonic()
+    record = {'index': item['index'], 'id': item['id']}
+    cache_key = response_cache.make_cache_key(item['prompt'], item['history'], backend, model) if config.LLM_CACHE_ENABLED else None
+    try:
+        response_text = response_cache.get_cached_response(cache_key) if cache_key else None
+        if response_text is not None:
+            served_backend, served_model = backend, model
+            record['cached'] = True
+        else:
+            response_text, served_backend, served_model = routed_call_llm_backend(
+                item['prompt'], item['history'], backend, model, priority=scheduler.PRIORITY_BULK, cancel_event=cancel_event)
+        if is_error_response(response_text):
+            record.update({'status': 'error', 'message': response_text})
+        else:
+            if cache_key and not record.get('cached') and (served_backend, served_model) == (backend, model):
+                response_cache.store_response(cache_key, response_text)
+            record.update({'status': 'success', 'response': response_text, 'served_by': f"{served_backend}:{served_model}"})
+    except scheduler.SchedulerRejected as e:
+        record.update({'status': 'error', 'message': str(e), 'retry_after': e.retry_after})
+    except Exception as e:
+        logging.exception(f"Unexpected error generating batch item {item['index']}:")
+        record.update({'status': 'error', 'message': f'Server error: {str(e)}'})
+    record['elapsed_ms'] = round((time.monotonic() - start_time) * 1000, 1)
+    return record
+
+@chat_bp.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    """Runs many prompts against one backend with bounded parallelism, streaming NDJSON results as they finish.
+
+    Items are prompt strings or {"id", "prompt", "history"} objects. Each line is
+    one item's result (with index, timing and per-item errors); the last line
+    is a summary with "done": true.
+    """
+    client_id = request.headers.get('X-Client-ID') or str(uuid.uuid4())
+    try:
+        data = request.get_json()
+        if not data: return jsonify({'status': 'error', 'message': 'Invalid JSON payload'}), 400
+
+        backend = data.get('backend', 'ollama')
+        model = data.get('model')
+        shared_history = data.get('history', []) # Newest first; used by items without their own history
+        raw_items = data.get('prompts')
+        if not isinstance(raw_items, list) or not raw_items:
+            return jsonify({'status': 'error', 'message': 'prompts must be a non-empty list'}), 400
+        if len(raw_items) > config.BATCH_MAX_ITEMS:
+            return jsonify({'status': 'error', 'message': f'Too many prompts ({len(raw_items)}); limit is {config.BATCH_MAX_ITEMS}.'}), 400
+        if backend == 'ollama' and not model: return jsonify({'status': 'error', 'message': 'Model is required for Ollama'}), 400
+        if backend == 'kobold' and not model: model = 'default'
+
+        items = []
+        for index, raw_item in enumerate(raw_items):
+            if isinstance(raw_item, str):
+                raw_item = {'prompt': raw_item}
+            if not isinstance(raw_item, dict) or not raw_item.get('prompt'):
+                return jsonify({'status': 'error', 'message': f'Item {index} has no prompt'}), 400
+            items.append({'index': index, 'id': raw_item.get('id', index), 'prompt': raw_item['prompt'],
+                          'history': raw_item.get('history', shared_history)})
+
+        try:
+            concurrency = int(data.get('concurrency', config.BATCH_MAX_CONCURRENCY))
+        except (TypeError, ValueError):
+            return jsonify({'status': 'error', 'message': 'concurrency must be an integer'}), 400
+        concurrency = max(1, min(concurrency, config.BATCH_MAX_CONCURRENCY, len(items)))
+
+        logging.info(f"HTTP Route: /generate/batch - backend={backend}, model={model}, items={len(items)}, concurrency={concurrency}, client={client_id}")
+
+        cancel_event = cancellation.CancelHandle(f"batch {client_id}") # Aborts every in-flight item
+        with state["task_lock"]:
+            state["active_tasks"][client_id] = {"type": "batch", "backend": backend, "controller": None, "cancel_event": cancel_event}
+
+        def generate_results():
+            start_time = time.monotonic()
+            succeeded = failed = 0
+            cancelled = False
+            executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-generate")
+            futures = [executor.submit(run_batch_item, item, backend, model, cancel_event) for item in items]
+            try:
+                for future in as_completed(futures):
+                    cancelled = cancel_event.is_set()
+                    if cancelled:
+                        logging.info(f"Batch {client_id} cancelled; dropping queued items.")
+                        break
+                    record = future.result()
+                    if record['status'] == 'success':
+                        succeeded += 1
+                    else:
+                        failed += 1
+                    yield json.dumps(record) + "\n"
+                yield json.dumps({'done': True, 'cancelled': cancelled, 'total': len(items), 'succeeded': succeeded,
+                                  'failed': failed, 'elapsed_ms': round((time.monotonic() - start_time) * 1000, 1)}) + "\n"
+            finally:
+                cancel_event.set() # Stops retries of items still running; also runs when the client disconnects
+                executor.shutdown(wait=False, cancel_futures=True)
+                with state["task_lock"]:
+                    state["active_tasks"].pop(client_id, None)
+
+        return Response(generate_results(), mimetype='application/x-ndjson')
+
+    except Exception as e:
+        logging.exception("Unexpected error during /generate/batch:")
+        return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
+
 @chat_bp.route('/chats', methods=['GET'])
 def list_chats():
-    """Lists available chat IDs based on stored files."""
+    """Lists chats newest first; ?limit=N pages through them, following next_cursor via ?cursor=."""
     try:
-        chat_list = get_chat_list_from_history()
-        return jsonify({'status': 'success', 'chats': chat_list})
+        limit = request.args.get('limit')
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                return jsonify({'status': 'error', 'message': 'limit must be an integer'}), 400
+            if not 1 <= limit <= config.CHAT_LIST_MAX_LIMIT:
+                return jsonify({'status': 'error', 'message': f'limit must be between 1 and {config.CHAT_LIST_MAX_LIMIT}'}), 400
+        try:
+            chat_list, next_cursor = get_chat_page(limit, request.args.get('cursor'))
+        except ValueError as e: # Malformed cursor
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        return jsonify({'status': 'success', 'chats': chat_list, 'next_cursor': next_cursor})
     except OSError as e:
         logging.error(f"Error listing chat directory {config.HISTORY_DIR}: {e}")
         return jsonify({'status': 'error', 'message': 'Could not list chat histories.'}), 500
@@ -166,12 +339,56 @@ def list_chats():
         logging.exception("Unexpected error listing chats:")
         return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
 
+@chat_bp.route('/chats/search', methods=['GET'])
+def search_chats():
+    """Full-text search over chat messages: ?q= returns chats ranked by their best match, with a snippet.
+    ?limit=N (default 20) and ?offset= page through results, following next_offset."""
+    if not config.SEARCH_ENABLED:
+        return jsonify({'status': 'error', 'message': 'Chat search is disabled (SEARCH_ENABLED=false).'}), 503
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'status': 'error', 'message': 'Missing search query (q).'}), 400
+    try:
+        limit = int(request.args.get('limit', 20))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'limit and offset must be integers'}), 400
+    if not 1 <= limit <= config.SEARCH_MAX_LIMIT or offset < 0:
+        return jsonify({'status': 'error', 'message': f'limit must be between 1 and {config.SEARCH_MAX_LIMIT}, offset at least 0'}), 400
+    try:
+        results, next_offset, truncated = chat_search.search(query, limit, offset)
+        return jsonify({'status': 'success', 'results': results, 'next_offset': next_offset, 'truncated': truncated,
+                        'indexing': chat_search.is_syncing()}) # Results may be incomplete while the index is built
+    except ValueError as e: # Query without any searchable words
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except sqlite3.Error as e:
+        logging.error(f"Error searching chats in {config.HISTORY_SEARCH_DB_PATH}: {e}")
+        return jsonify({'status': 'error', 'message': 'Chat search is unavailable.'}), 503
+    except Exception as e:
+        logging.exception("Unexpected error searching chats:")
+        return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
+
 @chat_bp.route('/chat/<chat_id>', methods=['GET'])
 def get_chat(chat_id):
-    """Gets the message and image history for a specific chat."""
+    """Gets the message and image history for a specific chat.
+
+    With ?limit=N only the N newest messages are returned, plus next_cursor; pass it
+    back as ?before= for the next older page (images come with the first page only).
+    """
     try:
-        chat_data = load_chat_data(chat_id)
-        return jsonify({'status': 'success', 'chat_id': chat_id, 'history': chat_data})
+        if 'limit' not in request.args and 'before' not in request.args:
+            chat_data = load_chat_data(chat_id)
+            return jsonify({'status': 'success', 'chat_id': chat_id, 'history': chat_data})
+        try:
+            limit = int(request.args.get('limit', config.CHAT_HISTORY_PAGE_SIZE))
+            before = int(request.args['before']) if request.args.get('before') else None
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'limit and before must be integers'}), 400
+        if not 1 <= limit <= config.CHAT_HISTORY_MAX_PAGE_SIZE:
+            return jsonify({'status': 'error', 'message': f'limit must be between 1 and {config.CHAT_HISTORY_MAX_PAGE_SIZE}'}), 400
+        chat_data, next_cursor, message_count = load_chat_page(chat_id, before, limit)
+        return jsonify({'status': 'success', 'chat_id': chat_id, 'history': chat_data,
+                        'next_cursor': next_cursor, 'message_count': message_count})
     except ValueError as e:
         return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
@@ -193,6 +410,31 @@ def save_chat(chat_id):
         logging.exception(f"Unexpected error saving chat {chat_id}:")
         return jsonify({'status': 'error', 'message': f'Server error saving chat: {str(e)}'}), 500
 
+@chat_bp.route('/chat/<chat_id>/messages', methods=['POST'])
+def append_chat_messages(chat_id):
+    """Appends new turns to a chat without resending its history.
+
+    Body: {"messages": [...], "images": [...]}, either may be omitted; items are
+    oldest first and become the chat's newest entries.
+    """
+    try:
+        data = request.get_json()
+        if not isinstance(data, dict):
+            return jsonify({'status': 'error', 'message': 'Invalid JSON payload'}), 400
+        messages = data.get('messages', [])
+        images = data.get('images', [])
+        if not isinstance(messages, list) or not isinstance(images, list) or not (messages or images):
+            return jsonify({'status': 'error', 'message': 'Provide a non-empty messages and/or images list.'}), 400
+        if not all(isinstance(m, dict) and m.get('role') for m in messages):
+            return jsonify({'status': 'error', 'message': 'Each message must be an object with a role.'}), 400
+        append_chat_items(chat_id, messages, images)
+        return jsonify({'status': 'success', 'message': f'Appended {len(messages)} message(s) and {len(images)} image(s) to chat {chat_id}.'})
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        logging.exception(f"Unexpected error appending to chat {chat_id}:")
+        return jsonify({'status': 'error', 'message': f'Server error saving chat: {str(e)}'}), 500
+
 @chat_bp.route('/chat/<chat_id>', methods=['DELETE'])
 def delete_chat(chat_id):
     """Deletes the history file for a specific chat."""
@@ -238,7 +480,10 @@ def cancel_task_route():
             logging.info(f"Processing cancellation for client {client_id}, type: {task_type}, backend: {backend}, prompt_id: {prompt_id}")
 
             # --- Cancellation Logic ---
-            if task_type == "text" and backend == "ollama" and controller:
+            cancel_event = task_details.get("cancel_event")
+            if cancel_event is not None:
+                cancel_event.set() # Aborts in-flight upstream requests and wakes retry backoffs
+            if task_type == "text" and controller:
                 # Controller might be requests.Response or response.raw
                 logging.info(f"Attempting to close controller for text stream {client_id}")
                 try:
@@ -254,8 +499,8 @@ def cancel_task_route():
                 logging.info(f"Attempting ComfyUI interrupt for client {client_id} / prompt {prompt_id}")
                 try:
                     interrupt_payload = {"client_id": client_id}
-                    # Use make_request_with_retry for interrupt as well? Maybe not needed.
-                    interrupt_response = requests.post(f"{config.COMFYUI_API_BASE}/interrupt", json=interrupt_payload, timeout=5)
+                    interrupt_url = f"{config.COMFYUI_API_BASE}/interrupt"
+                    interrupt_response = get_session(interrupt_url).post(interrupt_url, json=interrupt_payload, timeout=5)
                     if interrupt_response.ok:
                         logging.info(f"Sent ComfyUI interrupt request for client {client_id} / prompt {prompt_id}.")
                     else:
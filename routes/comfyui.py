@@ -3,13 +3,27 @@ import logging
 import json
 import time
 import requests
+import sqlite3
 from urllib.parse import urlencode
 from utils import make_request_with_retry, find_node_errors
+from services.http_pool import get_session
+from services import blob_store
 from config import state # Import shared state
 import config # Import full config
 
 comfyui_bp = Blueprint('comfyui', __name__, url_prefix='/api')
 
+def store_generated_image(image_url):
+    """Copies a generated image from ComfyUI into the blob store and returns its blob URL,
+    so chat histories don't depend on ComfyUI's output folder. Falls back to the ComfyUI URL."""
+    try:
+        response = get_session(image_url).get(image_url, timeout=30)
+        response.raise_for_status()
+        return blob_store.blob_url(blob_store.put(response.content, response.headers.get('Content-Type')))
+    except (requests.RequestException, ValueError, OSError, sqlite3.Error) as e:
+        logging.warning(f"Could not copy generated image into the blob store, using the ComfyUI URL: {e}")
+        return image_url
+
 @comfyui_bp.route('/comfyui-status', methods=['GET'])
 def check_comfyui_status():
     """Checks if ComfyUI server is running."""
@@ -147,7 +161,8 @@ def generate_image_route():
                     # Try to interrupt ComfyUI
                     try:
                         interrupt_payload = {"client_id": client_id}
-                        requests.post(f"{config.COMFYUI_API_BASE}/interrupt", json=interrupt_payload, timeout=5)
+                        interrupt_url = f"{config.COMFYUI_API_BASE}/interrupt"
+                        get_session(interrupt_url).post(interrupt_url, json=interrupt_payload, timeout=5)
                         logging.info(f"Sent ComfyUI interrupt request for {client_id}.")
                     except requests.RequestException as e_int:
                          logging.warning(f"Could not send ComfyUI interrupt: {e_int}")
@@ -209,6 +224,7 @@ def generate_image_route():
             state["active_tasks"].pop(client_id, None) # Clean up task entry
 
         if image_url:
+            image_url = store_generated_image(image_url)
             return jsonify({'status': 'success', 'image_url': image_url, 'message': final_status_message})
         else:
             logging.error(f"Image generation failed/timed out for Prompt ID {prompt_id}. Final status: {final_status_message}")
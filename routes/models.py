@@ -1,31 +1,45 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response
+import json
+import time
 import logging
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 from utils import make_request_with_retry
 import config # Import config variables
+from services import ollama_residency, model_catalog
 
 models_bp = Blueprint('models', __name__, url_prefix='/api')
 
+def fetch_ollama_models():
+    """Fetches the installed model names from Ollama's /api/tags (uncached)."""
+    logging.info("Fetching models from Ollama...")
+    url = f"{config.OLLAMA_API}/api/tags"
+    response_data = make_request_with_retry(url, "GET", timeout=10)
+
+    if not isinstance(response_data, dict):
+        logging.error(f"Unexpected response type ({type(response_data)}) from Ollama {url}")
+        raise ValueError('Internal error fetching Ollama models.')
+    models = response_data.get('models', [])
+    if not isinstance(models, list):
+        logging.warning("Ollama '/api/tags' response 'models' key was not a list.")
+        raise ValueError("Ollama response format error.")
+    model_names = [m['name'] for m in models if isinstance(m, dict) and 'name' in m]
+    logging.info(f"Found {len(model_names)} Ollama models.")
+    return model_names
+
+def _wants_refresh():
+    return request.args.get('refresh', 'false').lower() == 'true'
+
 @models_bp.route('/models', methods=['GET'])
 def get_ollama_models():
-    """Fetches available models from Ollama."""
+    """Lists available Ollama models (served from the model catalog cache; ?refresh=true refetches)."""
     try:
-        logging.info("Fetching models from Ollama...")
-        url = f"{config.OLLAMA_API}/api/tags"
-        response_data = make_request_with_retry(url, "GET", timeout=10)
-
-        if isinstance(response_data, dict):
-            models = response_data.get('models', [])
-            if isinstance(models, list):
-                 model_names = [m['name'] for m in models if isinstance(m, dict) and 'name' in m]
-                 logging.info(f"Found {len(model_names)} Ollama models.")
-                 return jsonify({'status': 'success', 'models': model_names})
-            else:
-                 logging.warning("Ollama '/api/tags' response 'models' key was not a list.")
-                 return jsonify({'status': 'error', 'message': "Ollama response format error."}), 500
-        else:
-             logging.error(f"Unexpected response type ({type(response_data)}) from Ollama {url}")
-             return jsonify({'status': 'error', 'message': 'Internal error fetching Ollama models.'}), 500
+        model_names, cache_status = model_catalog.get_models('ollama', fetch_ollama_models, force_refresh=_wants_refresh())
+        response = jsonify({'status': 'success', 'models': model_names})
+        response.headers['X-Cache'] = cache_status
+        return response
+    except ValueError as ve:
+        return jsonify({'status': 'error', 'message': str(ve)}), 500
     except requests.RequestException as e:
         logging.error(f"Error fetching Ollama models: {e}")
         return jsonify({'status': 'error', 'message': f'Failed to connect to Ollama: {str(e)}'}), 500
@@ -34,83 +48,107 @@ def get_ollama_models():
         return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
 
 
+@models_bp.route('/models/residency', methods=['GET'])
+def get_ollama_residency():
+    """Reports which Ollama models are loaded, which are kept hot, and their request rates."""
+    try:
+        if _wants_refresh():
+            ollama_residency.refresh_residency()
+        return jsonify({'status': 'success', 'residency': ollama_residency.get_residency_state()})
+    except Exception as e:
+        logging.exception("Unexpected error reporting Ollama residency:")
+        return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
+
+
+EXTERNAL_MODEL_BACKENDS = ('groq', 'openai', 'google', 'anthropic', 'xai')
+LOCAL_MODEL_BACKENDS = ('kobold', 'ollama', 'custom_external') # No dynamic model list via /api/external-models
+
+def fetch_external_models(backend):
+    """Fetches the sorted model list of an external provider (uncached).
+
+    Raises ValueError for configuration or response format problems and
+    requests.RequestException when the provider can't be reached.
+    """
+    headers = {'Accept': 'application/json'}
+    models = []
+
+    if backend == 'groq':
+        api_endpoint = "https://api.groq.com/openai/v1/models"
+        api_key = config.GROQ_API_KEY
+        if not api_key: raise ValueError("Groq API Key not configured on backend")
+        headers['Authorization'] = f'Bearer {api_key}'
+        response = make_request_with_retry(api_endpoint, "GET", headers=headers)
+        if isinstance(response, dict) and 'data' in response:
+            models = [m.get('id') for m in response['data'] if m.get('id')]
+        else: raise ValueError(f"Unexpected response format from Groq /models: {str(response)[:200]}")
+
+    elif backend == 'openai':
+        api_endpoint = "https://api.openai.com/v1/models"
+        api_key = config.OPENAI_API_KEY
+        if not api_key: raise ValueError("OpenAI API Key not configured on backend")
+        headers['Authorization'] = f'Bearer {api_key}'
+        response = make_request_with_retry(api_endpoint, "GET", headers=headers)
+        if isinstance(response, dict) and 'data' in response:
+            models = [m.get('id') for m in response['data'] if m.get('id')]
+        else: raise ValueError(f"Unexpected response format from OpenAI /models: {str(response)[:200]}")
+
+    elif backend == 'google':
+        api_endpoint = "https://generativelanguage.googleapis.com/v1beta/models"
+        api_key = config.GOOGLE_API_KEY
+        if not api_key: raise ValueError("Google API Key not configured on backend")
+        api_endpoint += f"?key={api_key}"
+        response = make_request_with_retry(api_endpoint, "GET")
+        if isinstance(response, dict) and 'models' in response:
+            models = [m.get('name').replace("models/", "") for m in response['models']
+                      if m.get('name') and 'generateContent' in m.get('supportedGenerationMethods', [])]
+        else: raise ValueError(f"Unexpected response format from Google /models: {str(response)[:200]}")
+
+    elif backend == 'anthropic':
+        logging.warning("Anthropic does not have a standard /models endpoint. Returning empty list.")
+        models = []
+
+    elif backend == 'xai':
+        logging.warning("Attempting to fetch xAI models assuming OpenAI format.")
+        api_endpoint = "https://api.x.ai/v1/models"
+        api_key = config.XAI_API_KEY
+        if not api_key: raise ValueError("xAI API Key not configured on backend")
+        headers['Authorization'] = f'Bearer {api_key}'
+        response = make_request_with_retry(api_endpoint, "GET", headers=headers)
+        if isinstance(response, dict) and 'data' in response:
+            models = [m.get('id') for m in response['data'] if m.get('id')]
+        else: raise ValueError(f"Unexpected response format from xAI /models: {str(response)[:200]}")
+
+    else:
+        raise ValueError(f'Unsupported backend: {backend}')
+
+    models = sorted([str(m) for m in models if m])
+    logging.info(f"Successfully fetched {len(models)} models for backend {backend}.")
+    return models
+
 @models_bp.route('/external-models', methods=['GET'])
 def get_external_models():
-    """Fetches model list from selected external provider."""
+    """Lists models of the selected external provider (served from the model catalog cache; ?refresh=true refetches)."""
     backend = request.args.get('backend')
     if not backend:
         return jsonify({'status': 'error', 'message': 'Backend parameter is required'}), 400
 
-    logging.info(f"Request received to fetch models for external backend: {backend}")
-
-    api_endpoint = None
-    api_key = None
-    headers = {'Accept': 'application/json'}
-    models = []
-    error_message = None
+    if backend in LOCAL_MODEL_BACKENDS:
+        logging.info(f"Backend {backend} does not support dynamic model fetching via this endpoint.")
+        return jsonify({'status': 'success', 'models': []})
+    if backend not in EXTERNAL_MODEL_BACKENDS:
+        return jsonify({'status': 'error', 'message': f'Unsupported backend: {backend}'}), 400
 
     try:
-        if backend == 'groq':
-            api_endpoint = "https://api.groq.com/openai/v1/models"
-            api_key = config.GROQ_API_KEY
-            if not api_key: raise ValueError("Groq API Key not configured on backend")
-            headers['Authorization'] = f'Bearer {api_key}'
-            response = make_request_with_retry(api_endpoint, "GET", headers=headers)
-            if isinstance(response, dict) and 'data' in response:
-                models = [m.get('id') for m in response['data'] if m.get('id')]
-            else: raise ValueError(f"Unexpected response format from Groq /models: {str(response)[:200]}")
-
-        elif backend == 'openai':
-            api_endpoint = "https://api.openai.com/v1/models"
-            api_key = config.OPENAI_API_KEY
-            if not api_key: raise ValueError("OpenAI API Key not configured on backend")
-            headers['Authorization'] = f'Bearer {api_key}'
-            response = make_request_with_retry(api_endpoint, "GET", headers=headers)
-            if isinstance(response, dict) and 'data' in response:
-                models = [m.get('id') for m in response['data'] if m.get('id')]
-            else: raise ValueError(f"Unexpected response format from OpenAI /models: {str(response)[:200]}")
-
-        elif backend == 'google':
-            api_endpoint = "https://generativelanguage.googleapis.com/v1beta/models"
-            api_key = config.GOOGLE_API_KEY
-            if not api_key: raise ValueError("Google API Key not configured on backend")
-            api_endpoint += f"?key={api_key}"
-            response = make_request_with_retry(api_endpoint, "GET")
-            if isinstance(response, dict) and 'models' in response:
-                models = [m.get('name').replace("models/", "") for m in response['models']
-                          if m.get('name') and 'generateContent' in m.get('supportedGenerationMethods', [])]
-            else: raise ValueError(f"Unexpected response format from Google /models: {str(response)[:200]}")
-
-        elif backend == 'anthropic':
-            logging.warning("Anthropic does not have a standard /models endpoint. Returning empty list.")
-            models = []
-
-        elif backend == 'xai':
-            logging.warning("Attempting to fetch xAI models assuming OpenAI format.")
-            try:
-                api_endpoint = "https://api.x.ai/v1/models"
-                api_key = config.XAI_API_KEY
-                if not api_key: raise ValueError("xAI API Key not configured on backend")
-                headers['Authorization'] = f'Bearer {api_key}'
-                response = make_request_with_retry(api_endpoint, "GET", headers=headers)
-                if isinstance(response, dict) and 'data' in response:
-                    models = [m.get('id') for m in response['data'] if m.get('id')]
-                else: raise ValueError(f"Unexpected response format from xAI /models: {str(response)[:200]}")
-            except Exception as e_xai:
-                 logging.error(f"Failed to fetch models for xAI: {e_xai}")
-                 error_message = f"Could not fetch models for xAI. Error: {e_xai}"
-                 models = [] # Fallback on error
-
-        elif backend in ['kobold', 'ollama', 'custom_external']:
-             logging.info(f"Backend {backend} does not support dynamic model fetching via this endpoint.")
-             return jsonify({'status': 'success', 'models': []})
-
-        else:
-            return jsonify({'status': 'error', 'message': f'Unsupported backend: {backend}'}), 400
-
-        models = sorted([str(m) for m in models if m])
-        logging.info(f"Successfully fetched {len(models)} models for backend {backend}.")
-        return jsonify({'status': 'success', 'models': models})
+        try:
+            models, cache_status = model_catalog.get_models(backend, lambda: fetch_external_models(backend), force_refresh=_wants_refresh())
+        except Exception as e_xai:
+            if backend != 'xai':
+                raise
+            logging.error(f"Failed to fetch models for xAI: {e_xai}")
+            return jsonify({'status': 'success', 'models': []}) # Fallback on error
+        response = jsonify({'status': 'success', 'models': models})
+        response.headers['X-Cache'] = cache_status
+        return response
 
     except ValueError as ve:
         error_message = str(ve)
@@ -122,5 +160,84 @@ def get_external_models():
         return jsonify({'status': 'error', 'message': error_message}), 502
     except Exception as e:
         logging.exception(f"Unexpected error fetching models for {backend}:")
-        error_message = error_message or f"An unexpected error occurred: {e}"
-        return jsonify({'status': 'error', 'message': error_message}), 500
\ No newline at end of file
+        return jsonify({'status': 'error', 'message': f"An unexpected error occurred: {e}"}), 500
+
+
+# Providers /api/models/all queries, with the config key that has to be set for each
+DISCOVERY_PROVIDER_KEYS = {
+    'groq': 'GROQ_API_KEY',
+    'openai': 'OPENAI_API_KEY',
+    'google': 'GOOGLE_API_KEY',
+    'anthropic': 'ANTHROPIC_API_KEY',
+    'xai': 'XAI_API_KEY',
+}
+
+def _fetch_provider_models(provider, force_refresh):
+    """Runs one provider's lookup through the model catalog; returns its NDJSON record."""
+    start_time = time.monotonic()
+    record = {'provider': provider}
+    try:
+        if provider == 'ollama':
+            models, cache_status = model_catalog.get_models('ollama', fetch_ollama_models, force_refresh=force_refresh)
+        else:
+            models, cache_status = model_catalog.get_models(provider, lambda: fetch_external_models(provider), force_refresh=force_refresh)
+        record.update({'status': 'success', 'models': models, 'cache': cache_status})
+    except requests.RequestException as e:
+        logging.error(f"Model discovery: failed to reach {provider}: {e}")
+        record.update({'status': 'error', 'message': f"Failed to connect to {provider} API: {e}"})
+    except Exception as e: # ValueError for configuration/format problems
+        logging.error(f"Model discovery: error fetching models for {provider}: {e}")
+        record.update({'status': 'error', 'message': str(e)})
+    record['elapsed_ms'] = round((time.monotonic() - start_time) * 1000, 1)
+    return record
+
+@models_bp.route('/models/all', methods=['GET'])
+def get_all_models():
+    """Lists models of Ollama and every configured provider, queried in parallel, streaming NDJSON as each finishes.
+
+    ?providers=a,b limits the lookup; ?refresh=true bypasses the catalog cache.
+    Each line is one provider's result; providers still running after
+    MODEL_DISCOVERY_TIMEOUT are reported as timed out. The last line is a
+    summary with "done": true and the failed providers.
+    """
+    requested = request.args.get('providers')
+    if requested:
+        providers = [p.strip() for p in requested.split(',') if p.strip()]
+        unsupported = [p for p in providers if p != 'ollama' and p not in DISCOVERY_PROVIDER_KEYS]
+        if unsupported:
+            return jsonify({'status': 'error', 'message': f"Unsupported provider(s): {', '.join(unsupported)}"}), 400
+    else:
+        providers = ['ollama'] + [p for p, key in DISCOVERY_PROVIDER_KEYS.items() if getattr(config, key, None)]
+    if not providers:
+        return jsonify({'status': 'error', 'message': 'No providers to query.'}), 400
+    force_refresh = _wants_refresh()
+
+    logging.info(f"HTTP Route: /models/all - providers={','.join(providers)}")
+
+    def generate_results():
+        start_time = time.monotonic()
+        failed = []
+        # Not a with-block: timed-out lookups keep running and still fill the catalog for the next request
+        executor = ThreadPoolExecutor(max_workers=len(providers), thread_name_prefix="model-discovery")
+        futures = {executor.submit(_fetch_provider_models, provider, force_refresh): provider for provider in providers}
+        pending = set(futures)
+        try:
+            for future in as_completed(futures, timeout=config.MODEL_DISCOVERY_TIMEOUT):
+                pending.discard(future)
+                record = future.result()
+                if record['status'] != 'success':
+                    failed.append(record['provider'])
+                yield json.dumps(record) + "\n"
+        except FuturesTimeoutError:
+            for future in pending:
+                provider = futures[future]
+                logging.warning(f"Model discovery: {provider} did not answer within {config.MODEL_DISCOVERY_TIMEOUT}s.")
+                failed.append(provider)
+                yield json.dumps({'provider': provider, 'status': 'error', 'message': f'Timed out after {config.MODEL_DISCOVERY_TIMEOUT}s',
+                                  'elapsed_ms': round((time.monotonic() - start_time) * 1000, 1)}) + "\n"
+        finally:
+            executor.shutdown(wait=False)
+        yield json.dumps({'done': True, 'total': len(providers), 'succeeded': len(providers) - len(failed), 'failed': failed,
+                          'elapsed_ms': round((time.monotonic() - start_time) * 1000, 1)}) + "\n"
+
+    return Response(generate_results(), mimetype='application/x-ndjson')
@@ -2,6 +2,7 @@ from flask import Blueprint, request, jsonify
 import logging
 import json
 import config # Import config module directly
+from services import model_catalog, http_pool
 
 settings_bp = Blueprint('settings', __name__, url_prefix='/api')
 
@@ -31,9 +32,12 @@ def update_endpoints():
 
         if updated_keys:
             logging.info(f"Backend API settings updated for keys: {', '.join(updated_keys)}")
+            model_catalog.invalidate_for_settings(updated_keys) # Cached model lists may belong to the old URL/key
+            if set(updated_keys) & {'ollama', 'kobold', 'comfyui', 'customApiEndpoint'}:
+                http_pool.close_all_sessions() # Pools are sized by the backend a host maps to, which may have changed
             # Log current config (optional)
             logged_config = {k: (v if 'key' not in k.lower() else bool(v)) for k, v in vars(config).items() if k.isupper()}
-            logging.debug(f"Current config state (masked keys): {json.dumps(logged_config)}")
+            logging.debug(f"Current config state (masked keys): {json.dumps(logged_config, default=str)}")
             return jsonify({'status': 'success', 'message': f'Backend API setting(s) updated.'})
         else:
             logging.warning(f"Received update-endpoints request with no valid keys: {data}")
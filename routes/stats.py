@@ -0,0 +1,57 @@
+from flask import Blueprint, jsonify
+import logging
+from services.http_pool import get_pool_stats
+from services.response_cache import get_cache_stats
+from services.llm_router import get_router_stats
+from services.single_flight import get_single_flight_stats
+from services.scheduler import get_scheduler_stats
+from services.retry_policy import get_retry_stats
+from services.hedging import get_hedging_stats
+from services.cancellation import get_cancellation_stats
+from services.ollama_residency import get_residency_state
+from services.conversation_state import get_conversation_state_stats
+from services.model_catalog import get_catalog_stats
+from services.chat_search import get_search_stats
+from services.blob_store import get_blob_stats
+from services.history_manager import get_chat_cache_stats
+
+stats_bp = Blueprint('stats', __name__, url_prefix='/api')
+
+# Each section maps to a zero-argument function returning JSON-serializable stats
+STATS_SECTIONS = {
+    'http-pool': get_pool_stats,
+    'response-cache': get_cache_stats,
+    'router': get_router_stats,
+    'single-flight': get_single_flight_stats,
+    'scheduler': get_scheduler_stats,
+    'retries': get_retry_stats,
+    'hedging': get_hedging_stats,
+    'cancellation': get_cancellation_stats,
+    'ollama-residency': get_residency_state,
+    'conversation-state': get_conversation_state_stats,
+    'model-catalog': get_catalog_stats,
+    'chat-search': get_search_stats,
+    'blobs': get_blob_stats,
+    'chat-cache': get_chat_cache_stats,
+}
+
+@stats_bp.route('/stats', methods=['GET'])
+def get_all_stats():
+    """Returns runtime statistics for every registered component."""
+    try:
+        return jsonify({'status': 'success', 'stats': {name: fn() for name, fn in STATS_SECTIONS.items()}})
+    except Exception as e:
+        logging.exception("Unexpected error collecting stats:")
+        return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
+
+@stats_bp.route('/stats/<section>', methods=['GET'])
+def get_stats_section(section):
+    """Returns runtime statistics for a single component."""
+    stats_fn = STATS_SECTIONS.get(section)
+    if stats_fn is None:
+        return jsonify({'status': 'error', 'message': f'Unknown stats section: {section}'}), 404
+    try:
+        return jsonify({'status': 'success', 'stats': stats_fn()})
+    except Exception as e:
+        logging.exception(f"Unexpected error collecting stats for {section}:")
+        return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
@@ -0,0 +1,251 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+import json
+import aiohttp
+import requests
+import config # Import config variables
+from services.llm_backends import build_backend_request, fit_backend_history, parse_backend_response, get_adapter
+from services.stream_parsers import StreamDecoder
+from services import cancellation, conversation_state
+from services.retry_policy import RequestCancelled, record_attempt, try_spend_retry, record_rate_limited, \
+                                  parse_retry_after, compute_backoff
+
+# One background event loop multiplexes every in-flight generation.
+# Flask routes and socket handlers reach it through the sync bridge functions below.
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+_client_session = None # aiohttp.ClientSession, only touched from the loop thread
+
+_STREAM_END = object() # Sentinel pushed onto bridge queues when a stream finishes
+_STREAM_COMPLETE = object() # Pushed before _STREAM_END when the backend signalled a complete reply
+
+def get_event_loop():
+    """Returns the shared background event loop, starting it on first use."""
+    global _loop, _loop_thread
+    if _loop is not None:
+        return _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=loop.run_forever, name="async-llm-loop", daemon=True)
+            _loop_thread.start()
+            _loop = loop
+            logging.info("Started asyncio LLM engine event loop.")
+    return _loop
+
+async def _get_client_session():
+    global _client_session
+    if _client_session is None or _client_session.closed:
+        connector = aiohttp.TCPConnector(limit=config.ASYNC_LLM_MAX_CONNECTIONS,
+                                         limit_per_host=config.ASYNC_LLM_MAX_CONNECTIONS_PER_HOST,
+                                         keepalive_timeout=60)
+        _client_session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar()) # Shared by all users: no cookies
+    return _client_session
+
+def _request_headers(headers, stream):
+    request_headers = {'Content-Type': 'application/json; charset=utf-8', 'Accept': 'application/json'}
+    request_headers.update(headers or {})
+    if stream:
+        request_headers['Accept'] = 'text/event-stream'
+    return request_headers
+
+async def _wait_before_retry(url, delay, cancel_event):
+    """asyncio counterpart of retry_policy.wait_before_retry; polls the (threading) cancel_event."""
+    deadline = time.monotonic() + delay
+    while True:
+        if cancel_event is not None and cancel_event.is_set():
+            raise RequestCancelled(f"Request to {url} cancelled during retry backoff.")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(remaining, 0.1) if cancel_event is not None else remaining)
+
+async def _post_with_retry(url, payload, headers, stream, timeout, retries, cancel_event=None):
+    """POSTs with retries on timeouts, connection errors, 5xx and 429 (mirrors make_request_with_retry)."""
+    session = await _get_client_session()
+    client_timeout = aiohttp.ClientTimeout(total=None if stream else timeout, sock_read=timeout)
+    last_exception = None
+    record_attempt(url)
+    for i in range(retries):
+        retry_after = None
+        try:
+            response = await session.post(url, json=payload, headers=_request_headers(headers, stream), timeout=client_timeout)
+            if response.status >= 400:
+                body = await response.text()
+                response.release()
+                last_exception = aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                                             message=f"{response.reason} | Response Body: {body[:500]}")
+                logging.warning(f"Attempt {i+1}/{retries} for POST {url} failed: HTTP {response.status}")
+                retry_after = parse_retry_after(response.headers)
+                if response.status == 429:
+                    record_rate_limited(url)
+                    if retry_after is not None and retry_after > config.RETRY_MAX_DELAY:
+                        break
+                elif response.status < 500:
+                    break # Don't retry other client errors (4xx)
+            else:
+                return response
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logging.warning(f"Attempt {i+1}/{retries} for POST {url} failed: {e!r}")
+            last_exception = e
+        if i < retries - 1:
+            if not try_spend_retry(url):
+                logging.warning(f"Retry budget exhausted; not retrying POST {url}")
+                break
+            await _wait_before_retry(url, compute_backoff(i, 1, retry_after), cancel_event)
+    logging.error(f"Request failed after {i+1} attempt(s): POST {url}")
+    raise last_exception or aiohttp.ClientError(f"Request failed after {retries} attempts.")
+
+# --- Async Backend Calls ---
+async def acall_llm_backend(prompt, history, backend, model, cancel_event=None):
+    """Async equivalent of call_llm_backend (same return conventions)."""
+    logging.info(f"Async LLM Call: backend={backend}, model={model}, prompt='{prompt[:50]}...'")
+    try:
+        try:
+            history = fit_backend_history(prompt, history, backend, model) # begin_turn must key the same window
+            api_endpoint, headers, payload = build_backend_request(prompt, history, backend, model, fitted=True)
+        except ValueError as e:
+            return f"[Error: {e}]"
+
+        turn = conversation_state.begin_turn(backend, model, prompt, history, payload)
+        response = await _post_with_retry(api_endpoint, payload, headers, stream=False, timeout=180, retries=3, cancel_event=cancel_event)
+        async with response:
+            body = await response.text()
+        try:
+            result = json.loads(body) if body else {}
+        except json.JSONDecodeError:
+            result = body
+
+        response_text = parse_backend_response(result, backend)
+        if response_text is not None:
+            logging.info(f"{backend} async call successful.")
+            if turn:
+                turn.finish(result, response_text.strip())
+            return response_text.strip()
+        logging.error(f"Unexpected/Unparsed API response structure from {backend}: {result}")
+        return f"[Error parsing response from {backend}]"
+
+    except (asyncio.TimeoutError, aiohttp.ClientError, RequestCancelled) as e:
+        error_msg = f"Error connecting to {backend} API: {e}"
+        logging.error(error_msg)
+        return f"[{error_msg}]"
+    except Exception as e:
+        logging.error(f"Error calling {backend} API: {e}", exc_info=True)
+        return f"[Error during {backend} API call: {e}]"
+
+async def astream_llm_backend(prompt, history, backend, model, cancel_event=None, on_complete=None):
+    """Async generator of text chunks; async equivalent of stream_llm_backend."""
+    logging.info(f"Async LLM Stream: backend={backend}, model={model}, prompt='{prompt[:50]}...'")
+    history = fit_backend_history(prompt, history, backend, model) # begin_turn must key the same window
+    api_endpoint, headers, payload = build_backend_request(prompt, history, backend, model, stream=True, fitted=True)
+    response = await _post_with_retry(api_endpoint, payload, headers, stream=True, timeout=300, retries=1, cancel_event=cancel_event)
+    parse_line = get_adapter(backend).parse_stream_line
+    turn = conversation_state.begin_turn(backend, model, prompt, history, payload)
+    if turn:
+        parse_line = turn.wrap_parse_line(parse_line)
+    decoder = StreamDecoder(backend, parse_line)
+    async with response:
+        async for chunk in response.content.iter_any(): # Whatever bytes have arrived, no per-line awaits
+            for token in decoder.feed(chunk):
+                yield token
+            if decoder.done:
+                break
+        else:
+            for token in decoder.flush():
+                yield token
+    if decoder.done:
+        if turn:
+            turn.finish()
+        if on_complete:
+            on_complete()
+
+# --- Sync Bridge (for Flask routes and SocketIO handlers) ---
+class AsyncStreamController:
+    """Cancellation handle for a bridged stream; close() aborts the upstream task."""
+    def __init__(self, future):
+        self._future = future
+
+    def close(self):
+        self._future.cancel()
+
+def call_llm_backend_sync(prompt, history, backend, model, cancel_event=None):
+    """Runs acall_llm_backend on the shared loop and blocks for the result.
+
+    A cancellation.CancelHandle cancels the task on the loop, which closes the
+    upstream connection and returns immediately with an error string.
+    """
+    future = asyncio.run_coroutine_threadsafe(acall_llm_backend(prompt, history, backend, model, cancel_event=cancel_event), get_event_loop())
+    token = cancel_event.add_callback(lambda: cancellation.cancel_future(future)) if cancellation.supports_abort(cancel_event) else None
+    try:
+        return future.result()
+    except concurrent.futures.CancelledError:
+        cancellation.record_released(cancel_event)
+        logging.info(f"Async {backend} call cancelled while in flight.")
+        return f"[Error connecting to {backend} API: request cancelled]"
+    finally:
+        if token is not None:
+            cancel_event.remove_callback(token)
+
+def stream_llm_backend_sync(prompt, history, backend, model, on_connect=None, cancel_event=None, on_complete=None):
+    """Bridges astream_llm_backend into a plain generator of text chunks.
+
+    Matches stream_llm_backend: on_connect receives a controller whose close()
+    cancels the upstream stream, and returning False from it aborts, and
+    on_complete() is called as in stream_llm_backend.
+    """
+    chunk_queue = queue.Queue()
+
+    async def pump():
+        try:
+            async for token in astream_llm_backend(prompt, history, backend, model, cancel_event=cancel_event,
+                                                   on_complete=lambda: chunk_queue.put(_STREAM_COMPLETE)):
+                chunk_queue.put(token)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            chunk_queue.put(e)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+    # Not pump's finally: a future cancelled before the coroutine starts never runs it
+    future.add_done_callback(lambda _: chunk_queue.put(_STREAM_END))
+    controller = AsyncStreamController(future)
+    token = cancel_event.add_callback(lambda: cancellation.cancel_future(future)) if cancellation.supports_abort(cancel_event) else None
+    try:
+        if on_connect and on_connect(controller) is False:
+            return
+        while True:
+            item = chunk_queue.get()
+            if item is _STREAM_END:
+                break
+            if item is _STREAM_COMPLETE: # Called here, after the tokens before it were yielded
+                if on_complete:
+                    on_complete()
+                continue
+            if isinstance(item, (aiohttp.ClientError, asyncio.TimeoutError)):
+                # Surface connection failures the same way the requests-based engine does
+                raise requests.exceptions.ConnectionError(str(item) or repr(item)) from item
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        controller.close()
+        if token is not None:
+            cancel_event.remove_callback(token)
+
+def shutdown():
+    """Closes the shared client session and stops the event loop."""
+    global _loop, _client_session
+    if _loop is None:
+        return
+    async def close_session():
+        if _client_session is not None and not _client_session.closed:
+            await _client_session.close()
+    asyncio.run_coroutine_threadsafe(close_session(), _loop).result(timeout=10)
+    _loop.call_soon_threadsafe(_loop.stop)
+    _client_session = None
+    _loop = None
@@ -0,0 +1,214 @@
+import os
+import re
+import time
+import base64
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+import config # Import config variables
+
+# Content-addressed image store. An image is saved once under BLOB_DIR as
+# <sha256[:2]>/<sha256> and chat histories reference it by URL,
+# /api/blobs/<sha256>, so the same image in several chats (or saved again with
+# every chat save) is stored and sent once. The history manager turns inline
+# data: URL images into blobs on save and keeps a (chat_id, digest) row per
+# reference in BLOB_DIR/blobs.db; a blob's refcount is its number of rows.
+# References are added before a chat is written and dropped after, so a crash
+# in between can only leave an extra reference, never lose a referenced blob.
+# The GC pass deletes blobs without references once they are older than
+# BLOB_GC_GRACE_SECONDS, which covers uploads whose chat hasn't been saved yet.
+URL_PREFIX = "/api/blobs/"
+_URL_RE = re.compile(r"^/api/blobs/([0-9a-f]{64})$")
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+_DATA_URL_RE = re.compile(r"^data:([\w.+-]+/[\w.+-]+);base64,(.*)$", re.DOTALL)
+# Served inline from our origin, so only raster image types (SVG can carry scripts)
+ALLOWED_CONTENT_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/avif', 'image/bmp'}
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = set()
+_gc_thread = None
+_gc_stop = threading.Event()
+_blob_stats = {'stored': 0, 'deduplicated': 0, 'gc_runs': 0, 'gc_removed': 0, 'gc_bytes_freed': 0}
+_stats_lock = threading.Lock()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    content_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    stored_at REAL NOT NULL -- Last put; the GC grace period counts from here
+);
+CREATE TABLE IF NOT EXISTS blob_refs (
+    chat_id TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (chat_id, digest)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS blob_refs_digest ON blob_refs (digest);
+"""
+
+def _connect():
+    db_path = os.path.join(config.BLOB_DIR, "blobs.db")
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'path', None) == db_path:
+        return conn
+    if conn is not None:
+        conn.close()
+    os.makedirs(config.BLOB_DIR, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    with _schema_lock:
+        if db_path not in _schema_ready:
+            conn.executescript(_SCHEMA)
+            _schema_ready.add(db_path)
+    _local.conn, _local.path = conn, db_path
+    return conn
+
+@contextmanager
+def _transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def _count(counter, amount=1):
+    with _stats_lock:
+        _blob_stats[counter] += amount
+
+def blob_path(digest):
+    return os.path.join(config.BLOB_DIR, digest[:2], digest)
+
+def blob_url(digest):
+    return URL_PREFIX + digest
+
+def digest_from_url(url):
+    """The digest of a blob URL, or None for anything else."""
+    match = _URL_RE.match(url) if isinstance(url, str) else None
+    return match.group(1) if match else None
+
+def is_digest(value):
+    return bool(_DIGEST_RE.match(value))
+
+def put(data, content_type):
+    """Stores bytes (once per distinct content) and returns their digest.
+    Raises ValueError for disallowed content types or oversized data."""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type not in ALLOWED_CONTENT_TYPES:
+        raise ValueError(f"Unsupported blob content type: {content_type or 'none'}")
+    if len(data) > config.BLOB_MAX_BYTES:
+        raise ValueError(f"Blob too large ({len(data)} bytes; limit is {config.BLOB_MAX_BYTES}).")
+    digest = hashlib.sha256(data).hexdigest()
+    # Refresh stored_at before looking for the file: a GC pass either ran before this
+    # (and the file is rewritten below) or sees a fresh blob and leaves it alone
+    _connect().execute("""INSERT INTO blobs (digest, content_type, size, stored_at) VALUES (?, ?, ?, ?)
+                          ON CONFLICT (digest) DO UPDATE SET stored_at = excluded.stored_at""",
+                       (digest, content_type, len(data), time.time()))
+    path = blob_path(digest)
+    if os.path.exists(path):
+        _count('deduplicated')
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        _count('stored')
+    return digest
+
+def get_info(digest):
+    """Returns (path, content_type, size) of a stored blob, or None."""
+    row = _connect().execute("SELECT content_type, size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+    if row is None or not os.path.exists(blob_path(digest)):
+        return None
+    return blob_path(digest), row[0], row[1]
+
+def externalize_images(images):
+    """Returns images with inline data: URL images replaced by blob URLs (other entries unchanged)."""
+    result = []
+    for image in images:
+        match = _DATA_URL_RE.match(image) if isinstance(image, str) else None
+        if match and match.group(1).lower() in ALLOWED_CONTENT_TYPES:
+            try:
+                image = blob_url(put(base64.b64decode(match.group(2), validate=True), match.group(1)))
+            except (ValueError, OSError) as e: # Keep the inline image rather than lose it
+                logging.warning(f"Could not move an inline image into the blob store: {e}")
+        result.append(image)
+    return result
+
+def _digests(images):
+    return {digest for digest in map(digest_from_url, images) if digest}
+
+def add_refs(chat_id, images):
+    """Records that chat_id references the blobs among images."""
+    digests = _digests(images)
+    if digests:
+        _connect().executemany("INSERT OR IGNORE INTO blob_refs (chat_id, digest) VALUES (?, ?)",
+                               ((chat_id, digest) for digest in digests))
+
+def retain_refs(chat_id, images):
+    """Drops chat_id's references to blobs that are no longer among images (its full list)."""
+    digests = _digests(images)
+    conn = _connect()
+    with _transaction(conn):
+        stored = {row[0] for row in conn.execute("SELECT digest FROM blob_refs WHERE chat_id = ?", (chat_id,))}
+        conn.executemany("DELETE FROM blob_refs WHERE chat_id = ? AND digest = ?", ((chat_id, digest) for digest in stored - digests))
+
+def gc(grace_seconds=None):
+    """Deletes blobs no chat references that were stored more than grace_seconds ago.
+    Returns (blobs removed, bytes freed)."""
+    grace_seconds = config.BLOB_GC_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    conn = _connect()
+    removed = freed = 0
+    with _transaction(conn): # Holds the write lock, so no reference can be added mid-sweep
+        unreferenced = conn.execute("""SELECT digest, size FROM blobs WHERE stored_at < ?
+                                       AND NOT EXISTS (SELECT 1 FROM blob_refs WHERE blob_refs.digest = blobs.digest)""",
+                                    (time.time() - grace_seconds,)).fetchall()
+        for digest, size in unreferenced:
+            try:
+                os.remove(blob_path(digest))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning(f"Could not delete blob {digest}: {e}")
+                continue
+            conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            removed += 1
+            freed += size
+    _count('gc_runs')
+    _count('gc_removed', removed)
+    _count('gc_bytes_freed', freed)
+    if removed:
+        logging.info(f"Blob GC removed {removed} unreferenced blob(s), {freed} bytes.")
+    return removed, freed
+
+def _run_gc():
+    while not _gc_stop.wait(config.BLOB_GC_INTERVAL):
+        try:
+            gc()
+        except (OSError, sqlite3.Error) as e:
+            logging.error(f"Blob GC failed: {e}")
+
+def start_gc():
+    """Starts the periodic blob GC (no-op if already running)."""
+    global _gc_thread
+    if _gc_thread is not None and _gc_thread.is_alive():
+        return
+    _gc_stop.clear()
+    _gc_thread = threading.Thread(target=_run_gc, name="blob-gc", daemon=True)
+    _gc_thread.start()
+
+def stop_gc():
+    _gc_stop.set()
+
+def get_blob_stats():
+    with _stats_lock:
+        stats = dict(_blob_stats)
+    conn = _connect()
+    stats['blobs'], stats['bytes'] = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+    stats['references'] = conn.execute("SELECT COUNT(*) FROM blob_refs").fetchone()[0]
+    return stats
@@ -0,0 +1,122 @@
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+
+# Cancellation handles for upstream calls. A CancelHandle is a drop-in for the
+# threading.Event tasks already register in state["active_tasks"], but setting it
+# also runs abort callbacks: shutting down the socket of an in-flight request
+# (see http_pool) or cancelling an asyncio engine future. So /api/cancel frees
+# the worker thread and the backend's GPU/quota instead of waiting for a reply.
+_local = threading.local() # Handle bound to the current thread's request, see bind()
+_stats_lock = threading.Lock()
+_cancel_stats = {'handles': 0, 'cancelled': 0, 'connections_aborted': 0, 'futures_cancelled': 0,
+                 'calls_released': 0, 'release_latency_total': 0.0, 'release_latency_max': 0.0}
+
+def _count(counter, amount=1):
+    with _stats_lock:
+        _cancel_stats[counter] += amount
+
+class CancelHandle:
+    """threading.Event-compatible flag whose set() also aborts registered in-flight work."""
+    def __init__(self, label=None):
+        self.label = label
+        self.cancelled_at = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._next_token = 0
+        _count('handles')
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def set(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.cancelled_at = time.monotonic()
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        _count('cancelled')
+        logging.info(f"Cancelling {self.label or 'task'}: aborting {len(callbacks)} in-flight call(s).")
+        for callback in callbacks:
+            _run_callback(callback)
+
+    def add_callback(self, callback):
+        """Registers callback() to run on cancellation (immediately if already cancelled). Returns a removal token."""
+        with self._lock:
+            if not self._event.is_set():
+                self._next_token += 1
+                self._callbacks[self._next_token] = callback
+                return self._next_token
+        _run_callback(callback)
+        return None
+
+    def remove_callback(self, token):
+        if token is not None:
+            with self._lock:
+                self._callbacks.pop(token, None)
+
+def _run_callback(callback):
+    try:
+        callback()
+    except Exception as e:
+        logging.warning(f"Error running cancellation callback: {e}")
+
+def supports_abort(cancel_event):
+    """True for handles that can abort in-flight calls (plain Events only stop retries)."""
+    return hasattr(cancel_event, 'add_callback')
+
+@contextmanager
+def bind(handle):
+    """Binds a CancelHandle to the upstream connections this thread checks out inside the block."""
+    previous = getattr(_local, 'handle', None)
+    _local.handle = handle if supports_abort(handle) else None
+    try:
+        yield
+    finally:
+        _local.handle = previous
+
+def current_handle():
+    return getattr(_local, 'handle', None)
+
+def abort_connection(conn):
+    """Shuts down a urllib3 connection's socket, waking any thread blocked reading from it."""
+    sock = getattr(conn, 'sock', None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+        _count('connections_aborted')
+    except OSError:
+        pass # Already closed
+
+def cancel_future(future):
+    if future.cancel():
+        _count('futures_cancelled')
+
+def record_released(handle):
+    """Records that a cancelled call gave back its thread/slot (latency from set() to return)."""
+    if getattr(handle, 'cancelled_at', None) is None: # Not cancelled, or a plain Event
+        return
+    latency = time.monotonic() - handle.cancelled_at
+    with _stats_lock:
+        _cancel_stats['calls_released'] += 1
+        _cancel_stats['release_latency_total'] += latency
+        _cancel_stats['release_latency_max'] = max(_cancel_stats['release_latency_max'], latency)
+
+def get_cancellation_stats():
+    with _stats_lock:
+        stats = dict(_cancel_stats)
+    released = stats.pop('calls_released')
+    total = stats.pop('release_latency_total')
+    stats['calls_released'] = released
+    stats['avg_release_latency_ms'] = round(total / released * 1000, 1) if released else None
+    stats['max_release_latency_ms'] = round(stats.pop('release_latency_max') * 1000, 1)
+    return stats
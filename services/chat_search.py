@@ -0,0 +1,280 @@
+import os
+import re
+import bisect
+import sqlite3
+import hashlib
+import logging
+import threading
+import config # Import config variables
+from services.history_index import chat_name, display_name
+
+# Full-text search over chat messages: an SQLite FTS5 inverted index in its own
+# database (HISTORY_SEARCH_DB_PATH), used with either history store. The history
+# manager keeps it current from its save path: appended messages are inserted,
+# and a full save re-indexes only from the first message whose digest changed
+# (the same prefix diff the SQLite store uses). At startup a background sync
+# indexes chats whose message count differs from the index and drops deleted
+# ones, which also builds the index from scratch the first time.
+#
+# Results are chats ranked by their best-matching message (bm25), with a
+# snippet of that message. Only the newest SEARCH_MAX_CANDIDATES matching
+# messages are ranked, which bounds the cost of very common terms.
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = set()
+_sync_thread = None
+_search_stats = {'queries': 0, 'indexed_messages': 0, 'reindexed_chats': 0, 'index_errors': 0, 'syncing': False}
+_stats_lock = threading.Lock()
+_SNIPPET_WORDS = 16
+
+_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+    content, chat_id UNINDEXED, seq UNINDEXED, role UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+);
+CREATE TABLE IF NOT EXISTS search_messages ( -- Which FTS row holds each message, and what it contained
+    chat_id TEXT NOT NULL,
+    seq INTEGER NOT NULL, -- Oldest message first
+    digest TEXT NOT NULL,
+    fts_rowid INTEGER, -- NULL for messages without text
+    PRIMARY KEY (chat_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS search_chats (
+    chat_id TEXT PRIMARY KEY,
+    name TEXT,
+    message_count INTEGER NOT NULL
+);
+"""
+
+def _connect():
+    db_path = config.HISTORY_SEARCH_DB_PATH
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'path', None) == db_path:
+        return conn
+    if conn is not None:
+        conn.close()
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL") # The index can always be rebuilt from the history store
+    with _schema_lock:
+        if db_path not in _schema_ready:
+            conn.executescript(_SCHEMA)
+            _schema_ready.add(db_path)
+    _local.conn, _local.path = conn, db_path
+    return conn
+
+def _count(counter, amount=1):
+    with _stats_lock:
+        _search_stats[counter] += amount
+
+def _message_fields(message):
+    if not isinstance(message, dict):
+        return None, ''
+    content = message.get('content')
+    return message.get('role'), content if isinstance(content, str) else ''
+
+def _digest(role, content):
+    return hashlib.blake2b(f"{role}\0{content}".encode('utf-8'), digest_size=8).hexdigest()
+
+def _insert_messages(conn, chat_id, first_seq, messages):
+    """Caller holds a transaction. Indexes messages (oldest first) from seq first_seq on."""
+    for offset, message in enumerate(messages):
+        role, content = _message_fields(message)
+        fts_rowid = None
+        if content.strip():
+            fts_rowid = conn.execute("INSERT INTO message_fts (content, chat_id, seq, role) VALUES (?, ?, ?, ?)",
+                                     (content, chat_id, first_seq + offset, role)).lastrowid
+        conn.execute("INSERT INTO search_messages (chat_id, seq, digest, fts_rowid) VALUES (?, ?, ?, ?)",
+                     (chat_id, first_seq + offset, _digest(role, content), fts_rowid))
+    _count('indexed_messages', len(messages))
+
+def _delete_from(conn, chat_id, first_seq):
+    """Caller holds a transaction. Drops the chat's indexed messages from seq first_seq on."""
+    conn.execute("""DELETE FROM message_fts WHERE rowid IN
+                    (SELECT fts_rowid FROM search_messages WHERE chat_id = ? AND seq >= ? AND fts_rowid IS NOT NULL)""",
+                 (chat_id, first_seq))
+    conn.execute("DELETE FROM search_messages WHERE chat_id = ? AND seq >= ?", (chat_id, first_seq))
+
+def _run_write(chat_id, write):
+    """Runs write(conn) in a transaction; index failures are logged, never raised into the save path."""
+    if not config.SEARCH_ENABLED:
+        return
+    try:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            write(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    except sqlite3.Error as e:
+        logging.warning(f"Search index update for chat {chat_id} failed (repaired by the next sync): {e}")
+        _count('index_errors')
+
+def index_chat(chat_id, messages):
+    """Makes the index match a chat's full message list (newest first), re-indexing only from the first change."""
+    chronological = messages[::-1]
+    def write(conn):
+        stored = [row[0] for row in conn.execute("SELECT digest FROM search_messages WHERE chat_id = ? ORDER BY seq", (chat_id,))]
+        keep = 0
+        for digest, message in zip(stored, chronological):
+            if digest != _digest(*_message_fields(message)):
+                break
+            keep += 1
+        if keep < len(stored):
+            _delete_from(conn, chat_id, keep)
+        _insert_messages(conn, chat_id, keep, chronological[keep:])
+        conn.execute("INSERT OR REPLACE INTO search_chats (chat_id, name, message_count) VALUES (?, ?, ?)",
+                     (chat_id, chat_name(messages), len(messages)))
+    _run_write(chat_id, write)
+
+def index_appended(chat_id, messages):
+    """Indexes messages (oldest first) appended to a chat."""
+    if not messages:
+        return
+    def write(conn):
+        next_seq = conn.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM search_messages WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+        _insert_messages(conn, chat_id, next_seq, messages)
+        conn.execute("""INSERT INTO search_chats (chat_id, name, message_count) VALUES (?, ?, ?)
+                        ON CONFLICT (chat_id) DO UPDATE SET name = COALESCE(name, excluded.name),
+                                                            message_count = message_count + excluded.message_count""",
+                     (chat_id, chat_name(messages[::-1]), len(messages)))
+    _run_write(chat_id, write)
+
+def remove_chat(chat_id):
+    def write(conn):
+        _delete_from(conn, chat_id, 0)
+        conn.execute("DELETE FROM search_chats WHERE chat_id = ?", (chat_id,))
+    _run_write(chat_id, write)
+
+def _query_words(text):
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        raise ValueError("Search query must contain at least one word.")
+    return words
+
+def _build_query(words):
+    """FTS5 query for the words: every word must match, the last one as a prefix (search as you type)."""
+    return " ".join(f'"{word}"' for word in words[:-1]) + (" " if len(words) > 1 else "") + f'"{words[-1]}"*'
+
+def _snippet(content, words):
+    """Returns (snippet, highlights): the _SNIPPET_WORDS-word window of content with the most query hits,
+    and [start, end] offsets of the matched words within it. Built here rather than with FTS5's
+    snippet(), which re-runs the query, and returned as offsets so message text is never markup."""
+    tokens = list(re.finditer(r"\w+", content))
+    if not tokens:
+        return content[:200], []
+    exact, prefix = set(words[:-1]), words[-1]
+    hits = [i for i, token in enumerate(tokens) if token.group().lower() in exact or token.group().lower().startswith(prefix)]
+    first = 0
+    if hits: # Start the window at the hit that has the most other hits after it
+        first = max(hits, key=lambda i: bisect.bisect_left(hits, i + _SNIPPET_WORDS) - bisect.bisect_left(hits, i))
+        first = max(0, min(first - 2, len(tokens) - _SNIPPET_WORDS)) # A little leading context
+    last = min(first + _SNIPPET_WORDS, len(tokens)) - 1
+    # Whole message edges keep their punctuation; cut edges get an ellipsis
+    start = tokens[first].start() if first else len(content) - len(content.lstrip())
+    end = tokens[last].end() if last < len(tokens) - 1 else len(content.rstrip())
+    lead = "…" if first else ""
+    snippet = lead + content[start:end] + ("…" if last < len(tokens) - 1 else "")
+    highlights = [[tokens[i].start() - start + len(lead), tokens[i].end() - start + len(lead)] for i in hits if first <= i <= last]
+    return snippet, highlights
+
+def search(text, limit=20, offset=0):
+    """Returns (results, next_offset, truncated) for a query, best match first; next_offset is None on
+    the last page. truncated means only the newest SEARCH_MAX_CANDIDATES matching messages were ranked."""
+    words = _query_words(text)
+    query = _build_query(words)
+    _count('queries')
+    conn = _connect()
+    # Walking the index newest first lets FTS5 stop after the candidate cap, so broad
+    # queries cost the same as narrow ones; ranking only touches the candidates
+    candidates = conn.execute("SELECT chat_id, rowid, rank FROM message_fts WHERE message_fts MATCH ? ORDER BY rowid DESC LIMIT ?",
+                              (query, config.SEARCH_MAX_CANDIDATES)).fetchall()
+    best = {} # chat_id -> [best rank, its rowid, matching messages]
+    for chat_id, rowid, rank in candidates:
+        entry = best.get(chat_id)
+        if entry is None:
+            best[chat_id] = [rank, rowid, 1]
+        else:
+            entry[2] += 1
+            if rank < entry[0]:
+                entry[0], entry[1] = rank, rowid
+    ranked = sorted(best.items(), key=lambda item: (item[1][0], item[0]))
+    page = ranked[offset:offset + limit]
+    next_offset = offset + limit if offset + limit < len(ranked) else None
+    truncated = len(candidates) >= config.SEARCH_MAX_CANDIDATES
+    if not page:
+        return [], None, truncated
+    rowids = [entry[1] for _, entry in page]
+    placeholders = ",".join("?" * len(page))
+    messages = {rowid: (seq, role, content) for rowid, seq, role, content in conn.execute(
+        f"SELECT rowid, seq, role, content FROM message_fts WHERE rowid IN ({placeholders})", rowids)}
+    chats = {chat_id: (name, message_count) for chat_id, name, message_count in conn.execute(
+        f"SELECT chat_id, name, message_count FROM search_chats WHERE chat_id IN ({placeholders})", [chat_id for chat_id, _ in page])}
+    results = []
+    for chat_id, (rank, rowid, matches) in page:
+        seq, role, content = messages.get(rowid, (None, None, ''))
+        snippet, highlights = _snippet(content, words)
+        name, message_count = chats.get(chat_id, (None, None))
+        results.append({
+            'id': chat_id,
+            'name': display_name(chat_id, name),
+            'score': round(-rank, 4), # rank is bm25(), lower-is-better
+            'matches': matches, # Matching messages in the chat (among the candidates)
+            'snippet': snippet,
+            'highlights': highlights, # [start, end] offsets of matched words in snippet
+            'role': role,
+            'message_index': message_count - 1 - seq if message_count is not None and seq is not None else None, # Newest first, as the UI lists messages
+        })
+    return results, next_offset, truncated
+
+def sync(list_chats, load_chat):
+    """Re-indexes chats whose message count differs from the index and drops chats that no longer exist.
+
+    list_chats() returns [{'id', 'message_count'}, ...]; load_chat(id) returns the chat data.
+    """
+    with _stats_lock:
+        _search_stats['syncing'] = True
+    try:
+        store_counts = {chat['id']: chat.get('message_count') for chat in list_chats()}
+        indexed_counts = dict(_connect().execute("SELECT chat_id, message_count FROM search_chats"))
+        for chat_id in indexed_counts.keys() - store_counts.keys():
+            remove_chat(chat_id)
+        stale = [chat_id for chat_id, count in store_counts.items() if indexed_counts.get(chat_id) != count]
+        for chat_id in stale:
+            try:
+                index_chat(chat_id, load_chat(chat_id).get('messages', []))
+            except (OSError, ValueError, sqlite3.Error) as e:
+                logging.warning(f"Could not index chat {chat_id}: {e}")
+        if stale:
+            logging.info(f"Search index synced: {len(stale)} chat(s) indexed, {len(indexed_counts.keys() - store_counts.keys())} removed.")
+        _count('reindexed_chats', len(stale))
+    except (OSError, sqlite3.Error) as e:
+        logging.error(f"Search index sync failed: {e}")
+    finally:
+        with _stats_lock:
+            _search_stats['syncing'] = False
+
+def start_sync(list_chats, load_chat):
+    """Runs sync() in a background thread (no-op if disabled or already running)."""
+    global _sync_thread
+    if not config.SEARCH_ENABLED or (_sync_thread is not None and _sync_thread.is_alive()):
+        return
+    _sync_thread = threading.Thread(target=sync, args=(list_chats, load_chat), name="search-index-sync", daemon=True)
+    _sync_thread.start()
+
+def is_syncing():
+    with _stats_lock:
+        return _search_stats['syncing']
+
+def get_search_stats():
+    with _stats_lock:
+        stats = dict(_search_stats)
+    stats['enabled'] = config.SEARCH_ENABLED
+    if config.SEARCH_ENABLED:
+        conn = _connect()
+        stats['chats'] = conn.execute("SELECT COUNT(*) FROM search_chats").fetchone()[0]
+        stats['messages'] = conn.execute("SELECT COUNT(*) FROM search_messages").fetchone()[0]
+    return stats
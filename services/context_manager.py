@@ -0,0 +1,156 @@
+import math
+import logging
+import functools
+import threading
+import config # Import config variables
+
+try:
+    import tiktoken
+except ImportError: # Optional: falls back to the character heuristic
+    tiktoken = None
+
+try:
+    from tokenizers import Tokenizer as HFTokenizer
+except ImportError: # Optional: only needed for CONTEXT_TOKENIZER_FILES
+    HFTokenizer = None
+
+CHARS_PER_TOKEN_FALLBACK = 3.5 # Used only when no tokenizer can be loaded
+MESSAGE_TOKEN_OVERHEAD = 4 # Role markers / separators added per chat message
+
+# Known context windows by model name prefix (longest matching prefix wins)
+MODEL_CONTEXT_LIMITS = {
+    'gpt-4o': 128000, 'gpt-4.1': 1047576, 'gpt-4.5': 128000, 'gpt-4-turbo': 128000, 'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385, 'o1': 200000, 'o3': 200000, 'o4': 200000,
+    'claude': 200000,
+    'gemini-1.5': 1048576, 'gemini-2': 1048576, 'gemini-1.0': 32760, 'gemini-pro': 32760,
+    'llama3-8b-8192': 8192, 'llama3-70b-8192': 8192, 'llama-3.1': 131072, 'llama-3.2': 131072, 'llama-3.3': 131072,
+    'mixtral-8x7b-32768': 32768, 'gemma-7b-it': 8192, 'gemma2': 8192,
+    'grok': 131072,
+}
+
+# Tokenizer choice per backend: (tiktoken encoding, safety factor for non-native vocabularies)
+BACKEND_TOKENIZERS = {
+    'openai': ('cl100k_base', 1.0),
+    'groq': ('cl100k_base', 1.1),
+    'xai': ('cl100k_base', 1.1),
+    'custom_external': ('cl100k_base', 1.1),
+    'ollama': ('cl100k_base', 1.1),
+    'kobold': ('cl100k_base', 1.1),
+    'google': ('cl100k_base', 1.15),
+    'anthropic': ('cl100k_base', 1.2),
+}
+O200K_MODEL_PREFIXES = ('gpt-4o', 'gpt-4.1', 'gpt-4.5', 'gpt-5', 'o1', 'o3', 'o4')
+
+_encoders = {} # tokenizer key -> encode callable (or None if unavailable)
+_encoders_lock = threading.Lock()
+
+def _load_encoder(tokenizer_key):
+    kind, name = tokenizer_key
+    try:
+        if kind == 'hf' and HFTokenizer is not None:
+            hf_tokenizer = HFTokenizer.from_file(name)
+            return lambda text: hf_tokenizer.encode(text, add_special_tokens=False).ids
+        if kind == 'tiktoken' and tiktoken is not None:
+            encoding = tiktoken.get_encoding(name)
+            return lambda text: encoding.encode(text, disallowed_special=())
+    except Exception as e:
+        logging.warning(f"Could not load tokenizer {name}: {e}. Falling back to character estimate.")
+    return None
+
+def _get_encoder(tokenizer_key):
+    if tokenizer_key in _encoders:
+        return _encoders[tokenizer_key]
+    with _encoders_lock:
+        if tokenizer_key not in _encoders:
+            _encoders[tokenizer_key] = _load_encoder(tokenizer_key)
+    return _encoders[tokenizer_key]
+
+def get_tokenizer_key(backend, model):
+    """Picks the tokenizer for a backend/model: a configured HF tokenizer.json, else tiktoken.
+
+    Returns (tokenizer_key, safety_factor).
+    """
+    model_name = (model or '').lower()
+    for family, tokenizer_path in config.CONTEXT_TOKENIZER_FILES.items():
+        if family in model_name:
+            return ('hf', tokenizer_path), 1.0
+    encoding_name, factor = BACKEND_TOKENIZERS.get(backend, ('cl100k_base', 1.1))
+    if backend == 'openai' and model_name.startswith(O200K_MODEL_PREFIXES):
+        encoding_name = 'o200k_base'
+    return ('tiktoken', encoding_name), factor
+
+@functools.lru_cache(maxsize=32768)
+def _count_text_tokens(tokenizer_key, text):
+    """Token count for one text with one tokenizer (memoized per message content)."""
+    encode = _get_encoder(tokenizer_key)
+    if encode is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN_FALLBACK)
+    return len(encode(text))
+
+def count_tokens(text, backend, model):
+    tokenizer_key, factor = get_tokenizer_key(backend, model)
+    return math.ceil(_count_text_tokens(tokenizer_key, text or '') * factor)
+
+def count_message_tokens(message, backend, model):
+    return count_tokens(message.get('content', ''), backend, model) + MESSAGE_TOKEN_OVERHEAD
+
+def _message_cost(message, tokenizer_key, factor):
+    return math.ceil(_count_text_tokens(tokenizer_key, message.get('content') or '') * factor) + MESSAGE_TOKEN_OVERHEAD
+
+def get_context_limit(backend, model):
+    """Context window (tokens) for a backend/model, honoring CONTEXT_LIMIT_OVERRIDES."""
+    model_name = (model or '').lower()
+    overrides = config.CONTEXT_LIMIT_OVERRIDES
+    for prefix in sorted(overrides, key=len, reverse=True):
+        if model_name.startswith(prefix.lower()):
+            return overrides[prefix]
+    if backend == 'kobold':
+        return config.KOBOLD_CONTEXT_LIMIT
+    if backend == 'ollama':
+        return config.OLLAMA_CONTEXT_LIMIT
+    for prefix in sorted(MODEL_CONTEXT_LIMITS, key=len, reverse=True):
+        if model_name.startswith(prefix):
+            return MODEL_CONTEXT_LIMITS[prefix]
+    return config.DEFAULT_CONTEXT_LIMIT
+
+def get_prompt_budget(backend, model, reserved_tokens=None):
+    """Tokens available for the prompt once the generation budget is reserved."""
+    if reserved_tokens is None:
+        reserved_tokens = config.CONTEXT_RESERVED_TOKENS
+    return max(0, get_context_limit(backend, model) - reserved_tokens)
+
+def fit_history(prompt, history, backend, model, reserved_tokens=None):
+    """Trims history (newest first) so prompt + history fit the model's context window.
+
+    System messages are kept when they fit; otherwise the newest turns win.
+    Returns the trimmed history, still newest first.
+    """
+    budget = get_prompt_budget(backend, model, reserved_tokens)
+    tokenizer_key, factor = get_tokenizer_key(backend, model) # Resolved once, not per message
+    used = math.ceil(_count_text_tokens(tokenizer_key, prompt or '') * factor) + MESSAGE_TOKEN_OVERHEAD
+
+    # Pin system messages first so instructions survive trimming
+    keep = [False] * len(history)
+    for i, msg in enumerate(history):
+        if msg.get('role') == 'system':
+            cost = _message_cost(msg, tokenizer_key, factor)
+            if used + cost <= budget:
+                keep[i] = True
+                used += cost
+
+    dropped = 0
+    for i, msg in enumerate(history): # Newest first
+        if keep[i] or msg.get('role') == 'system':
+            continue
+        cost = _message_cost(msg, tokenizer_key, factor)
+        if used + cost > budget:
+            dropped = sum(1 for j in range(i, len(history)) if not keep[j])
+            break
+        keep[i] = True
+        used += cost
+
+    if dropped:
+        logging.warning(f"Context budget for {backend}/{model}: dropped {dropped} oldest message(s) to fit {budget} prompt tokens.")
+    elif all(keep):
+        return history # Nothing trimmed; skip the copy
+    return [msg for i, msg in enumerate(history) if keep[i]]
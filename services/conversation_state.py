@@ -0,0 +1,202 @@
+import json
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+import config # Import config variables
+from services.context_manager import fit_history, get_prompt_budget, get_context_limit, count_tokens, count_message_tokens
+
+# Per-conversation state that lets local backends skip re-processing the whole chat.
+#
+# Ollama context reuse: /api/generate returns `context`, the token state of the
+# conversation so far. It is stored under a digest of the whole history it was
+# built from (every earlier message, plus the turn's prompt and reply). When the
+# next request's history has exactly that digest, only the new prompt is sent
+# along with that context. Anything else (another chat that happens to end the
+# same way, an edit anywhere in the history, a reply served from cache) misses
+# and falls back to a full /api/chat resend.
+#
+# Stable prefixes: Kobold (and Ollama's runner on the /api/chat path) reuse the
+# KV cache for the longest prompt prefix matching the previous request. Trimming
+# one old message per turn would change the prefix every turn, so each
+# conversation keeps an anchor (its oldest kept message) and only moves it when
+# the prompt overflows the window or the client stops sending the anchor. It
+# then drops to CONVERSATION_REANCHOR_KEEP of the window, leaving room for
+# several more turns with the same prefix.
+#
+# Conversations are recognised by content, not by chat id. Prefix anchors are
+# keyed by the turn's user prompt, which the next request carries as one of its
+# newest history messages; a wrong match only changes which old messages are
+# trimmed.
+_state_lock = threading.Lock()
+_ollama_sessions = OrderedDict() # (model, history digest) -> context tokens (array('i'): 4 bytes per token instead of ~36 in a list)
+_anchors = OrderedDict() # (backend, model, prompt hash) -> anchor message hash chosen for that turn
+_state_stats = {'context_hits': 0, 'context_misses': 0, 'context_too_long': 0, 'history_tokens_not_resent': 0,
+                'prefix_kept': 0, 'reanchored': 0}
+
+def _message_hash(role, content):
+    return hash((role, (content or '').strip()))
+
+def _hash_message(message):
+    return _message_hash(message.get('role', 'user'), message.get('content'))
+
+def _feed_message(hasher, role, content):
+    hasher.update(json.dumps([role, (content or '').strip()], ensure_ascii=False).encode('utf-8') + b"\n")
+
+def _history_hasher(history):
+    """blake2b over a whole history (newest first, hashed oldest first so a turn can extend it)."""
+    hasher = hashlib.blake2b(digest_size=16)
+    for message in reversed(history):
+        _feed_message(hasher, message.get('role', 'user'), message.get('content'))
+    return hasher
+
+def _remember(table, key, value):
+    """Caller holds the lock. LRU insert bounded by CONVERSATION_STATE_MAX_SESSIONS."""
+    table[key] = value
+    table.move_to_end(key)
+    while len(table) > config.CONVERSATION_STATE_MAX_SESSIONS:
+        table.popitem(last=False)
+
+def _count(counter, amount=1):
+    with _state_lock:
+        _state_stats[counter] += amount
+
+# --- Ollama context reuse ---
+def get_ollama_context(model, prompt, history):
+    """Context to continue from for this request: a token list on a hit, [] to start a new
+    session (empty history), or None to fall back to a full /api/chat resend."""
+    if not config.CONVERSATION_STATE_ENABLED:
+        return None
+    if not history:
+        return []
+    if len(history) < 2 or history[0].get('role') != 'assistant' or history[1].get('role') != 'user':
+        _count('context_misses')
+        return None
+    key = (model, _history_hasher(history).digest()) # The stored context must cover exactly this history
+    with _state_lock:
+        context = _ollama_sessions.get(key)
+        if context is not None:
+            _ollama_sessions.move_to_end(key)
+    if context is None:
+        _count('context_misses')
+        return None
+    budget = get_context_limit('ollama', model) - config.CONTEXT_RESERVED_TOKENS
+    if len(context) + count_tokens(prompt, 'ollama', model) > budget:
+        _count('context_too_long') # Ollama would have to truncate; resend a budgeted window instead
+        return None
+    with _state_lock:
+        _state_stats['context_hits'] += 1
+        _state_stats['history_tokens_not_resent'] += sum(count_message_tokens(m, 'ollama', model) for m in history)
+    return list(context)
+
+def record_ollama_turn(model, history_hasher, prompt, reply, context):
+    """Stores the context Ollama returned so the next turn can continue from it.
+    history_hasher is _history_hasher() of the history the request was made with."""
+    if not config.CONVERSATION_STATE_ENABLED or not context or not reply:
+        return
+    hasher = history_hasher.copy()
+    _feed_message(hasher, 'user', prompt)
+    _feed_message(hasher, 'assistant', reply)
+    with _state_lock:
+        _remember(_ollama_sessions, (model, hasher.digest()), array('i', context))
+
+class OllamaTurn:
+    """Captures the reply and returned context of one /api/generate request."""
+    def __init__(self, model, prompt, history):
+        self.model = model
+        self.prompt = prompt
+        self.history_hasher = _history_hasher(history)
+        self.context = None
+        self._tokens = []
+
+    def wrap_parse_line(self, parse_line):
+        """Wraps a stream line parser to collect tokens and the final line's context."""
+        def parse(line):
+            token, done = parse_line(line)
+            if token:
+                self._tokens.append(token)
+            if done:
+                self.context = json.loads(line).get('context')
+            return token, done
+        return parse
+
+    def finish(self, result=None, response_text=None):
+        """Records the turn; pass the parsed JSON result and text for non-streaming calls."""
+        if isinstance(result, dict):
+            self.context = result.get('context')
+        reply = response_text if response_text is not None else ''.join(self._tokens)
+        record_ollama_turn(self.model, self.history_hasher, self.prompt, reply, self.context)
+
+def begin_turn(backend, model, prompt, history, payload):
+    """Returns an OllamaTurn if this request continues or starts an Ollama context session.
+    history is the fitted history the request was built from, as passed to get_ollama_context."""
+    if backend == 'ollama' and 'prompt' in payload:
+        return OllamaTurn(model, prompt, history)
+    return None
+
+# --- Stable prompt prefixes ---
+def _reanchor(prompt, history, backend, model, reserved_tokens, slid):
+    """Keeps the newest CONVERSATION_REANCHOR_KEEP of the window (by tokens, and by messages if the client's window slid)."""
+    prompt_budget = get_prompt_budget(backend, model, reserved_tokens)
+    keep_budget = int(prompt_budget * config.CONVERSATION_REANCHOR_KEEP)
+    limit = get_context_limit(backend, model)
+    fitted = fit_history(prompt, history, backend, model, reserved_tokens=max(0, limit - keep_budget))
+    if slid:
+        max_messages = max(2, int(len(history) * config.CONVERSATION_REANCHOR_KEEP))
+        non_system = [i for i, m in enumerate(fitted) if m.get('role') != 'system']
+        if len(non_system) > max_messages:
+            cut = set(non_system[max_messages:]) # Oldest non-system messages beyond the cap
+            fitted = [m for i, m in enumerate(fitted) if i not in cut]
+    _count('reanchored')
+    return fitted
+
+def _oldest_anchor_hash(history):
+    for message in reversed(history): # Oldest first
+        if message.get('role') != 'system':
+            return _hash_message(message)
+    return None
+
+def fit_stable_history(prompt, history, backend, model, reserved_tokens=None):
+    """fit_history that keeps the conversation's prompt prefix stable across turns (newest first in and out)."""
+    if not config.CONVERSATION_STATE_ENABLED or not history:
+        return fit_history(prompt, history, backend, model, reserved_tokens=reserved_tokens)
+
+    previous_anchor = None
+    with _state_lock:
+        for message in history[:2]: # The previous turn's prompt is one of the newest two messages
+            if message.get('role') == 'user':
+                previous_anchor = _anchors.get((backend, model, _hash_message(message)))
+                if previous_anchor is not None:
+                    break
+
+    fitted = None
+    if previous_anchor is not None:
+        hashes = [_hash_message(m) for m in history]
+        if previous_anchor in hashes:
+            anchor_index = len(hashes) - 1 - hashes[::-1].index(previous_anchor) # Oldest occurrence, for repeated short messages
+            candidate = [m for i, m in enumerate(history) if i <= anchor_index or m.get('role') == 'system']
+            fitted = fit_history(prompt, candidate, backend, model, reserved_tokens=reserved_tokens)
+            if len(fitted) == len(candidate):
+                _count('prefix_kept')
+            else:
+                fitted = _reanchor(prompt, history, backend, model, reserved_tokens, slid=False)
+        else:
+            fitted = _reanchor(prompt, history, backend, model, reserved_tokens, slid=True)
+    else: # New to us: keep everything that fits, re-anchoring only on overflow
+        fitted = fit_history(prompt, history, backend, model, reserved_tokens=reserved_tokens)
+        if len(fitted) != len(history):
+            fitted = _reanchor(prompt, history, backend, model, reserved_tokens, slid=False)
+
+    anchor = _oldest_anchor_hash(fitted)
+    if anchor is not None:
+        with _state_lock:
+            _remember(_anchors, (backend, model, _message_hash('user', prompt)), anchor)
+    return fitted
+
+def get_conversation_state_stats():
+    with _state_lock:
+        stats = dict(_state_stats)
+        stats['ollama_sessions'] = len(_ollama_sessions)
+        stats['anchored_conversations'] = len(_anchors)
+    stats['enabled'] = config.CONVERSATION_STATE_ENABLED
+    return stats
@@ -0,0 +1,180 @@
+import time
+import queue
+import logging
+import threading
+from collections import deque
+import config # Import config variables
+from services.llm_backends import call_llm_backend, is_error_response
+from services import scheduler, cancellation
+from services.retry_policy import RequestCancelled
+
+LATENCY_WINDOW = 500 # Successful latencies kept per backend for the percentile
+
+_hedge_lock = threading.Lock()
+_latencies = {} # backend -> deque of recent successful latencies (seconds)
+_thresholds = {} # backend -> (sample count when computed, threshold seconds)
+_hedge_stats = {} # backend -> counters, see _get_stats
+_rate_window = {'requests': 0.0, 'hedges': 0.0} # Decayed counts for the global hedge-rate cap
+
+def _get_stats(backend):
+    """Caller holds the lock."""
+    stats = _hedge_stats.get(backend)
+    if stats is None:
+        stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'rate_capped': 0}
+        _hedge_stats[backend] = stats
+    return stats
+
+def record_latency(backend, latency):
+    with _hedge_lock:
+        window = _latencies.get(backend)
+        if window is None:
+            window = _latencies[backend] = deque(maxlen=LATENCY_WINDOW)
+        window.append(latency)
+
+def get_hedge_delay(backend):
+    """Seconds to wait before hedging: HEDGE_PERCENTILE of recent latencies, or None if too few samples."""
+    with _hedge_lock:
+        window = _latencies.get(backend)
+        if window is None or len(window) < config.HEDGE_MIN_SAMPLES:
+            return None
+        samples = len(window)
+        cached = _thresholds.get(backend)
+        if cached is None or abs(samples - cached[0]) >= 10 or samples == LATENCY_WINDOW:
+            ordered = sorted(window)
+            index = min(len(ordered) - 1, int(len(ordered) * config.HEDGE_PERCENTILE / 100))
+            cached = (samples, max(config.HEDGE_MIN_DELAY, ordered[index]))
+            _thresholds[backend] = cached
+        return cached[1]
+
+def _take_hedge_token(backend):
+    """Global cap: hedges stay under HEDGE_MAX_RATE of requests (counts decay so the cap tracks recent traffic)."""
+    with _hedge_lock:
+        allowed = _rate_window['hedges'] + 1 <= config.HEDGE_MAX_RATE * _rate_window['requests'] + 1
+        if allowed:
+            _rate_window['hedges'] += 1
+            _get_stats(backend)['hedged'] += 1
+        else:
+            _get_stats(backend)['rate_capped'] += 1
+        return allowed
+
+def _count_request(backend):
+    with _hedge_lock:
+        _rate_window['requests'] += 1
+        if _rate_window['requests'] > 1000:
+            _rate_window['requests'] /= 2
+            _rate_window['hedges'] /= 2
+        _get_stats(backend)['requests'] += 1
+
+def is_hedging_enabled(backend):
+    return config.HEDGING_ENABLED and backend in config.HEDGE_BACKENDS
+
+def hedged_call_llm_backend(prompt, history, backend, model, hedge_target, priority=scheduler.PRIORITY_INTERACTIVE, cancel_event=None):
+    """call_llm_backend that sends a second request if the first is slower than the hedge delay.
+
+    hedge_target is the (backend, model) for the hedge (the same target or a
+    failover equivalent). The first successful response wins; the loser's
+    request is aborted and its result discarded. The caller holds a
+    scheduler slot for the primary; the hedge takes its own.
+    Returns (response_text, used_backend, used_model).
+    """
+    _count_request(backend)
+    delay = get_hedge_delay(backend) if is_hedging_enabled(backend) else None
+    if delay is None:
+        start_time = time.monotonic()
+        response_text = call_llm_backend(prompt, history, backend, model, cancel_event=cancel_event)
+        if not is_error_response(response_text):
+            record_latency(backend, time.monotonic() - start_time)
+        return response_text, backend, model
+
+    results = queue.Queue()
+    attempt_events = []
+
+    def run_attempt(target_backend, target_model, attempt_event, is_hedge):
+        start_time = time.monotonic()
+        try:
+            if is_hedge:
+                with scheduler.backend_slot(target_backend, priority, attempt_event):
+                    response_text = call_llm_backend(prompt, history, target_backend, target_model, cancel_event=attempt_event)
+            else:
+                response_text = call_llm_backend(prompt, history, target_backend, target_model, cancel_event=attempt_event)
+        except scheduler.SchedulerRejected as e:
+            response_text = f"[Error: hedge rejected: {e}]"
+        except RequestCancelled as e: # Cancelled while queued for the hedge's slot
+            response_text = f"[Error connecting to {target_backend} API: {e}]"
+        if not is_error_response(response_text): # Late losers count too, or slow tails would vanish from the window
+            record_latency(target_backend, time.monotonic() - start_time)
+        results.put((response_text, target_backend, target_model, is_hedge))
+
+    def launch(target_backend, target_model, is_hedge):
+        attempt_event = cancellation.CancelHandle(f"{'hedge' if is_hedge else 'primary'} call to {target_backend}")
+        attempt_events.append(attempt_event)
+        threading.Thread(target=run_attempt, args=(target_backend, target_model, attempt_event, is_hedge),
+                         name="hedged-llm-call", daemon=True).start()
+
+    def cancel_all():
+        for attempt_event in list(attempt_events):
+            attempt_event.set()
+
+    def client_cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    # A client cancel aborts every attempt at once (their results then arrive promptly);
+    # plain Events can't call back, so they are polled
+    cancel_token = cancel_event.add_callback(cancel_all) if cancellation.supports_abort(cancel_event) else None
+    poll = 0.05 if cancel_event is not None and cancel_token is None else None
+
+    def next_result(timeout=None):
+        """Next attempt result, or None if timeout passes first (never after a client cancel)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if client_cancelled():
+                cancel_all()
+                return results.get()
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            wait = poll if remaining is None else (remaining if poll is None else min(remaining, poll))
+            try:
+                return results.get(timeout=wait)
+            except queue.Empty:
+                pass
+
+    try:
+        launch(backend, model, is_hedge=False)
+        pending = 1
+        first = next_result(delay)
+        if first is not None:
+            pending -= 1
+        elif not client_cancelled() and _take_hedge_token(backend):
+            logging.info(f"{backend}/{model} slower than {delay * 1000:.0f}ms; hedging to {hedge_target[0]}/{hedge_target[1]}.")
+            launch(hedge_target[0], hedge_target[1], is_hedge=True)
+            pending += 1
+
+        last_result = first
+        while not (last_result is not None and not is_error_response(last_result[0])) and pending > 0:
+            last_result = next_result()
+            pending -= 1
+    finally:
+        if cancel_token is not None:
+            cancel_event.remove_callback(cancel_token)
+
+    cancel_all() # Loser's (if any) connection is aborted; its late result is dropped
+    response_text, used_backend, used_model, was_hedge = last_result
+    if was_hedge and not is_error_response(response_text):
+        with _hedge_lock:
+            _get_stats(backend)['hedge_wins'] += 1
+    return response_text, used_backend, used_model
+
+def get_hedging_stats():
+    stats = {'enabled': config.HEDGING_ENABLED, 'percentile': config.HEDGE_PERCENTILE,
+             'max_rate': config.HEDGE_MAX_RATE, 'backends': {}}
+    with _hedge_lock:
+        backends = set(_latencies) | set(_hedge_stats)
+    for backend in sorted(backends):
+        delay = get_hedge_delay(backend)
+        with _hedge_lock:
+            backend_stats = dict(_get_stats(backend))
+            backend_stats['samples'] = len(_latencies.get(backend, ()))
+        backend_stats['hedge_delay_ms'] = round(delay * 1000, 1) if delay is not None else None
+        stats['backends'][backend] = backend_stats
+    return stats
@@ -0,0 +1,66 @@
+import zlib
+import logging
+import config # Import config variables
+
+try:
+    import zstandard
+except ImportError: # Optional: gzip is used when it isn't installed
+    zstandard = None
+
+# Compression for chat history at rest (HISTORY_COMPRESSION): file-store
+# snapshots, and large message/image rows in the SQLite store. Data is
+# recognized by its magic bytes when read, so stored data may mix plain JSON,
+# gzip and zstd, and changing the setting never requires a migration.
+METHODS = ('auto', 'zstd', 'gzip', 'none')
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_GZIP_LEVEL = 6 # Level 9 costs several times more for little gain on JSON
+_GZIP_WBITS = 16 + zlib.MAX_WBITS # gzip framing, without the gzip module's per-call overhead (it adds up over many small rows)
+_ZSTD_LEVEL = 3
+_warned_missing_zstd = False
+
+def check_setting():
+    """Falls back to 'none' (with a warning) for an unknown HISTORY_COMPRESSION. Called at startup."""
+    if config.HISTORY_COMPRESSION not in METHODS:
+        logging.warning(f"Unknown HISTORY_COMPRESSION={config.HISTORY_COMPRESSION!r} (expected one of {', '.join(METHODS)}); "
+                        "storing chat history uncompressed.")
+        config.HISTORY_COMPRESSION = 'none'
+
+def _method():
+    global _warned_missing_zstd
+    check_setting() # Also covers callers that skip init_store, e.g. the SQLite import tool
+    method = config.HISTORY_COMPRESSION
+    if method == 'auto':
+        return 'zstd' if zstandard is not None else 'gzip'
+    if method == 'zstd' and zstandard is None:
+        if not _warned_missing_zstd:
+            logging.warning("HISTORY_COMPRESSION=zstd but the zstandard package is not installed; using gzip.")
+            _warned_missing_zstd = True
+        return 'gzip'
+    return method
+
+def enabled():
+    return _method() != 'none'
+
+def compress(data):
+    """Compresses bytes with the configured method (returned unchanged for HISTORY_COMPRESSION=none)."""
+    method = _method()
+    if method == 'zstd':
+        return zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(data)
+    if method == 'gzip':
+        compressor = zlib.compressobj(_GZIP_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    return data
+
+def is_compressed(data):
+    return data[:2] == _GZIP_MAGIC or data[:4] == _ZSTD_MAGIC
+
+def decompress(data):
+    """Returns the plain bytes of data written by compress() with any method (plain data is returned as is)."""
+    if data[:2] == _GZIP_MAGIC:
+        return zlib.decompress(data, _GZIP_WBITS)
+    if data[:4] == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError("data is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
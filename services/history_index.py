@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import base64
+import bisect
+import logging
+import threading
+import config # Import config variables
+from services import history_journal
+
+# Chat list index for the file history store. /api/chats used to open and parse
+# every <chat_id>.json to derive names; this keeps one entry per chat (name,
+# updated_at, message_count, size) in memory, ordered newest first, updated by
+# the history manager on save and delete. It is persisted to
+# HISTORY_DIR/.index.json (debounced) so a restart only stats the chat files,
+# re-parsing just those whose mtime or size changed. Files added or removed
+# behind the server's back change the directory mtime, which is checked on every
+# listing and triggers the same reconcile at runtime.
+INDEX_FILENAME = ".index.json"
+_INDEX_VERSION = 1
+_FLUSH_DELAY = 2.0 # Seconds; batches index writes during bursts of saves
+
+_index_lock = threading.RLock()
+_entries = {} # chat_id -> entry dict
+_order = [] # Sorted (-updated_at, chat_id): newest first
+_loaded_dir = None # HISTORY_DIR the index was loaded for
+_dir_mtime_ns = None # Directory mtime as of our last look/write
+_flush_timer = None
+
+def chat_name(messages):
+    """Name hint from the oldest user message (messages newest first): its first four words."""
+    oldest_user_msg = next((msg.get('content') for msg in reversed(messages) if isinstance(msg, dict) and msg.get('role') == 'user'), None)
+    if not isinstance(oldest_user_msg, str) or not oldest_user_msg:
+        return None
+    name = " ".join(oldest_user_msg.split()[:4]) # First 4 words
+    if len(oldest_user_msg) > len(name) + 3: name += "..." # Add ellipsis
+    return name
+
+def display_name(chat_id, name):
+    return name or f"Chat {chat_id.split('-')[-1]}"
+
+# --- Cursors (shared by both history stores) ---
+def encode_cursor(updated_at, chat_id):
+    """Opaque /api/chats cursor: the sort position of the last chat returned."""
+    return base64.urlsafe_b64encode(json.dumps([updated_at, chat_id]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Returns (updated_at, chat_id); raises ValueError for a malformed cursor."""
+    try:
+        updated_at, chat_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(updated_at), str(chat_id)
+    except (ValueError, TypeError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+# --- File store index ---
+def _index_path():
+    return os.path.join(config.HISTORY_DIR, INDEX_FILENAME)
+
+def _is_chat_file(filename):
+    return filename.endswith(".json") and not filename.startswith(".")
+
+def _dir_mtime():
+    try:
+        return os.stat(config.HISTORY_DIR).st_mtime_ns
+    except OSError:
+        return None
+
+def _build_entry(messages, stat_result):
+    return {
+        'name': chat_name(messages),
+        'updated_at': stat_result.st_mtime,
+        'message_count': len(messages),
+        'size': stat_result.st_size,
+        'mtime_ns': stat_result.st_mtime_ns,
+    }
+
+def _entry_from_file(filepath, stat_result):
+    """Caller holds the lock. Parses a chat file (and its journal) into an index entry (unreadable files get an unnamed entry)."""
+    messages = []
+    try:
+        messages = history_journal.load(filepath)[0]['messages']
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        logging.warning(f"Could not read name hint for {os.path.basename(filepath)[:-5]}: {e}")
+    return _build_entry(messages if isinstance(messages, list) else [], stat_result)
+
+def _set_entry(chat_id, entry):
+    """Caller holds the lock."""
+    old = _entries.get(chat_id)
+    if old is not None:
+        key = (-old['updated_at'], chat_id)
+        i = bisect.bisect_left(_order, key)
+        if i < len(_order) and _order[i] == key:
+            del _order[i]
+    if entry is None:
+        _entries.pop(chat_id, None)
+    else:
+        _entries[chat_id] = entry
+        bisect.insort(_order, (-entry['updated_at'], chat_id))
+
+def _reconcile():
+    """Caller holds the lock. Brings the index in line with the directory: stats every chat file,
+    parsing only new or changed ones, and drops entries whose file is gone."""
+    global _dir_mtime_ns
+    start_time = time.monotonic()
+    _dir_mtime_ns = _dir_mtime()
+    seen, parsed = set(), 0
+    try:
+        with os.scandir(config.HISTORY_DIR) as it:
+            for dir_entry in it:
+                if not _is_chat_file(dir_entry.name) or not dir_entry.is_file():
+                    continue
+                chat_id = dir_entry.name[:-5]
+                seen.add(chat_id)
+                stat_result = dir_entry.stat()
+                entry = _entries.get(chat_id)
+                if entry is None or entry.get('mtime_ns') != stat_result.st_mtime_ns or entry.get('size') != stat_result.st_size:
+                    _set_entry(chat_id, _entry_from_file(dir_entry.path, stat_result))
+                    parsed += 1
+    except FileNotFoundError:
+        pass
+    removed = [chat_id for chat_id in _entries if chat_id not in seen]
+    for chat_id in removed:
+        _set_entry(chat_id, None)
+    if parsed or removed:
+        logging.info(f"Chat index reconciled: {parsed} chat file(s) indexed, {len(removed)} removed "
+                     f"({len(_entries)} total, {time.monotonic() - start_time:.2f}s).")
+        _schedule_flush()
+
+def _ensure_loaded():
+    """Caller holds the lock. Loads the persisted index on first use (or after HISTORY_DIR changed),
+    and reconciles it whenever the directory changed since we last looked."""
+    global _loaded_dir
+    if _loaded_dir != config.HISTORY_DIR:
+        _entries.clear()
+        _order.clear()
+        _loaded_dir = config.HISTORY_DIR
+        try:
+            with open(_index_path(), 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            if stored.get('version') == _INDEX_VERSION:
+                for chat_id, entry in stored['chats'].items():
+                    _set_entry(chat_id, entry)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            logging.warning(f"Ignoring unreadable chat index {_index_path()}: {e}")
+            _entries.clear()
+            _order.clear()
+        _reconcile() # Stat-only unless files changed while we were down
+    elif _dir_mtime() != _dir_mtime_ns:
+        _reconcile()
+
+def _schedule_flush():
+    """Caller holds the lock."""
+    global _flush_timer
+    if _flush_timer is None:
+        _flush_timer = threading.Timer(_FLUSH_DELAY, flush)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+def flush():
+    """Writes the index to HISTORY_DIR/.index.json (atomically)."""
+    global _flush_timer, _dir_mtime_ns
+    with _index_lock:
+        _flush_timer = None
+        if _loaded_dir != config.HISTORY_DIR:
+            return
+        path = _index_path()
+        tmp_path = f"{path}.tmp"
+        try:
+            dir_changed = _dir_mtime() != _dir_mtime_ns
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': _INDEX_VERSION, 'chats': _entries}, f, separators=(',', ':'))
+            os.replace(tmp_path, path)
+            if not dir_changed: # Don't let our own rename hide an outside change from the next listing
+                _dir_mtime_ns = _dir_mtime()
+        except OSError as e:
+            logging.error(f"Error writing chat index {path}: {e}")
+
+def record_save(chat_id, messages, filepath):
+    """Updates the index after the history manager wrote filepath for chat_id."""
+    global _dir_mtime_ns
+    with _index_lock:
+        if _loaded_dir != config.HISTORY_DIR:
+            return # Loaded (and reconciled) on the next listing
+        try:
+            stat_result = os.stat(filepath)
+        except OSError:
+            return
+        _set_entry(chat_id, _build_entry(messages, stat_result))
+        _dir_mtime_ns = _dir_mtime() # Creating or atomically replacing the file changed the directory mtime
+        _schedule_flush()
+
+def record_append(chat_id, messages, filepath):
+    """Updates the index after messages (oldest first) were journaled for chat_id."""
+    with _index_lock:
+        if _loaded_dir != config.HISTORY_DIR:
+            return
+        entry = _entries.get(chat_id)
+        if entry is None:
+            record_save(chat_id, messages[::-1], filepath)
+            return
+        _set_entry(chat_id, dict(entry, updated_at=time.time(), message_count=entry['message_count'] + len(messages),
+                                 name=entry['name'] or chat_name(messages[::-1])))
+        _schedule_flush()
+
+def record_delete(chat_id):
+    global _dir_mtime_ns
+    with _index_lock:
+        if _loaded_dir != config.HISTORY_DIR:
+            return
+        _set_entry(chat_id, None)
+        _dir_mtime_ns = _dir_mtime() # Removing the file changed the directory mtime
+        _schedule_flush()
+
+def list_chats(limit=None, cursor=None):
+    """Returns (chats, next_cursor) for the file store, newest first; next_cursor is None on the last page."""
+    with _index_lock:
+        _ensure_loaded()
+        start = 0
+        if cursor:
+            updated_at, chat_id = decode_cursor(cursor)
+            start = bisect.bisect_right(_order, (-updated_at, chat_id))
+        page = _order[start:start + limit] if limit else _order[start:]
+        chats = []
+        for neg_updated_at, chat_id in page:
+            entry = _entries[chat_id]
+            chats.append({'id': chat_id, 'name': display_name(chat_id, entry.get('name')), 'updated_at': -neg_updated_at,
+                          'message_count': entry.get('message_count'), 'size': entry.get('size')})
+        has_more = limit and start + limit < len(_order)
+    next_cursor = encode_cursor(chats[-1]['updated_at'], chats[-1]['id']) if has_more and chats else None
+    return chats, next_cursor
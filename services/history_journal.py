@@ -0,0 +1,109 @@
+import os
+import json
+import logging
+from services import history_codec
+
+# Journaled file format for the file history store. A chat is a snapshot,
+# <chat_id>.json (the chat object plus "journal_seq"), and a journal,
+# <chat_id>.journal.jsonl, with one line per appended turn:
+#     {"seq": 7, "messages": [...], "images": [...]}   (items oldest first)
+# Appending a turn writes one line instead of the whole chat. Loading replays
+# the journal lines with seq > journal_seq onto the snapshot; compaction folds
+# them into a new snapshot and then removes the journal. Because the snapshot
+# records the last seq it contains, a crash between those two steps can't
+# replay a turn twice.
+#
+# Snapshots are compressed per HISTORY_COMPRESSION (see history_codec) but keep
+# the .json name; plain snapshots from before are read as they are. The journal
+# stays plain text so a turn can be appended without rewriting it.
+JOURNAL_SUFFIX = ".journal.jsonl"
+SEQ_KEY = "journal_seq"
+
+def journal_path(filepath):
+    """Journal path for a snapshot path (<dir>/<chat_id>.json)."""
+    return filepath[:-len(".json")] + JOURNAL_SUFFIX
+
+def _empty_chat():
+    return {'messages': [], 'images': []}
+
+def read_snapshot(filepath):
+    """Returns (chat data, journal_seq); an empty chat if the snapshot doesn't exist.
+    Raises OSError/ValueError for unreadable snapshots."""
+    try:
+        with open(filepath, 'rb') as f:
+            data = json.loads(history_codec.decompress(f.read()))
+    except FileNotFoundError:
+        return _empty_chat(), 0
+    if not isinstance(data, dict):
+        raise ValueError("chat file does not contain an object")
+    journal_seq = data.pop(SEQ_KEY, 0)
+    # Ensure default structure if keys are missing
+    if 'messages' not in data: data['messages'] = []
+    if 'images' not in data: data['images'] = []
+    return data, journal_seq
+
+def read_entries(filepath, after_seq=0):
+    """Journal entries with seq > after_seq, oldest first. Torn lines (a crash mid-append) are skipped."""
+    entries = []
+    try:
+        with open(journal_path(filepath), 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return entries
+    for line_number, line in enumerate(lines, 1):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            logging.warning(f"Skipping incomplete line {line_number} of journal {journal_path(filepath)}")
+            continue
+        if isinstance(entry, dict) and entry.get('seq', 0) > after_seq:
+            entries.append(entry)
+    return entries
+
+def apply_entries(data, entries):
+    """Adds the journaled items to data's newest-first lists. Returns the last seq applied (or None)."""
+    new_messages, new_images = [], []
+    for entry in entries:
+        new_messages.extend(entry.get('messages') or [])
+        new_images.extend(entry.get('images') or [])
+    if new_messages:
+        data['messages'] = new_messages[::-1] + data['messages']
+    if new_images:
+        data['images'] = new_images[::-1] + data['images']
+    return entries[-1]['seq'] if entries else None
+
+def load(filepath):
+    """Returns (chat data with the journal replayed, last seq)."""
+    data, journal_seq = read_snapshot(filepath)
+    last_seq = apply_entries(data, read_entries(filepath, journal_seq))
+    return data, last_seq if last_seq is not None else journal_seq
+
+def append(filepath, seq, messages, images):
+    """Appends one turn (items oldest first) to the chat's journal."""
+    line = json.dumps({'seq': seq, 'messages': messages, 'images': images}, ensure_ascii=False, separators=(',', ':'))
+    with open(journal_path(filepath), 'ab+') as f:
+        if f.tell() > 0: # Start a fresh line after a torn last write
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = "\n" + line
+        f.write((line + "\n").encode('utf-8'))
+
+def write_snapshot(filepath, data, journal_seq, mtime=None):
+    """Atomically replaces the snapshot with data, recording that it contains the journal up to journal_seq."""
+    tmp_path = f"{filepath}.tmp"
+    if history_codec.enabled():
+        encoded = json.dumps({**data, SEQ_KEY: journal_seq}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        with open(tmp_path, 'wb') as f:
+            f.write(history_codec.compress(encoded))
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({**data, SEQ_KEY: journal_seq}, f, indent=2)
+    if mtime is not None:
+        os.utime(tmp_path, (mtime, mtime))
+    os.replace(tmp_path, filepath)
+
+def remove_journal(filepath):
+    try:
+        os.remove(journal_path(filepath))
+    except FileNotFoundError:
+        pass
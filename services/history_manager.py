@@ -1,48 +1,268 @@
 import os
-import json
+import time
+import sqlite3
 import logging
+import threading
+from collections import OrderedDict
+import config # Import config variables
 from config import HISTORY_DIR
+from services import history_sqlite, history_index, history_journal, history_codec, chat_search, blob_store
 
-def get_chat_filepath(chat_id):
-    """Constructs the file path for a given chat ID."""
+# Chats are stored either as one JSON file per chat in HISTORY_DIR ("file") or
+# in the SQLite database at HISTORY_DB_PATH ("sqlite", see history_sqlite).
+# HISTORY_BACKEND selects one; the functions below dispatch to it.
+#
+# In the file store, appended turns go to a per-chat journal (history_journal)
+# and a background compactor folds journals into the snapshot once the chat
+# has been idle for HISTORY_COMPACT_IDLE_SECONDS or the journal outgrows
+# HISTORY_COMPACT_MAX_JOURNAL_BYTES. Writes to one chat are serialized by its lock.
+#
+# Every save, append and delete also updates the full-text search index
+# (chat_search); it is synced against the store in the background at startup.
+# Images are kept in the blob store: inline data: URL images become blob URLs
+# on save, and each chat's blob references are recorded for the blob GC. On
+# both stores a chat's references are added, its data written and stale
+# references dropped under the chat's lock, so a slower concurrent write can't
+# drop references the newer stored chat still needs.
+#
+# Loaded chats are kept in an LRU cache of up to HISTORY_CACHE_MAX_BYTES
+# (estimated). An entry is valid while the chat's version stamp is unchanged:
+# the SQLite store's per-chat version counter, or the inode/mtime/size of the
+# file store's snapshot and journal, so writes from other processes are
+# noticed too. Saves and appends update the cache (write-through); deletes drop
+# the entry.
+_chat_locks = {} # chat_id -> threading.Lock
+_chat_locks_lock = threading.Lock()
+_last_seqs = {} # chat_id -> last journal seq written (file store)
+_pending_compaction = {} # chat_id -> monotonic time of the last append
+_compactor_thread = None
+_compactor_stop = threading.Event()
+_chat_cache = OrderedDict() # chat_id -> (version stamp, data, estimated bytes); least recently used first
+_chat_cache_bytes = 0
+_chat_cache_lock = threading.Lock()
+_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+def _use_sqlite():
+    return config.HISTORY_BACKEND == 'sqlite'
+
+def _chat_lock(chat_id):
+    with _chat_locks_lock:
+        return _chat_locks.setdefault(chat_id, threading.Lock())
+
+def validate_chat_id(chat_id):
+    """Returns chat_id if it is safe to use as a file name, else raises ValueError."""
     # Basic sanitization to prevent directory traversal
     safe_chat_id = "".join(c for c in chat_id if c.isalnum() or c in ('-', '_'))
     if not safe_chat_id or safe_chat_id != chat_id: # Ensure original ID was safe
         raise ValueError(f"Invalid chat ID format: {chat_id}")
-    return os.path.join(HISTORY_DIR, f"{safe_chat_id}.json")
+    return safe_chat_id
+
+def get_chat_filepath(chat_id):
+    """Constructs the file path for a given chat ID."""
+    return os.path.join(HISTORY_DIR, f"{validate_chat_id(chat_id)}.json")
+
+def init_store():
+    """Prepares the selected store. The first start on SQLite imports existing JSON chat files."""
+    history_codec.check_setting()
+    if not _use_sqlite():
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+        start_compactor()
+    elif not history_sqlite.has_chats():
+        imported, skipped, failed = history_sqlite.import_json_histories(HISTORY_DIR)
+        if imported or failed:
+            logging.info(f"Imported {imported} JSON chat file(s) into {config.HISTORY_DB_PATH} ({failed} failed).")
+    chat_search.start_sync(get_chat_list, _read_chat_data) # Uncached: don't flush hot chats with cold ones
+    blob_store.start_gc()
+
+# --- Hot-chat cache ---
+def _stat_key(path):
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size) # A new inode catches same-size atomic replaces
+
+def _version_stamp(chat_id):
+    """A value that changes whenever the stored chat does; None if the chat doesn't exist."""
+    if _use_sqlite():
+        return history_sqlite.chat_version(validate_chat_id(chat_id))
+    filepath = get_chat_filepath(chat_id)
+    stamp = (_stat_key(filepath), _stat_key(history_journal.journal_path(filepath)))
+    return stamp if stamp != (None, None) else None
+
+def _estimate_size(messages, images):
+    """Rough in-memory size of chat items: their text plus per-object overhead."""
+    size = 0
+    for message in messages:
+        content = message.get('content') if isinstance(message, dict) else None
+        size += 300 + (len(content) if isinstance(content, str) else 0)
+    return size + sum(100 + (len(image) if isinstance(image, str) else 0) for image in images)
+
+def _copy_chat(data):
+    """A copy whose lists the caller may change (message objects are shared)."""
+    return {**data, 'messages': list(data.get('messages') or []), 'images': list(data.get('images') or [])}
+
+def _cache_discard(chat_id):
+    """Caller holds the cache lock. Returns whether there was an entry."""
+    global _chat_cache_bytes
+    entry = _chat_cache.pop(chat_id, None)
+    if entry is not None:
+        _chat_cache_bytes -= entry[2]
+    return entry is not None
+
+def _cache_store(chat_id, stamp, data, size):
+    """Caller holds the cache lock. data must be private to the cache."""
+    global _chat_cache_bytes
+    _cache_discard(chat_id)
+    if size > config.HISTORY_CACHE_MAX_BYTES // 4: # One huge chat shouldn't flush all the others
+        return
+    _chat_cache[chat_id] = (stamp, data, size)
+    _chat_cache_bytes += size
+    while _chat_cache_bytes > config.HISTORY_CACHE_MAX_BYTES:
+        _, (_, _, evicted_size) = _chat_cache.popitem(last=False)
+        _chat_cache_bytes -= evicted_size
+        _cache_stats['evictions'] += 1
+
+def _cache_get(chat_id, stamp):
+    with _chat_cache_lock:
+        entry = _chat_cache.get(chat_id)
+        if entry is not None and entry[0] == stamp:
+            _chat_cache.move_to_end(chat_id)
+            _cache_stats['hits'] += 1
+            return _copy_chat(entry[1])
+        if entry is not None: # Changed behind our back
+            _cache_discard(chat_id)
+            _cache_stats['invalidations'] += 1
+        _cache_stats['misses'] += 1
+        return None
+
+def _cache_put(chat_id, stamp, data):
+    if stamp is None or config.HISTORY_CACHE_MAX_BYTES <= 0:
+        return
+    data = _copy_chat(data)
+    size = _estimate_size(data['messages'], data['images'])
+    with _chat_cache_lock:
+        _cache_store(chat_id, stamp, data, size)
+
+def _cache_extend(chat_id, old_stamp, new_stamp, messages, images):
+    """Write-through for an append (items oldest first): extends the cached chat if it was current
+    before the append, else drops it."""
+    with _chat_cache_lock:
+        entry = _chat_cache.get(chat_id)
+        if entry is None:
+            return
+        stamp, data, size = entry
+        if stamp != old_stamp or new_stamp is None:
+            _cache_discard(chat_id)
+            _cache_stats['invalidations'] += 1
+            return
+        data = {**data, 'messages': messages[::-1] + data['messages'], 'images': images[::-1] + data['images']}
+        _cache_store(chat_id, new_stamp, data, size + _estimate_size(messages, images))
+
+def _cache_invalidate(chat_id):
+    with _chat_cache_lock:
+        if _cache_discard(chat_id):
+            _cache_stats['invalidations'] += 1
+
+def get_chat_cache_stats():
+    with _chat_cache_lock:
+        stats = dict(_cache_stats, entries=len(_chat_cache), bytes=_chat_cache_bytes, max_bytes=config.HISTORY_CACHE_MAX_BYTES)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else None
+    return stats
 
 def load_chat_data(chat_id):
-    """Loads chat history (messages and images) from its JSON file."""
+    """Loads chat history (messages and images), from the hot-chat cache when it is current."""
+    stamp = _version_stamp(chat_id) # Taken before reading: a write racing the read only leaves a stale stamp
+    if stamp is not None:
+        cached = _cache_get(chat_id, stamp)
+        if cached is not None:
+            return cached
+    data = _read_chat_data(chat_id)
+    _cache_put(chat_id, stamp, data)
+    return data
+
+def _read_chat_data(chat_id):
+    """Loads chat history (messages and images) from the selected store."""
+    if _use_sqlite():
+        return history_sqlite.load_chat_data(validate_chat_id(chat_id))
     try:
         filepath = get_chat_filepath(chat_id)
-        if os.path.exists(filepath):
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # Ensure default structure if keys are missing
-                    if 'messages' not in data: data['messages'] = []
-                    if 'images' not in data: data['images'] = []
-                    return data
-            except (json.JSONDecodeError, IOError) as e:
-                logging.error(f"Error loading chat file {filepath}: {e}")
-                return {'messages': [], 'images': []} # Return empty structure on error
-        else:
-            logging.info(f"Chat file not found for {chat_id}, returning empty structure.")
-            return {'messages': [], 'images': []} # Return empty if file doesn't exist
     except ValueError as e: # Catch invalid chat ID from get_chat_filepath
         logging.error(f"Error getting chat filepath: {e}")
         raise # Re-raise validation error
+    if not os.path.exists(filepath) and not os.path.exists(history_journal.journal_path(filepath)):
+        logging.info(f"Chat file not found for {chat_id}, returning empty structure.")
+        return {'messages': [], 'images': []} # Return empty if file doesn't exist
+    try:
+        data, _ = history_journal.load(filepath) # Snapshot plus journaled turns
+        return data
+    except (ValueError, IOError) as e:
+        logging.error(f"Error loading chat file {filepath}: {e}")
+        return {'messages': [], 'images': []} # Return empty structure on error
+
+def load_chat_page(chat_id, before=None, limit=50):
+    """Loads one page of a chat's messages, newest first: the `limit` messages older than message seq
+    `before` (seqs count from the oldest message), or the newest ones when before is None.
+    Returns (data, next_cursor, message_count); data has all images on the first page only,
+    and next_cursor is the `before` for the next older page (None when there is none)."""
+    if _use_sqlite():
+        return history_sqlite.load_chat_page(validate_chat_id(chat_id), before, limit)
+    data = load_chat_data(chat_id) # The file store keeps whole chats (parsed or cached); only the response is paged
+    messages = data['messages']
+    total = len(messages)
+    start = 0 if before is None else max(total - before, 0)
+    data['messages'] = messages[start:start + limit]
+    if before is not None:
+        data.pop('images', None)
+    oldest_seq = total - start - len(data['messages'])
+    return data, oldest_seq if data['messages'] and oldest_seq > 0 else None, total
+
+def _last_seq(chat_id, filepath):
+    """Caller holds the chat lock. Last journal seq of a chat (read from disk once per process)."""
+    if chat_id not in _last_seqs:
+        _last_seqs[chat_id] = history_journal.load(filepath)[1]
+    return _last_seqs[chat_id]
+
+def _retain_blob_refs(chat_id, images):
+    """After a chat was written: drops references to blobs it no longer uses (failures only delay their GC)."""
+    try:
+        blob_store.retain_refs(chat_id, images)
+    except sqlite3.Error as e:
+        logging.warning(f"Could not update blob references of chat {chat_id}: {e}")
 
 def save_chat_data(chat_id, data):
-    """Saves chat history (messages and images) to its JSON file."""
+    """Saves chat history (messages and images) to the selected store."""
+    data['images'] = blob_store.externalize_images(data.get('images') or [])
+    if _use_sqlite():
+        try:
+            with _chat_lock(validate_chat_id(chat_id)):
+                # Reference the chat's blobs before writing it, so the blob GC can't remove them in between
+                blob_store.add_refs(chat_id, data['images'])
+                version = history_sqlite.save_chat_data(chat_id, data)
+                _cache_put(chat_id, version, data)
+                chat_search.index_chat(chat_id, data.get('messages') or [])
+                _retain_blob_refs(chat_id, data['images'])
+            return
+        except (sqlite3.Error, TypeError) as e:
+            logging.error(f"Error saving chat {chat_id} to {config.HISTORY_DB_PATH}: {e}")
+            raise # Re-raise to signal failure
     try:
         os.makedirs(HISTORY_DIR, exist_ok=True)
         filepath = get_chat_filepath(chat_id)
         # Ensure data has the correct keys before saving
         if 'messages' not in data: data['messages'] = []
         if 'images' not in data: data['images'] = []
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2)
+        with _chat_lock(chat_id):
+            blob_store.add_refs(chat_id, data['images'])
+            # The full chat supersedes every journaled turn so far
+            history_journal.write_snapshot(filepath, data, _last_seq(chat_id, filepath))
+            history_journal.remove_journal(filepath)
+            _pending_compaction.pop(chat_id, None)
+            history_index.record_save(chat_id, data['messages'], filepath)
+            _cache_put(chat_id, _version_stamp(chat_id), data)
+            chat_search.index_chat(chat_id, data['messages'])
+            _retain_blob_refs(chat_id, data['images'])
         logging.debug(f"Saved chat data for {chat_id} to {filepath}")
     except (IOError, TypeError) as e:
         logging.error(f"Error saving chat file {filepath}: {e}")
@@ -52,53 +272,148 @@ def save_chat_data(chat_id, data):
         raise
 
 def delete_chat_file(chat_id):
-    """Deletes the JSON file associated with a chat ID."""
+    """Deletes the stored history of a chat ID."""
+    if _use_sqlite():
+        try:
+            with _chat_lock(validate_chat_id(chat_id)):
+                deleted = history_sqlite.delete_chat(chat_id)
+                _cache_invalidate(chat_id)
+                chat_search.remove_chat(chat_id)
+                _retain_blob_refs(chat_id, []) # The chat no longer references any blob
+            if deleted:
+                logging.info(f"Deleted chat history {chat_id} from {config.HISTORY_DB_PATH}")
+            else:
+                logging.warning(f"Attempted to delete non-existent chat: {chat_id}")
+            return deleted
+        except (sqlite3.Error, ValueError) as e:
+            logging.error(f"Error deleting chat {chat_id}: {e}")
+            return False # Indicate failure
     try:
         filepath = get_chat_filepath(chat_id)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            logging.info(f"Deleted chat history file: {filepath}")
-            return True
-        else:
-            logging.warning(f"Attempted to delete non-existent chat file: {filepath}")
-            return False
+        with _chat_lock(chat_id):
+            had_journal = os.path.exists(history_journal.journal_path(filepath))
+            history_journal.remove_journal(filepath)
+            _pending_compaction.pop(chat_id, None)
+            _last_seqs.pop(chat_id, None)
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            elif not had_journal:
+                logging.warning(f"Attempted to delete non-existent chat file: {filepath}")
+                return False
+            history_index.record_delete(chat_id)
+            _cache_invalidate(chat_id)
+            chat_search.remove_chat(chat_id)
+            _retain_blob_refs(chat_id, []) # The chat no longer references any blob
+        logging.info(f"Deleted chat history file: {filepath}")
+        return True
     except (IOError, ValueError, OSError) as e:
         logging.error(f"Error deleting chat file for {chat_id}: {e}")
         return False # Indicate failure
 
-def get_chat_list():
-    """Lists available chat IDs and names based on stored files."""
-    chat_list_data = []
-    if not os.path.exists(HISTORY_DIR):
-        return chat_list_data # Return empty list if directory doesn't exist
-
+def append_chat_items(chat_id, messages=None, images=None):
+    """Appends messages and/or images (each list oldest first) as the newest entries of a chat,
+    without rewriting what is already stored. Creates the chat if needed."""
+    messages, images = list(messages or []), blob_store.externalize_images(images or [])
+    if _use_sqlite():
+        try:
+            with _chat_lock(validate_chat_id(chat_id)):
+                blob_store.add_refs(chat_id, images) # Under the lock: a concurrent save's retain_refs can't drop them
+                version = history_sqlite.append_chat_items(chat_id, messages, images)
+                _cache_extend(chat_id, version - 1, version, messages, images)
+                chat_search.index_appended(chat_id, messages)
+            return
+        except (sqlite3.Error, TypeError) as e:
+            logging.error(f"Error appending to chat {chat_id} in {config.HISTORY_DB_PATH}: {e}")
+            raise # Re-raise to signal failure
     try:
-        # Sort files by modification time, newest first
-        files = sorted(
-            [os.path.join(HISTORY_DIR, f) for f in os.listdir(HISTORY_DIR) if f.endswith(".json")],
-            key=os.path.getmtime,
-            reverse=True
-        )
-        for filepath in files:
-            filename = os.path.basename(filepath)
-            chat_id = filename[:-5] # Remove .json extension
-            name = None
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+        filepath = get_chat_filepath(chat_id)
+        with _chat_lock(chat_id):
+            blob_store.add_refs(chat_id, images)
+            old_stamp = _version_stamp(chat_id)
+            seq = _last_seq(chat_id, filepath)
+            if not os.path.exists(filepath): # Listings and the index look for the snapshot
+                history_journal.write_snapshot(filepath, {'messages': [], 'images': []}, seq)
+            history_journal.append(filepath, seq + 1, messages, images)
+            _last_seqs[chat_id] = seq + 1
+            _pending_compaction[chat_id] = time.monotonic()
+            history_index.record_append(chat_id, messages, filepath)
+            _cache_extend(chat_id, old_stamp, _version_stamp(chat_id), messages, images)
+            chat_search.index_appended(chat_id, messages)
+        logging.debug(f"Appended {len(messages)} message(s) and {len(images)} image(s) to chat {chat_id}")
+    except (IOError, TypeError) as e:
+        logging.error(f"Error appending to chat {chat_id}: {e}")
+        raise # Re-raise to signal failure
+
+def compact_chat(chat_id):
+    """Folds a file-store chat's journal into its snapshot."""
+    filepath = get_chat_filepath(chat_id)
+    journal_path = history_journal.journal_path(filepath)
+    with _chat_lock(chat_id):
+        _pending_compaction.pop(chat_id, None)
+        try:
+            last_append = os.path.getmtime(journal_path)
+        except FileNotFoundError:
+            return
+        data, last_seq = history_journal.load(filepath)
+        # Keep the last append time as the chat's modification time (the list is ordered by it)
+        history_journal.write_snapshot(filepath, data, last_seq, mtime=last_append)
+        history_journal.remove_journal(filepath)
+        _last_seqs[chat_id] = last_seq
+        history_index.record_save(chat_id, data['messages'], filepath)
+        _cache_put(chat_id, _version_stamp(chat_id), data) # Same content, new file
+    logging.debug(f"Compacted journal of chat {chat_id} (up to seq {last_seq})")
+
+def _compact_due():
+    now = time.monotonic()
+    for chat_id, appended_at in list(_pending_compaction.items()):
+        try:
+            journal_bytes = os.path.getsize(history_journal.journal_path(get_chat_filepath(chat_id)))
+        except OSError:
+            journal_bytes = 0
+        if now - appended_at >= config.HISTORY_COMPACT_IDLE_SECONDS or journal_bytes >= config.HISTORY_COMPACT_MAX_JOURNAL_BYTES:
             try:
-                # Attempt to read the first user message as a name hint
-                with open(filepath, 'r', encoding='utf-8') as f_read:
-                    data = json.load(f_read)
-                    messages = data.get('messages', [])
-                    # Find the *oldest* user message (last in list)
-                    oldest_user_msg = next((msg['content'] for msg in reversed(messages) if msg.get('role') == 'user'), None)
-                    if oldest_user_msg:
-                         name = " ".join(oldest_user_msg.split()[:4]) # First 4 words
-                         if len(oldest_user_msg) > len(name) + 3: name += "..." # Add ellipsis
-            except Exception as e_name:
-                logging.warning(f"Could not read name hint for {chat_id}: {e_name}")
-            # Fallback name
-            chat_list_data.append({"id": chat_id, "name": name or f"Chat {chat_id.split('-')[-1]}"})
-        return chat_list_data
+                compact_chat(chat_id)
+            except (OSError, ValueError, TypeError) as e:
+                logging.error(f"Error compacting chat {chat_id}: {e}")
+
+def _run_compactor():
+    try: # Journals left over from the last run
+        for filename in os.listdir(HISTORY_DIR):
+            if filename.endswith(history_journal.JOURNAL_SUFFIX):
+                _pending_compaction.setdefault(filename[:-len(history_journal.JOURNAL_SUFFIX)], 0)
+    except OSError as e:
+        logging.warning(f"Could not scan {HISTORY_DIR} for chat journals: {e}")
+    while not _compactor_stop.wait(config.HISTORY_COMPACT_INTERVAL):
+        _compact_due()
+
+def start_compactor():
+    """Starts the file store's background journal compactor (no-op if already running)."""
+    global _compactor_thread
+    if _compactor_thread is not None and _compactor_thread.is_alive():
+        return
+    _compactor_stop.clear()
+    _compactor_thread = threading.Thread(target=_run_compactor, name="history-compactor", daemon=True)
+    _compactor_thread.start()
+
+def stop_compactor():
+    _compactor_stop.set()
+
+def get_chat_page(limit=None, cursor=None):
+    """Lists chats newest first as (chats, next_cursor); each chat has id, name, updated_at,
+    message_count and size. Pass next_cursor back to get the following page (None when done)."""
+    if _use_sqlite():
+        try:
+            return history_sqlite.list_chats(limit, cursor)
+        except sqlite3.Error as e:
+            logging.error(f"Error listing chats in {config.HISTORY_DB_PATH}: {e}")
+            raise OSError(f"Could not list chat histories: {e}")
+    try:
+        return history_index.list_chats(limit, cursor) # Maintained on save/delete instead of parsing every file
     except OSError as e:
         logging.error(f"Error listing chat directory {HISTORY_DIR}: {e}")
-        # Re-raise or return empty list? Let's re-raise to signal a potentially bigger issue.
-        raise OSError(f"Could not list chat histories: {e}")
\ No newline at end of file
+        raise OSError(f"Could not list chat histories: {e}")
+
+def get_chat_list():
+    """Lists available chat IDs and names, most recently saved first."""
+    return get_chat_page()[0]
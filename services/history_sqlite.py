@@ -0,0 +1,368 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import config # Import config variables
+from services import history_journal, history_codec, blob_store
+from services.history_index import chat_name, display_name, encode_cursor, decode_cursor
+
+# SQLite chat history store (HISTORY_BACKEND=sqlite), in WAL mode so reads never
+# wait for a save. Messages and images are one row each, keyed by (chat_id, seq)
+# with seq counting from the oldest entry, so the API's newest-first lists map
+# to rows in reverse. A save compares the incoming lists with the stored rows
+# and only rewrites from the first difference: appending a message is one
+# INSERT and a regenerated reply replaces just the tail. Every save runs in one
+# transaction, so a crash leaves either the old or the new chat, never a torn file.
+#
+# The stored side of that comparison comes from _saved_rows, the decoded rows of
+# recently saved chats, valid while the chat's version column is unchanged
+# (another process saving bumps it too). Only on a miss are the rows read back
+# from the database and decoded.
+#
+# Rows whose JSON is at least HISTORY_COMPRESS_MIN_BYTES are stored as
+# compressed BLOBs (history_codec); small rows wouldn't shrink enough to pay for it.
+_local = threading.local() # One connection per thread (sqlite3 connections aren't shared across threads)
+_schema_lock = threading.Lock()
+_schema_ready = set() # DB paths whose schema has been created in this process
+_saved_rows = OrderedDict() # (db path, chat_id) -> (version, {table: decoded rows, oldest first}); private copies
+_saved_rows_lock = threading.Lock()
+_SAVED_ROWS_MAX_CHATS = 16
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    extra TEXT, -- Other top-level keys of the saved chat object, as JSON
+    version INTEGER NOT NULL DEFAULT 1, -- Incremented by every save
+    message_count INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0, -- Bytes of stored message and image data
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT,
+    data TEXT NOT NULL, -- The message object as JSON (a compressed BLOB when large)
+    PRIMARY KEY (chat_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS images (
+    chat_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL, -- The image entry (usually a URL) as JSON (a compressed BLOB when large)
+    PRIMARY KEY (chat_id, seq)
+) WITHOUT ROWID;
+"""
+
+# Applied after _SCHEMA, for databases created before the columns they need existed
+_UPGRADES = (
+    ('message_count', """ALTER TABLE chats ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0;
+                         ALTER TABLE chats ADD COLUMN size INTEGER NOT NULL DEFAULT 0;
+                         UPDATE chats SET
+                             message_count = (SELECT COUNT(*) FROM messages WHERE chat_id = chats.id),
+                             size = (SELECT COALESCE(SUM(length(CAST(data AS BLOB))), 0) FROM messages WHERE chat_id = chats.id)
+                                  + (SELECT COALESCE(SUM(length(CAST(data AS BLOB))), 0) FROM images WHERE chat_id = chats.id);"""),
+)
+_INDEXES = """
+DROP INDEX IF EXISTS chats_updated_at;
+CREATE INDEX IF NOT EXISTS chats_updated_at_id ON chats (updated_at DESC, id); -- /api/chats order and cursor
+"""
+
+def _connect():
+    """Returns this thread's connection to HISTORY_DB_PATH, creating the schema on first use."""
+    db_path = config.HISTORY_DB_PATH
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'path', None) == db_path:
+        return conn
+    if conn is not None:
+        conn.close()
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None) # Autocommit; transactions are explicit
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL") # Durable at checkpoints; WAL keeps the DB consistent either way
+    with _schema_lock:
+        if db_path not in _schema_ready:
+            conn.executescript(_SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(chats)")}
+            for column, script in _UPGRADES:
+                if column not in columns:
+                    conn.executescript(f"BEGIN; {script} COMMIT;")
+            conn.executescript(_INDEXES)
+            _schema_ready.add(db_path)
+    _local.conn, _local.path = conn, db_path
+    return conn
+
+@contextmanager
+def _transaction(conn):
+    conn.execute("BEGIN IMMEDIATE") # Take the write lock up front instead of failing to upgrade mid-save
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+_encode = _encoder.encode
+
+def _stored_value(data):
+    """Row value for a JSON encoding: compressed bytes if it is large and compresses, else the text."""
+    if len(data) >= config.HISTORY_COMPRESS_MIN_BYTES and history_codec.enabled():
+        raw = data.encode('utf-8')
+        packed = history_codec.compress(raw)
+        if len(packed) < len(raw):
+            return packed
+    return data
+
+def _value_size(value):
+    return len(value) if isinstance(value, bytes) else len(value.encode('utf-8'))
+
+def _decode(value):
+    return json.loads(history_codec.decompress(value) if isinstance(value, bytes) else value)
+
+def _sync_rows(conn, table, chat_id, items, stored):
+    """Makes table's rows for chat_id hold items (oldest first), rewriting only from the first row
+    that differs from stored (the decoded current rows). Returns (new decoded rows, change in stored bytes)."""
+    keep = 0
+    for stored_item, item in zip(stored, items):
+        if stored_item != item:
+            break
+        keep += 1
+    size_delta = 0
+    if keep < len(stored):
+        size_delta -= conn.execute(f"SELECT COALESCE(SUM(length(CAST(data AS BLOB))), 0) FROM {table} WHERE chat_id = ? AND seq >= ?",
+                                   (chat_id, keep)).fetchone()[0]
+        conn.execute(f"DELETE FROM {table} WHERE chat_id = ? AND seq >= ?", (chat_id, keep))
+    encoded, added_bytes = _insert_rows(conn, table, chat_id, keep, items[keep:])
+    size_delta += added_bytes
+    # Decode what was written rather than keeping the caller's objects, which it may still mutate
+    return stored[:keep] + [json.loads(data) for data in encoded], size_delta
+
+def _insert_rows(conn, table, chat_id, first_seq, items):
+    """Inserts items (oldest first) from seq first_seq on. Returns (their JSON encodings, bytes stored)."""
+    encoded = [_encode(item) for item in items]
+    values = [_stored_value(data) for data in encoded]
+    if table == 'messages':
+        conn.executemany("INSERT INTO messages (chat_id, seq, role, data) VALUES (?, ?, ?, ?)",
+                         ((chat_id, first_seq + i, item.get('role') if isinstance(item, dict) else None, value)
+                          for i, (item, value) in enumerate(zip(items, values))))
+    else:
+        conn.executemany(f"INSERT INTO {table} (chat_id, seq, data) VALUES (?, ?, ?)",
+                         ((chat_id, first_seq + i, value) for i, value in enumerate(values)))
+    return encoded, sum(_value_size(value) for value in values)
+
+def _stored_rows(conn, chat_id, version):
+    """Decoded current rows of a chat (from _saved_rows when its version matches)."""
+    key = (config.HISTORY_DB_PATH, chat_id)
+    with _saved_rows_lock:
+        cached = _saved_rows.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    return {table: [_decode(row[0]) for row in conn.execute(f"SELECT data FROM {table} WHERE chat_id = ? ORDER BY seq", (chat_id,))]
+            for table in ('messages', 'images')}
+
+def _remember_rows(chat_id, version, rows):
+    key = (config.HISTORY_DB_PATH, chat_id)
+    with _saved_rows_lock:
+        _saved_rows[key] = (version, rows)
+        _saved_rows.move_to_end(key)
+        while len(_saved_rows) > _SAVED_ROWS_MAX_CHATS:
+            _saved_rows.popitem(last=False)
+
+def _forget_rows(chat_id):
+    with _saved_rows_lock:
+        _saved_rows.pop((config.HISTORY_DB_PATH, chat_id), None)
+
+def load_chat_data(chat_id):
+    """Loads a chat as {'messages': [...], 'images': [...], ...} (lists newest first); empty if unknown."""
+    conn = _connect()
+    conn.execute("BEGIN") # One snapshot for all three reads
+    try:
+        chat = conn.execute("SELECT extra FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        messages = conn.execute("SELECT data FROM messages WHERE chat_id = ? ORDER BY seq DESC", (chat_id,)).fetchall()
+        images = conn.execute("SELECT data FROM images WHERE chat_id = ? ORDER BY seq DESC", (chat_id,)).fetchall()
+    finally:
+        conn.execute("COMMIT")
+    if chat is None:
+        logging.info(f"Chat {chat_id} not found in history database, returning empty structure.")
+        return {'messages': [], 'images': []}
+    data = json.loads(chat[0]) if chat[0] else {}
+    data['messages'] = [_decode(row[0]) for row in messages]
+    data['images'] = [_decode(row[0]) for row in images]
+    return data
+
+def load_chat_page(chat_id, before=None, limit=50):
+    """Loads the newest `limit` messages older than seq `before` (all images only on the first page,
+    before=None). Returns (data, next_cursor, message_count); next_cursor is the `before` for the
+    next older page, None when there are no older messages."""
+    conn = _connect()
+    conn.execute("BEGIN")
+    try:
+        chat = conn.execute("SELECT extra, message_count FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        query, params = "SELECT seq, data FROM messages WHERE chat_id = ?", [chat_id]
+        if before is not None:
+            query += " AND seq < ?"
+            params.append(before)
+        messages = conn.execute(query + " ORDER BY seq DESC LIMIT ?", params + [limit + 1]).fetchall()
+        images = conn.execute("SELECT data FROM images WHERE chat_id = ? ORDER BY seq DESC", (chat_id,)).fetchall() if before is None else None
+    finally:
+        conn.execute("COMMIT")
+    if chat is None:
+        return {'messages': [], 'images': []}, None, 0
+    data = json.loads(chat[0]) if chat[0] else {}
+    data['messages'] = [_decode(row[1]) for row in messages[:limit]]
+    if images is not None:
+        data['images'] = [_decode(row[0]) for row in images]
+    next_cursor = messages[limit - 1][0] if len(messages) > limit else None
+    return data, next_cursor, chat[1]
+
+def save_chat_data(chat_id, data, updated_at=None):
+    """Saves a chat in one transaction, writing only the rows that changed since the last save.
+    Returns the chat's new version."""
+    messages = data.get('messages') or []
+    images = data.get('images') or []
+    extra = {k: v for k, v in data.items() if k not in ('messages', 'images')}
+    now = updated_at or time.time()
+
+    conn = _connect()
+    try:
+        with _transaction(conn):
+            row = conn.execute("SELECT version, size FROM chats WHERE id = ?", (chat_id,)).fetchone()
+            version, size = row if row else (0, 0)
+            stored = _stored_rows(conn, chat_id, version)
+            rows = {}
+            for table, items in (('messages', messages), ('images', images)):
+                rows[table], size_delta = _sync_rows(conn, table, chat_id, items[::-1], stored[table]) # Stored oldest first
+                size += size_delta
+            conn.execute("""INSERT INTO chats (id, name, extra, version, message_count, size, created_at, updated_at)
+                            VALUES (?, ?, ?, 1, ?, ?, ?, ?)
+                            ON CONFLICT (id) DO UPDATE SET name = excluded.name, extra = excluded.extra, version = version + 1,
+                                                           message_count = excluded.message_count, size = excluded.size,
+                                                           updated_at = excluded.updated_at""",
+                         (chat_id, chat_name(messages), _encode(extra) if extra else None, len(messages), size, now, now))
+    except BaseException:
+        _forget_rows(chat_id)
+        raise
+    _remember_rows(chat_id, version + 1, rows)
+    logging.debug(f"Saved chat data for {chat_id} to {config.HISTORY_DB_PATH}")
+    return version + 1
+
+def append_chat_items(chat_id, messages, images):
+    """Appends items (each list oldest first) after a chat's newest rows, creating the chat if needed.
+    Returns the chat's new version."""
+    now = time.time()
+    conn = _connect()
+    try:
+        with _transaction(conn):
+            row = conn.execute("SELECT version FROM chats WHERE id = ?", (chat_id,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO chats (id, version, created_at, updated_at) VALUES (?, 0, ?, ?)", (chat_id, now, now))
+            version = row[0] if row else 0
+            added_bytes = 0
+            appended = {}
+            for table, items in (('messages', messages), ('images', images)):
+                if not items:
+                    continue
+                next_seq = conn.execute(f"SELECT COALESCE(MAX(seq) + 1, 0) FROM {table} WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+                encoded, stored_bytes = _insert_rows(conn, table, chat_id, next_seq, items)
+                added_bytes += stored_bytes
+                appended[table] = [json.loads(data) for data in encoded]
+            conn.execute("""UPDATE chats SET version = version + 1, message_count = message_count + ?, size = size + ?,
+                                             name = COALESCE(name, ?), updated_at = ? WHERE id = ?""",
+                         (len(messages), added_bytes, chat_name(messages[::-1]), now, chat_id))
+    except BaseException:
+        _forget_rows(chat_id)
+        raise
+    key = (config.HISTORY_DB_PATH, chat_id)
+    with _saved_rows_lock: # Extend the remembered rows rather than dropping them
+        cached = _saved_rows.get(key)
+        if cached is not None and cached[0] == version:
+            rows = {table: cached[1][table] + appended.get(table, []) for table in ('messages', 'images')}
+            _saved_rows[key] = (version + 1, rows)
+    return version + 1
+
+def chat_version(chat_id):
+    """The chat's version (incremented by every save and append, from any process), or None if it doesn't exist."""
+    row = _connect().execute("SELECT version FROM chats WHERE id = ?", (chat_id,)).fetchone()
+    return row[0] if row else None
+
+def delete_chat(chat_id):
+    """Deletes a chat and its rows. Returns False if it didn't exist."""
+    conn = _connect()
+    _forget_rows(chat_id)
+    with _transaction(conn):
+        deleted = conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,)).rowcount
+        conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        conn.execute("DELETE FROM images WHERE chat_id = ?", (chat_id,))
+    return deleted > 0
+
+def list_chats(limit=None, cursor=None):
+    """Returns (chats, next_cursor), most recently updated first; next_cursor is None on the last page."""
+    query = "SELECT id, name, updated_at, message_count, size FROM chats"
+    params = []
+    if cursor:
+        updated_at, chat_id = decode_cursor(cursor)
+        query += " WHERE updated_at < ? OR (updated_at = ? AND id > ?)" # Keyset: rows after the cursor in list order
+        params += [updated_at, updated_at, chat_id]
+    query += " ORDER BY updated_at DESC, id"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit + 1) # One extra row tells whether another page follows
+    rows = _connect().execute(query, params).fetchall()
+    has_more = bool(limit) and len(rows) > limit
+    rows = rows[:limit] if limit else rows
+    chats = [{'id': chat_id, 'name': display_name(chat_id, name), 'updated_at': updated_at, 'message_count': message_count, 'size': size}
+             for chat_id, name, updated_at, message_count, size in rows]
+    next_cursor = encode_cursor(chats[-1]['updated_at'], chats[-1]['id']) if has_more else None
+    return chats, next_cursor
+
+def has_chats():
+    return _connect().execute("SELECT 1 FROM chats LIMIT 1").fetchone() is not None
+
+def import_json_histories(history_dir, overwrite=False):
+    """Copies <history_dir>/<id>.json chats into the database, keeping their modification times.
+
+    Chats already in the database are skipped unless overwrite is set. Returns
+    (imported, skipped, failed) counts. The JSON files are left in place.
+    """
+    imported = skipped = failed = 0
+    if not os.path.isdir(history_dir):
+        return imported, skipped, failed
+    conn = _connect()
+    for filename in sorted(os.listdir(history_dir)):
+        if not filename.endswith(".json") or filename.startswith("."): # Skips the file store's .index.json
+            continue
+        chat_id = filename[:-5]
+        filepath = os.path.join(history_dir, filename)
+        if not overwrite and conn.execute("SELECT 1 FROM chats WHERE id = ?", (chat_id,)).fetchone():
+            skipped += 1
+            continue
+        try:
+            data, _ = history_journal.load(filepath) # Includes turns still in the chat's journal
+            # Same blob handling as history_manager.save_chat_data: inline images become blobs, referenced before the write
+            data['images'] = blob_store.externalize_images(data.get('images') or [])
+            blob_store.add_refs(chat_id, data['images'])
+            save_chat_data(chat_id, data, updated_at=os.path.getmtime(filepath))
+            blob_store.retain_refs(chat_id, data['images'])
+            imported += 1
+        except (OSError, ValueError, TypeError, sqlite3.Error) as e:
+            logging.error(f"Could not import chat file {filepath}: {e}")
+            failed += 1
+    return imported, skipped, failed
+
+if __name__ == '__main__':
+    # Migration tool: python -m services.history_sqlite [--dir chat_histories] [--db chat_histories/history.db] [--overwrite]
+    import argparse
+    parser = argparse.ArgumentParser(description="Imports one-JSON-file-per-chat histories into the SQLite history store.")
+    parser.add_argument('--dir', default=config.HISTORY_DIR, help="Directory with <chat_id>.json files")
+    parser.add_argument('--db', default=config.HISTORY_DB_PATH, help="SQLite database to import into")
+    parser.add_argument('--overwrite', action='store_true', help="Replace chats that already exist in the database")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    config.HISTORY_DB_PATH = args.db
+    imported, skipped, failed = import_json_histories(args.dir, overwrite=args.overwrite)
+    print(f"Imported {imported} chat(s) into {args.db}; skipped {skipped} already present; {failed} failed.")
@@ -0,0 +1,154 @@
+import logging
+import threading
+import http.cookiejar
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import config # Import config variables
+from services import cancellation
+
+# Known cloud provider hosts -> backend name (used to pick pool sizes)
+CLOUD_PROVIDER_HOSTS = {
+    'api.groq.com': 'groq',
+    'api.openai.com': 'openai',
+    'api.anthropic.com': 'anthropic',
+    'generativelanguage.googleapis.com': 'google',
+    'api.x.ai': 'xai',
+}
+
+_sessions = {} # (scheme, netloc) -> requests.Session
+_session_backends = {} # (scheme, netloc) -> backend name
+_request_counts = {} # (scheme, netloc) -> {'requests': int, 'errors': int}
+_pool_lock = threading.Lock()
+
+class _CancellablePoolMixin:
+    """Registers each checked-out connection with the thread's bound CancelHandle.
+
+    Setting the handle shuts the socket down, so a request blocked waiting for a
+    slow generation (or reading a stream) fails immediately instead of running
+    until its timeout. The registration is dropped when the connection returns.
+    """
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout=timeout)
+        handle = cancellation.current_handle()
+        if handle is not None:
+            conn._cancel_registration = (handle, handle.add_callback(lambda: cancellation.abort_connection(conn)))
+        return conn
+
+    def _put_conn(self, conn):
+        registration = getattr(conn, '_cancel_registration', None)
+        if registration is not None:
+            conn._cancel_registration = None
+            registration[0].remove_callback(registration[1])
+        super()._put_conn(conn)
+
+class CancellableHTTPConnectionPool(_CancellablePoolMixin, HTTPConnectionPool):
+    pass
+
+class CancellableHTTPSConnectionPool(_CancellablePoolMixin, HTTPSConnectionPool):
+    pass
+
+class CancellableHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CancellableHTTPConnectionPool, 'https': CancellableHTTPSConnectionPool}
+
+def _pool_key(url):
+    parts = urlsplit(url)
+    return (parts.scheme.lower(), parts.netloc.lower())
+
+def resolve_backend_for_url(url):
+    """Maps a request URL to the backend whose pool settings should apply."""
+    scheme, netloc = _pool_key(url)
+    host = netloc.rsplit('@', 1)[-1].split(':', 1)[0]
+    if host in CLOUD_PROVIDER_HOSTS:
+        return CLOUD_PROVIDER_HOSTS[host]
+    # Local/configurable endpoints are matched against the current config values
+    configured = (
+        ('ollama', config.OLLAMA_API),
+        ('kobold', config.KOBOLD_API),
+        ('comfyui', config.COMFYUI_API_BASE),
+        ('custom_external', config.CUSTOM_API_ENDPOINT),
+    )
+    for backend, base_url in configured:
+        if base_url and _pool_key(base_url) == (scheme, netloc):
+            return backend
+    return 'default'
+
+def get_session(url):
+    """Returns the keep-alive session for the URL's host, creating it on first use."""
+    key = _pool_key(url)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+
+    with _pool_lock:
+        session = _sessions.get(key)
+        if session is None:
+            backend = resolve_backend_for_url(url)
+            pool_size = config.HTTP_POOL_SIZES.get(backend, config.HTTP_POOL_DEFAULT_SIZE)
+            adapter = CancellableHTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+            session = requests.Session()
+            # Shared by every user's upstream calls: never store or send provider cookies
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+            _session_backends[key] = backend
+            _request_counts[key] = {'requests': 0, 'errors': 0}
+            logging.info(f"Created HTTP connection pool for {key[0]}://{key[1]} (backend={backend}, maxsize={pool_size})")
+    return session
+
+def record_request(url, error=False):
+    """Counts a request (and optionally an error) against the URL's pool."""
+    counts = _request_counts.get(_pool_key(url))
+    if counts is None:
+        return
+    with _pool_lock:
+        counts['requests'] += 1
+        if error:
+            counts['errors'] += 1
+
+def get_pool_stats():
+    """Returns per-host pool statistics (requests vs. connections actually opened)."""
+    stats = []
+    with _pool_lock:
+        items = list(_sessions.items())
+    for key, session in items:
+        adapter = session.get_adapter(f"{key[0]}://{key[1]}")
+        connections_opened = 0
+        idle_connections = 0
+        pool_manager = getattr(adapter, 'poolmanager', None)
+        if pool_manager is not None:
+            for pool_key in list(pool_manager.pools.keys()):
+                conn_pool = pool_manager.pools.get(pool_key)
+                if conn_pool is None:
+                    continue
+                connections_opened += getattr(conn_pool, 'num_connections', 0)
+                if getattr(conn_pool, 'pool', None) is not None:
+                    idle_connections += conn_pool.pool.qsize()
+        counts = _request_counts.get(key, {})
+        stats.append({
+            'host': f"{key[0]}://{key[1]}",
+            'backend': _session_backends.get(key),
+            'pool_maxsize': getattr(adapter, '_pool_maxsize', None),
+            'requests': counts.get('requests', 0),
+            'errors': counts.get('errors', 0),
+            'connections_opened': connections_opened,
+            'idle_connections': idle_connections,
+        })
+    return stats
+
+def close_all_sessions():
+    """Closes every pooled session (after endpoints change, and at exit)."""
+    with _pool_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+        _session_backends.clear()
+        _request_counts.clear()
+    for session in sessions:
+        try:
+            session.close()
+        except Exception as e:
+            logging.warning(f"Error closing pooled HTTP session: {e}")
@@ -3,182 +3,502 @@ import requests
 import json
 from utils import make_request_with_retry
 import config # Import config variables
+from services.context_manager import fit_history
+from services.stream_parsers import StreamDecoder, iter_response_chunks
+from services.retry_policy import RequestCancelled
+from services import ollama_residency, conversation_state
 
 # --- Helper Functions ---
 def format_kobold_prompt(prompt, history):
-    """Formats prompt and history for Kobold."""
+    """Formats prompt and (already budgeted) history for Kobold."""
     logging.debug("Formatting prompt for Kobold...")
     ai_trigger_phrase = "Assistant:"
     formatted_lines = []
     # History is newest first, reverse for processing order
-    reversed_history = history[::-1]
-    current_length = 0
-    max_chars_approx = config.KOBOLD_CONTEXT_LIMIT * 3 # Rough estimate
-
-    current_prompt_line = f"User: {prompt.strip()}"
-    formatted_lines.append(current_prompt_line)
-    current_length += len(current_prompt_line)
-
-    for msg in reversed_history:
+    for msg in history[::-1]:
         role = msg.get('role', 'user').capitalize()
         content = msg.get('content', '').strip()
         if role == 'User':
-            line = f"User: {content}"
+            formatted_lines.append(f"User: {content}")
         elif role == 'Assistant':
-            line = f"{ai_trigger_phrase} {content}"
+            formatted_lines.append(f"{ai_trigger_phrase} {content}")
         else:
-            line = content # Handle system messages
-
-        if current_length + len(line) < max_chars_approx:
-            formatted_lines.insert(0, line) # Insert at beginning
-            current_length += len(line)
-        else:
-            logging.warning(f"Kobold history truncated due to context limit ({max_chars_approx} chars).")
-            break
+            formatted_lines.append(content) # Handle system messages
 
+    formatted_lines.append(f"User: {prompt.strip()}")
     formatted_lines.append(ai_trigger_phrase) # Trigger AI response
     final_prompt = "\n".join(formatted_lines)
     logging.info(f"Kobold formatted prompt length: {len(final_prompt)} characters.")
     return final_prompt
 
-# --- Main Backend Call Function ---
-def call_llm_backend(prompt, history, backend, model):
-    """Calls the selected LLM backend."""
-    logging.info(f"LLM Call: backend={backend}, model={model}, prompt='{prompt[:50]}...'")
+# --- Backend Adapters (request building / response parsing, shared by blocking and streaming calls) ---
+OPENAI_COMPATIBLE_BACKENDS = ('groq', 'openai', 'xai', 'custom_external')
 
-    # Prepare messages in standard OpenAI format (oldest first)
-    messages_for_api = history[::-1] # Reverse history for chronological order
-    messages_for_api.append({'role': 'user', 'content': prompt})
+# Fixed generation settings sent per backend (also part of the response cache key)
+BACKEND_SAMPLING_PARAMS = {
+    'kobold': {'temperature': 0.7, 'max_generation_length': 512},
+    'anthropic': {'max_tokens': 1024},
+}
 
-    api_endpoint = None
-    api_key = None
-    headers = {'Content-Type': 'application/json; charset=utf-8', 'Accept': 'application/json'}
-    payload = {}
+JSON_HEADERS = {'Content-Type': 'application/json; charset=utf-8', 'Accept': 'application/json'}
 
-    # --- Determine API Details based on Backend ---
-    try:
-        if backend == 'ollama':
-            ollama_messages = [{'role': msg.get('role', 'user'), 'content': msg.get('content', '')} for msg in messages_for_api]
-            payload = {'model': model, 'messages': ollama_messages, 'stream': False}
-            api_endpoint = f"{config.OLLAMA_API}/api/chat"
-
-        elif backend == 'kobold':
-            kobold_formatted_prompt = format_kobold_prompt(prompt, history) # History should be newest first here
-            prompt_token_estimate = len(kobold_formatted_prompt) // 3
-            desired_generation_length = 512
-            max_length = min(prompt_token_estimate + desired_generation_length, config.KOBOLD_CONTEXT_LIMIT)
-            payload = {'prompt': kobold_formatted_prompt, 'max_length': max_length, 'temperature': 0.7}
-            api_endpoint = config.KOBOLD_API
-
-        elif backend == 'groq':
-            api_endpoint = "https://api.groq.com/openai/v1/chat/completions"
-            api_key = config.GROQ_API_KEY
-            if not api_key: return "[Error: Groq API Key not configured on backend]"
-            if not model: return "[Error: Model name required for Groq]"
-            headers['Authorization'] = f'Bearer {api_key}'
-            openai_messages = [{'role': msg.get('role','user'), 'content': msg.get('content','')} for msg in messages_for_api]
-            payload = {"messages": openai_messages, "model": model, "stream": False}
-
-        elif backend == 'openai':
-            api_endpoint = "https://api.openai.com/v1/chat/completions"
-            api_key = config.OPENAI_API_KEY
-            if not api_key: return "[Error: OpenAI API Key not configured on backend]"
-            if not model: return "[Error: Model name required for OpenAI]"
-            headers['Authorization'] = f'Bearer {api_key}'
-            openai_messages = [{'role': msg.get('role','user'), 'content': msg.get('content','')} for msg in messages_for_api]
-            payload = {"messages": openai_messages, "model": model, "stream": False}
-
-        elif backend == 'anthropic':
-            api_endpoint = "https://api.anthropic.com/v1/messages"
-            api_key = config.ANTHROPIC_API_KEY
-            if not api_key: return "[Error: Anthropic API Key not configured on backend]"
-            if not model: return "[Error: Model name required for Anthropic]"
-            headers['x-api-key'] = api_key
-            headers['anthropic-version'] = '2023-06-01'
-            anthropic_messages = [{'role': msg.get('role','user'), 'content': msg.get('content','')} for msg in messages_for_api]
-            payload = {"model": model, "messages": anthropic_messages, "max_tokens": 1024, "stream": False}
-            headers.pop('Authorization', None)
-
-        elif backend == 'google':
-            if not model: return "[Error: Model name required for Google Gemini]"
-            api_endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
-            api_key = config.GOOGLE_API_KEY
-            if not api_key: return "[Error: Google API Key not configured on backend]"
-            api_endpoint += f"?key={api_key}"
-            gemini_contents = []
-            for msg in messages_for_api:
-                role = msg.get('role', 'user')
-                gemini_role = 'model' if role == 'assistant' else 'user'
-                gemini_contents.append({'role': gemini_role, 'parts': [{'text': msg.get('content', '')}]})
-            payload = {"contents": gemini_contents}
-
-        elif backend == 'xai':
-            api_endpoint = "https://api.x.ai/v1/chat/completions"
-            api_key = config.XAI_API_KEY
-            if not api_key: return "[Error: xAI API Key not configured on backend (if required)]"
-            if not model: return "[Error: Model name required for xAI]"
-            headers['Authorization'] = f'Bearer {api_key}'
-            openai_messages = [{'role': msg.get('role','user'), 'content': msg.get('content','')} for msg in messages_for_api]
-            payload = {"messages": openai_messages, "model": model, "stream": False}
-
-        elif backend == 'custom_external':
-            api_endpoint = config.CUSTOM_API_ENDPOINT
-            api_key = config.CUSTOM_API_KEY
-            model = config.CUSTOM_API_MODEL_NAME
-            if not api_endpoint: return "[Error: Custom API Endpoint not configured]"
-            if not model: return "[Error: Custom API Model Name not configured]"
-            if api_key: headers['Authorization'] = f'Bearer {api_key}'
-            openai_messages = [{'role': msg.get('role','user'), 'content': msg.get('content','')} for msg in messages_for_api]
-            payload = {"messages": openai_messages, "model": model, "stream": False}
+def is_error_response(response_text):
+    """True if call_llm_backend returned one of its '[Error ...]' strings (or nothing)."""
+    return not response_text or response_text.startswith("[Error")
+
+def get_kobold_stream_endpoint():
+    """Derives Kobold's SSE endpoint from the configured generate endpoint."""
+    if config.KOBOLD_STREAM_API:
+        return config.KOBOLD_STREAM_API
+    base_url = config.KOBOLD_API.split('/api/', 1)[0]
+    return f"{base_url}/api/extra/generate/stream"
+
+def _chat_messages(prompt, history):
+    """History (newest first) plus prompt as chronological role/content messages, in one pass."""
+    messages = [{'role': msg.get('role', 'user'), 'content': msg.get('content', '')} for msg in reversed(history)]
+    messages.append({'role': 'user', 'content': prompt})
+    return messages
+
+def _parse_sse_data(line):
+    """Returns (decoded JSON payload or None, done) for one SSE line."""
+    if not line.startswith('data:'):
+        return None, False
+    data_str = line[5:].strip()
+    if data_str == '[DONE]':
+        return None, True
+    if not data_str:
+        return None, False
+    return json.loads(data_str), False
+
+class BackendAdapter:
+    """Builds requests for and parses responses from one provider.
+
+    Endpoint and headers depend only on config, so they are prepared once and
+    rebuilt only when one of config_keys changes (e.g. via /api/update-endpoints).
+    The returned headers dict is shared: treat it as read-only.
+    """
+    name = None
+    config_keys = ()
+    stable_prefix = False # Local backends with prompt caching: keep the history window's prefix stable across turns
+
+    def __init__(self):
+        self._fingerprint = None
+        self._prepared = None
+
+    def prepared(self):
+        """Returns (endpoint, headers, config_error) for the current config."""
+        fingerprint = tuple(getattr(config, key) for key in self.config_keys)
+        if self._prepared is None or fingerprint != self._fingerprint:
+            self._prepared = self.prepare()
+            self._fingerprint = fingerprint
+        return self._prepared
+
+    def prepare(self):
+        raise NotImplementedError
+
+    def generation_budget(self):
+        """Tokens reserved for the reply when budgeting the prompt."""
+        return config.CONTEXT_RESERVED_TOKENS
+
+    def build_request(self, prompt, history, model, stream=False):
+        """Returns (endpoint, headers, payload); history is already budgeted and newest first."""
+        endpoint, headers, config_error = self.prepared()
+        if config_error:
+            raise ValueError(config_error)
+        return endpoint, headers, self.build_payload(prompt, history, model, stream)
+
+    def build_payload(self, prompt, history, model, stream):
+        raise NotImplementedError
+
+    def parse_response(self, result):
+        """Extracts the reply text from a non-streaming JSON response (None if the shape is unknown)."""
+        return None
+
+    def parse_stream_line(self, line):
+        """Returns (token, done) for one line of the provider's SSE stream."""
+        data, done = _parse_sse_data(line)
+        if data is None:
+            return None, done
+        return self.parse_stream_event(data)
+
+    def parse_stream_event(self, data):
+        return None, False
+
+class OllamaAdapter(BackendAdapter):
+    name = 'ollama'
+    config_keys = ('OLLAMA_API',)
+    stable_prefix = True
+
+    def prepare(self):
+        return f"{config.OLLAMA_API}/api/chat", JSON_HEADERS, None
+
+    def build_request(self, prompt, history, model, stream=False):
+        # Continuing a known conversation (or starting one) goes through /api/generate with
+        # Ollama's returned context, so only the new prompt is sent and processed.
+        context = conversation_state.get_ollama_context(model, prompt, history)
+        if context is None:
+            return super().build_request(prompt, history, model, stream)
+        _, headers, config_error = self.prepared()
+        if config_error:
+            raise ValueError(config_error)
+        payload = {'model': model, 'prompt': prompt, 'stream': stream, 'options': {'num_ctx': config.OLLAMA_CONTEXT_LIMIT}}
+        if context:
+            payload['context'] = context
+        return f"{config.OLLAMA_API}/api/generate", headers, self._with_keep_alive(payload, model)
+
+    def build_payload(self, prompt, history, model, stream):
+        payload = {'model': model, 'messages': _chat_messages(prompt, history), 'stream': stream,
+                   'options': {'num_ctx': config.OLLAMA_CONTEXT_LIMIT}} # Keep Ollama's window in sync with our budget
+        return self._with_keep_alive(payload, model)
+
+    def _with_keep_alive(self, payload, model):
+        ollama_residency.record_request(model)
+        keep_alive = ollama_residency.get_keep_alive(model)
+        if keep_alive is not None: # Hot models stay loaded past Ollama's default 5 minutes
+            payload['keep_alive'] = keep_alive
+        return payload
+
+    def parse_response(self, result):
+        message = result.get('message')
+        if isinstance(message, dict) and 'content' in message:
+            return message['content']
+        return result.get('response') # Fallback for older ollama non-stream
+
+    def parse_stream_line(self, line):
+        # NDJSON: one JSON object per line
+        data = json.loads(line)
+        if data.get('error'):
+            raise RuntimeError(f"Ollama stream error: {data['error']}")
+        token = data.get('message', {}).get('content')
+        if token is None and 'response' in data:
+            token = data['response']
+        return token, bool(data.get('done'))
+
+class KoboldAdapter(BackendAdapter):
+    name = 'kobold'
+    config_keys = ('KOBOLD_API', 'KOBOLD_STREAM_API')
+    stable_prefix = True # KoboldCpp fast-forwards over the prompt prefix it already processed
+
+    def prepare(self):
+        return config.KOBOLD_API, JSON_HEADERS, None
+
+    def generation_budget(self):
+        return BACKEND_SAMPLING_PARAMS['kobold']['max_generation_length']
+
+    def build_request(self, prompt, history, model, stream=False):
+        endpoint, headers, payload = super().build_request(prompt, history, model, stream)
+        return (get_kobold_stream_endpoint() if stream else endpoint), headers, payload
+
+    def build_payload(self, prompt, history, model, stream):
+        kobold_params = BACKEND_SAMPLING_PARAMS['kobold']
+        return {'prompt': format_kobold_prompt(prompt, history), # History should be newest first here
+                'max_context_length': config.KOBOLD_CONTEXT_LIMIT,
+                'max_length': kobold_params['max_generation_length'], # Tokens to generate
+                'temperature': kobold_params['temperature']}
+
+    def parse_response(self, result):
+        try:
+            return result['results'][0]['text']
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def parse_stream_event(self, data):
+        return data.get('token'), bool(data.get('finish_reason')) # Set ("stop"/"length") on the last event
+
+class OpenAICompatibleAdapter(BackendAdapter):
+    """OpenAI-style chat completions (Groq, OpenAI, xAI, custom endpoints)."""
+    def __init__(self, name, endpoint, key_attr, label, missing_key_suffix=""):
+        super().__init__()
+        self.name = name
+        self.endpoint = endpoint
+        self.key_attr = key_attr
+        self.label = label
+        self.missing_key_suffix = missing_key_suffix
+        self.config_keys = (key_attr,)
+
+    def prepare(self):
+        api_key = getattr(config, self.key_attr)
+        if not api_key:
+            return self.endpoint, JSON_HEADERS, f"{self.label} API Key not configured on backend{self.missing_key_suffix}"
+        return self.endpoint, {**JSON_HEADERS, 'Authorization': f'Bearer {api_key}'}, None
+
+    def build_payload(self, prompt, history, model, stream):
+        if not model: raise ValueError(f"Model name required for {self.label}")
+        return {"messages": _chat_messages(prompt, history), "model": model, "stream": stream}
+
+    def parse_response(self, result):
+        try:
+            return result['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError):
+            return None
 
+    def parse_stream_event(self, data):
+        if data.get('error'):
+            raise RuntimeError(f"{self.name} stream error: {data['error']}")
+        choices = data.get('choices') or []
+        if not choices:
+            return None, False
+        return (choices[0].get('delta') or {}).get('content'), False
+
+class CustomExternalAdapter(OpenAICompatibleAdapter):
+    """User-configured OpenAI-compatible endpoint; always calls the configured model."""
+    def __init__(self):
+        super().__init__('custom_external', None, 'CUSTOM_API_KEY', 'Custom API')
+        self.config_keys = ('CUSTOM_API_ENDPOINT', 'CUSTOM_API_KEY', 'CUSTOM_API_MODEL_NAME')
+
+    def prepare(self):
+        if not config.CUSTOM_API_ENDPOINT:
+            return None, JSON_HEADERS, "Custom API Endpoint not configured"
+        if not config.CUSTOM_API_MODEL_NAME:
+            return None, JSON_HEADERS, "Custom API Model Name not configured"
+        headers = {**JSON_HEADERS, 'Authorization': f'Bearer {config.CUSTOM_API_KEY}'} if config.CUSTOM_API_KEY else JSON_HEADERS
+        return config.CUSTOM_API_ENDPOINT, headers, None
+
+    def build_payload(self, prompt, history, model, stream):
+        return super().build_payload(prompt, history, config.CUSTOM_API_MODEL_NAME, stream)
+
+class AnthropicAdapter(BackendAdapter):
+    name = 'anthropic'
+    config_keys = ('ANTHROPIC_API_KEY',)
+
+    def prepare(self):
+        endpoint = "https://api.anthropic.com/v1/messages"
+        if not config.ANTHROPIC_API_KEY:
+            return endpoint, JSON_HEADERS, "Anthropic API Key not configured on backend"
+        return endpoint, {**JSON_HEADERS, 'x-api-key': config.ANTHROPIC_API_KEY, 'anthropic-version': '2023-06-01'}, None
+
+    def generation_budget(self):
+        return BACKEND_SAMPLING_PARAMS['anthropic']['max_tokens']
+
+    def build_payload(self, prompt, history, model, stream):
+        if not model: raise ValueError("Model name required for Anthropic")
+        return {"model": model, "messages": _chat_messages(prompt, history),
+                "max_tokens": BACKEND_SAMPLING_PARAMS['anthropic']['max_tokens'], "stream": stream}
+
+    def parse_response(self, result):
+        try:
+            return result['content'][0]['text']
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def parse_stream_event(self, data):
+        event_type = data.get('type')
+        if event_type == 'content_block_delta':
+            return (data.get('delta') or {}).get('text'), False
+        if event_type == 'message_stop':
+            return None, True
+        if event_type == 'error':
+            raise RuntimeError(f"Anthropic stream error: {(data.get('error') or {}).get('message', data)}")
+        return None, False
+
+class GoogleAdapter(BackendAdapter):
+    name = 'google'
+    config_keys = ('GOOGLE_API_KEY',)
+    GEMINI_ROLES = {'assistant': 'model'}
+
+    def prepare(self):
+        if not config.GOOGLE_API_KEY:
+            return None, JSON_HEADERS, "Google API Key not configured on backend"
+        return None, JSON_HEADERS, None # Endpoint depends on the model
+
+    def build_request(self, prompt, history, model, stream=False):
+        if not model: raise ValueError("Model name required for Google Gemini")
+        _, headers, payload = super().build_request(prompt, history, model, stream)
+        if stream:
+            endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent?alt=sse&key={config.GOOGLE_API_KEY}"
         else:
-            return f"[Backend '{backend}' not supported]"
+            endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={config.GOOGLE_API_KEY}"
+        return endpoint, headers, payload
+
+    def build_payload(self, prompt, history, model, stream):
+        gemini_roles = self.GEMINI_ROLES
+        contents = [{'role': gemini_roles.get(msg.get('role', 'user'), 'user'), 'parts': [{'text': msg.get('content', '')}]}
+                    for msg in reversed(history)]
+        contents.append({'role': 'user', 'parts': [{'text': prompt}]})
+        return {"contents": contents}
+
+    def parse_response(self, result):
+        try:
+            return result['candidates'][0]['content']['parts'][0]['text']
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def parse_stream_event(self, data):
+        error = data.get('error')
+        if error:
+            message = error.get('message', error) if isinstance(error, dict) else str(error) # Usually an object, sometimes a bare string
+            raise RuntimeError(f"Google stream error: {message}")
+        candidates = data.get('candidates') or []
+        if not candidates:
+            return None, False
+        parts = (candidates[0].get('content') or {}).get('parts') or []
+        finished = candidates[0].get('finishReason') not in (None, 'FINISH_REASON_UNSPECIFIED') # Only on the last chunk
+        return "".join(part.get('text', '') for part in parts) or None, finished
+
+# Adding a provider means registering an adapter here; call sites dispatch by name
+BACKEND_ADAPTERS = {}
+
+def register_adapter(adapter):
+    BACKEND_ADAPTERS[adapter.name] = adapter
+
+for _adapter in (
+    OllamaAdapter(),
+    KoboldAdapter(),
+    OpenAICompatibleAdapter('groq', "https://api.groq.com/openai/v1/chat/completions", 'GROQ_API_KEY', 'Groq'),
+    OpenAICompatibleAdapter('openai', "https://api.openai.com/v1/chat/completions", 'OPENAI_API_KEY', 'OpenAI'),
+    OpenAICompatibleAdapter('xai', "https://api.x.ai/v1/chat/completions", 'XAI_API_KEY', 'xAI', missing_key_suffix=" (if required)"),
+    CustomExternalAdapter(),
+    AnthropicAdapter(),
+    GoogleAdapter(),
+):
+    register_adapter(_adapter)
+
+def get_adapter(backend):
+    adapter = BACKEND_ADAPTERS.get(backend)
+    if adapter is None:
+        raise ValueError(f"Backend '{backend}' not supported")
+    return adapter
+
+def get_generation_budget(backend):
+    """Tokens reserved for the reply when budgeting the prompt."""
+    adapter = BACKEND_ADAPTERS.get(backend)
+    return adapter.generation_budget() if adapter else config.CONTEXT_RESERVED_TOKENS
+
+def fit_backend_history(prompt, history, backend, model):
+    """Trims history to the model's context window minus the generation budget."""
+    adapter = get_adapter(backend)
+    fit = conversation_state.fit_stable_history if adapter.stable_prefix else fit_history
+    return fit(prompt, history, backend, model, reserved_tokens=adapter.generation_budget())
+
+def build_backend_request(prompt, history, backend, model, stream=False, fitted=False):
+    """Builds (endpoint, headers, payload) for a backend call.
+
+    Pass fitted=True if history already went through fit_backend_history.
+    Raises ValueError with a user-facing message on missing configuration.
+    """
+    if not fitted:
+        history = fit_backend_history(prompt, history, backend, model)
+    return get_adapter(backend).build_request(prompt, history, model, stream)
+
+def parse_backend_response(result, backend):
+    """Extracts the generated text from a non-streaming backend response (None if unknown)."""
+    if isinstance(result, str): # Handle plain text response
+        logging.warning(f"{backend} API returned plain text.")
+        return result
+    if not isinstance(result, dict):
+        return None
+
+    adapter = BACKEND_ADAPTERS.get(backend)
+    response_text = adapter.parse_response(result) if adapter else None
+    if response_text is None and 'choices' in result: # Some local servers answer in OpenAI shape
+        response_text = BACKEND_ADAPTERS['openai'].parse_response(result)
+    if response_text is None: # Generic Fallback
+        logging.warning(f"Could not parse known structure for {backend}, attempting generic keys.")
+        response_text = result.get('response') or result.get('text') or result.get('completion')
+    return response_text
+
+def parse_stream_line(backend, line):
+    """Parses one line of a backend's native stream format.
+
+    Returns (token, done): token is the text delta (or None), done is True once
+    the provider signalled the end of the stream. Raises RuntimeError for
+    error events sent inside the stream.
+    """
+    if not line:
+        return None, False
+    adapter = BACKEND_ADAPTERS.get(backend)
+    if adapter is None:
+        return None, False
+    return adapter.parse_stream_line(line)
+
+# --- Main Backend Call Function ---
+def call_llm_backend(prompt, history, backend, model, cancel_event=None):
+    """Calls the selected LLM backend. Setting cancel_event aborts pending retries."""
+    if config.LLM_ENGINE == 'asyncio':
+        from services import async_llm # Imported lazily: async_llm depends on this module
+        return async_llm.call_llm_backend_sync(prompt, history, backend, model, cancel_event=cancel_event)
+
+    logging.info(f"LLM Call: backend={backend}, model={model}, prompt='{prompt[:50]}...'")
+
+    try:
+        try:
+            history = fit_backend_history(prompt, history, backend, model) # begin_turn must key the same window
+            api_endpoint, headers, payload = build_backend_request(prompt, history, backend, model, fitted=True)
+        except ValueError as e:
+            return f"[Error: {e}]"
 
         # --- Make the API Call ---
         logging.info(f"Attempting {backend} API Request to {api_endpoint}")
-        result = make_request_with_retry(api_endpoint, "POST", json_data=payload, headers=headers, timeout=180)
+        turn = conversation_state.begin_turn(backend, model, prompt, history, payload)
+        result = make_request_with_retry(api_endpoint, "POST", json_data=payload, headers=headers, timeout=180, cancel_event=cancel_event)
 
         # --- Parse Response ---
-        response_text = None
-        if isinstance(result, dict):
-            # OpenAI / Groq / xAI
-            if 'choices' in result and result['choices'] and 'message' in result['choices'][0] and 'content' in result['choices'][0]['message']:
-                response_text = result['choices'][0]['message']['content']
-            # Anthropic
-            elif backend == 'anthropic' and 'content' in result and isinstance(result['content'], list) and result['content'] and 'text' in result['content'][0]:
-                response_text = result['content'][0]['text']
-            # Google Gemini
-            elif backend == 'google' and 'candidates' in result and result['candidates'] and 'content' in result['candidates'][0] and 'parts' in result['candidates'][0]['content'] and result['candidates'][0]['content']['parts'] and 'text' in result['candidates'][0]['content']['parts'][0]:
-                 response_text = result['candidates'][0]['content']['parts'][0]['text']
-            # Kobold
-            elif backend == 'kobold' and 'results' in result and result['results'] and 'text' in result['results'][0]:
-                 response_text = result['results'][0]['text']
-            # Ollama (non-stream)
-            elif backend == 'ollama' and 'message' in result and 'content' in result['message']:
-                 response_text = result['message']['content']
-            elif backend == 'ollama' and 'response' in result: # Fallback for older ollama non-stream
-                 response_text = result['response']
-
-            # Generic Fallback
-            if response_text is None:
-                 logging.warning(f"Could not parse known structure for {backend}, attempting generic keys.")
-                 response_text = result.get('response') or result.get('text') or result.get('completion')
-
-        elif isinstance(result, str): # Handle plain text response
-             logging.warning(f"{backend} API returned plain text.")
-             response_text = result
+        response_text = parse_backend_response(result, backend)
 
         if response_text is not None:
             logging.info(f"{backend} call successful.")
+            if turn:
+                turn.finish(result, response_text.strip())
             return response_text.strip()
         else:
             logging.error(f"Unexpected/Unparsed API response structure from {backend}: {result}")
             return f"[Error parsing response from {backend}]"
 
+    except RequestCancelled as e: # Aborted by the task's cancel handle; not a backend failure
+        logging.info(f"{backend} call cancelled: {e}")
+        return f"[Error connecting to {backend} API: {e}]"
     except requests.RequestException as e:
         error_msg = f"Error connecting to {backend} API: {e}"
         logging.error(error_msg, exc_info=True)
         return f"[{error_msg}]"
     except Exception as e:
         logging.error(f"Error calling {backend} API: {e}", exc_info=True)
-        return f"[Error during {backend} API call: {e}]"
\ No newline at end of file
+        return f"[Error during {backend} API call: {e}]"
+
+# --- Streaming Backend Call Function ---
+def stream_llm_backend(prompt, history, backend, model, on_connect=None, cancel_event=None, on_complete=None):
+    """Streams the selected LLM backend's reply as a generator of text chunks.
+
+    Each provider's native stream format (Ollama NDJSON, OpenAI-style SSE,
+    Anthropic events, Gemini streamGenerateContent, Kobold SSE) is reduced to
+    plain text deltas. on_connect(response) is called once the upstream
+    connection is open so callers can register it for cancellation; if it
+    returns False the stream is closed without reading. on_complete() is called
+    after the last token if the backend signalled the end of its reply; a
+    stream that just stops (dropped connection, truncation) doesn't call it.
+    Raises ValueError for configuration errors and requests.RequestException
+    for connection failures.
+    """
+    if config.LLM_ENGINE == 'asyncio':
+        from services import async_llm # Imported lazily: async_llm depends on this module
+        yield from async_llm.stream_llm_backend_sync(prompt, history, backend, model, on_connect=on_connect, cancel_event=cancel_event,
+                                                     on_complete=on_complete)
+        return
+
+    logging.info(f"LLM Stream: backend={backend}, model={model}, prompt='{prompt[:50]}...'")
+    history = fit_backend_history(prompt, history, backend, model) # begin_turn must key the same window
+    api_endpoint, headers, payload = build_backend_request(prompt, history, backend, model, stream=True, fitted=True)
+
+    logging.info(f"Initiating {backend} stream request to: {api_endpoint}")
+    response = make_request_with_retry(api_endpoint, "POST", json_data=payload, headers=headers, stream=True, timeout=300, retries=1, cancel_event=cancel_event)
+    try:
+        if on_connect and on_connect(response) is False:
+            return
+        parse_line = get_adapter(backend).parse_stream_line
+        turn = conversation_state.begin_turn(backend, model, prompt, history, payload)
+        if turn:
+            parse_line = turn.wrap_parse_line(parse_line)
+        decoder = StreamDecoder(backend, parse_line)
+        for chunk in iter_response_chunks(response):
+            yield from decoder.feed(chunk)
+            if decoder.done:
+                break
+        else:
+            yield from decoder.flush()
+        if decoder.done:
+            if turn:
+                turn.finish() # Only complete replies can be continued from
+            if on_complete:
+                on_complete()
+    finally:
+        response.close()
@@ -0,0 +1,238 @@
+import time
+import logging
+import threading
+import requests
+import config # Import config variables
+from services.llm_backends import stream_llm_backend, is_error_response
+from services import scheduler, hedging
+from services.retry_policy import RequestCancelled
+
+# Circuit breaker states
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+_targets = {} # (backend, model) -> health dict, see _get_target
+_router_lock = threading.Lock()
+
+def _get_target(backend, model):
+    """Returns the health record for a backend/model. Caller holds the lock."""
+    key = (backend, model or '')
+    target = _targets.get(key)
+    if target is None:
+        target = {
+            'ewma_latency': None, # Seconds (time to first token for streams)
+            'ewma_error_rate': 0.0,
+            'samples': 0,
+            'consecutive_failures': 0,
+            'state': CIRCUIT_CLOSED,
+            'opened_at': None,
+            'probe_in_flight': False,
+            'served_as_failover': 0,
+        }
+        _targets[key] = target
+    return target
+
+def _allow_request(backend, model):
+    """Circuit check: closed passes, open fails fast, half-open lets one probe through."""
+    with _router_lock:
+        target = _get_target(backend, model)
+        if target['state'] == CIRCUIT_CLOSED:
+            return True
+        if target['state'] == CIRCUIT_OPEN:
+            if time.monotonic() - target['opened_at'] < config.CIRCUIT_OPEN_SECONDS:
+                return False
+            target['state'] = CIRCUIT_HALF_OPEN
+            target['probe_in_flight'] = False
+        if target['probe_in_flight']:
+            return False
+        target['probe_in_flight'] = True
+        return True
+
+def record_result(backend, model, latency, success):
+    """Updates EWMA latency/error rate and the circuit breaker for a backend/model."""
+    alpha = config.ROUTER_EWMA_ALPHA
+    with _router_lock:
+        target = _get_target(backend, model)
+        target['samples'] += 1
+        target['ewma_error_rate'] = alpha * (0.0 if success else 1.0) + (1 - alpha) * target['ewma_error_rate']
+        if success:
+            if latency is not None:
+                previous = target['ewma_latency']
+                target['ewma_latency'] = latency if previous is None else alpha * latency + (1 - alpha) * previous
+            target['consecutive_failures'] = 0
+            if target['state'] != CIRCUIT_CLOSED:
+                logging.info(f"Circuit for {backend}/{model} closed after successful probe.")
+            target['state'] = CIRCUIT_CLOSED
+            target['probe_in_flight'] = False
+            return
+
+        target['consecutive_failures'] += 1
+        should_open = (
+            target['state'] == CIRCUIT_HALF_OPEN
+            or target['consecutive_failures'] >= config.CIRCUIT_FAILURE_THRESHOLD
+            or (target['samples'] >= config.CIRCUIT_MIN_SAMPLES and target['ewma_error_rate'] >= config.CIRCUIT_ERROR_RATE_THRESHOLD)
+        )
+        if should_open:
+            if target['state'] != CIRCUIT_OPEN:
+                logging.warning(f"Opening circuit for {backend}/{model} (consecutive failures: {target['consecutive_failures']}, "
+                                f"error rate: {target['ewma_error_rate']:.2f}).")
+            target['state'] = CIRCUIT_OPEN
+            target['opened_at'] = time.monotonic()
+            target['probe_in_flight'] = False
+
+def _release_probe(backend, model):
+    """Frees a half-open probe slot when the attempt ended without a health verdict."""
+    with _router_lock:
+        _get_target(backend, model)['probe_in_flight'] = False
+
+def _record_failover(backend, model):
+    with _router_lock:
+        _get_target(backend, model)['served_as_failover'] += 1
+
+def get_candidates(backend, model):
+    """Ordered (backend, model) targets for a request: the requested one plus configured failovers."""
+    candidates = [(backend, model)]
+    equivalents = config.LLM_FAILOVER.get(f"{backend}:{model}") or config.LLM_FAILOVER.get(f"{backend}:*") or []
+    for candidate in equivalents:
+        if candidate not in candidates:
+            candidates.append(candidate)
+
+    if config.LLM_ROUTING_POLICY == 'fastest' and len(candidates) > 1:
+        with _router_lock:
+            def sort_key(candidate):
+                target = _get_target(*candidate)
+                healthy = target['state'] == CIRCUIT_CLOSED
+                latency = target['ewma_latency'] if target['ewma_latency'] is not None else 0.0 # Unmeasured: try it
+                return (not healthy, latency)
+            candidates.sort(key=sort_key) # Stable sort keeps configured order on ties
+    return candidates
+
+def _get_hedge_target(candidates, index):
+    """Hedges go to the next equivalent with a closed circuit, else to the same target again."""
+    with _router_lock:
+        for candidate in candidates[index + 1:]:
+            if _get_target(*candidate)['state'] == CIRCUIT_CLOSED:
+                return candidate
+    return candidates[index]
+
+def _is_config_error(response_text):
+    # build_backend_request errors ("[Error: ... not configured]") say nothing about provider health
+    return response_text.startswith("[Error: ")
+
+def routed_call_llm_backend(prompt, history, backend, model, priority=scheduler.PRIORITY_INTERACTIVE, cancel_event=None):
+    """call_llm_backend with circuit breakers, failover, per-backend scheduling and optional hedging.
+
+    Returns (response_text, used_backend, used_model). Raises
+    scheduler.SchedulerRejected if every candidate's queue turned it away.
+    """
+    last_response = None
+    rejection = None
+    candidates = get_candidates(backend, model)
+    for index, (candidate_backend, candidate_model) in enumerate(candidates):
+        if not _allow_request(candidate_backend, candidate_model):
+            logging.info(f"Skipping {candidate_backend}/{candidate_model}: circuit open.")
+            continue
+        try:
+            with scheduler.backend_slot(candidate_backend, priority, cancel_event):
+                start_time = time.monotonic()
+                response_text, used_backend, used_model = hedging.hedged_call_llm_backend(
+                    prompt, history, candidate_backend, candidate_model, _get_hedge_target(candidates, index),
+                    priority=priority, cancel_event=cancel_event)
+                latency = time.monotonic() - start_time
+        except scheduler.SchedulerRejected as e: # Overloaded, not unhealthy: try the next candidate
+            _release_probe(candidate_backend, candidate_model)
+            rejection = e
+            continue
+        except RequestCancelled as e: # Cancelled while queued for a slot; same reply as a cancelled call
+            _release_probe(candidate_backend, candidate_model)
+            return f"[Error connecting to {candidate_backend} API: {e}]", candidate_backend, candidate_model
+        if cancel_event is not None and cancel_event.is_set(): # Cancelled by the client; no health verdict, no failover
+            _release_probe(candidate_backend, candidate_model)
+            return response_text, candidate_backend, candidate_model
+        if not is_error_response(response_text):
+            if (used_backend, used_model) != (candidate_backend, candidate_model): # A hedge to an equivalent won
+                _release_probe(candidate_backend, candidate_model)
+            record_result(used_backend, used_model, latency, success=True)
+            if (used_backend, used_model) != (backend, model):
+                _record_failover(used_backend, used_model)
+                logging.info(f"Failed over {backend}/{model} -> {used_backend}/{used_model}.")
+            return response_text, used_backend, used_model
+        if response_text and _is_config_error(response_text):
+            _release_probe(candidate_backend, candidate_model)
+        else:
+            record_result(candidate_backend, candidate_model, latency, success=False)
+        last_response = response_text
+
+    if last_response is None and rejection is not None:
+        raise rejection
+    if last_response is None:
+        last_response = f"[Error connecting to {backend} API: circuit open, no healthy failover available]"
+    return last_response, backend, model
+
+def routed_stream_llm_backend(prompt, history, backend, model, on_connect=None, priority=scheduler.PRIORITY_INTERACTIVE, cancel_event=None,
+                              on_complete=None):
+    """stream_llm_backend with circuit breakers and scheduling; fails over only before the first token.
+
+    The backend slot is held until the stream ends or is closed. on_complete() is only called for a reply from
+    the requested backend/model, so a failover reply is never cached under the requested key.
+    """
+    last_error = None
+    for candidate_backend, candidate_model in get_candidates(backend, model):
+        if not _allow_request(candidate_backend, candidate_model):
+            logging.info(f"Skipping {candidate_backend}/{candidate_model} stream: circuit open.")
+            continue
+        first_token_latency = None
+        try:
+            with scheduler.backend_slot(candidate_backend, priority, cancel_event):
+                start_time = time.monotonic()
+                served_as_requested = (candidate_backend, candidate_model) == (backend, model)
+                for token in stream_llm_backend(prompt, history, candidate_backend, candidate_model, on_connect=on_connect, cancel_event=cancel_event,
+                                                on_complete=on_complete if served_as_requested else None):
+                    if first_token_latency is None:
+                        first_token_latency = time.monotonic() - start_time
+                        if not served_as_requested:
+                            _record_failover(candidate_backend, candidate_model)
+                            logging.info(f"Stream failed over {backend}/{model} -> {candidate_backend}/{candidate_model}.")
+                    yield token
+            record_result(candidate_backend, candidate_model, first_token_latency, success=True)
+            return
+        except scheduler.SchedulerRejected as e: # Overloaded, not unhealthy: try the next candidate
+            _release_probe(candidate_backend, candidate_model)
+            last_error = e
+        except GeneratorExit: # Consumer stopped reading (e.g. cancelled); no health verdict
+            _release_probe(candidate_backend, candidate_model)
+            raise
+        except ValueError as e: # Configuration error: try the next candidate without penalizing health
+            _release_probe(candidate_backend, candidate_model)
+            last_error = e
+        except (requests.RequestException, RuntimeError) as e:
+            if cancel_event is not None and cancel_event.is_set():
+                _release_probe(candidate_backend, candidate_model)
+                raise
+            record_result(candidate_backend, candidate_model, None, success=False)
+            if first_token_latency is not None:
+                raise # Tokens already reached the client; can't switch providers mid-answer
+            logging.warning(f"Stream from {candidate_backend}/{candidate_model} failed before first token: {e}")
+            last_error = e
+
+    if last_error is not None:
+        raise last_error
+    raise requests.exceptions.ConnectionError(f"{backend}/{model}: circuit open, no healthy failover available")
+
+def get_router_stats():
+    with _router_lock:
+        items = list(_targets.items())
+        stats = []
+        for (backend, model), target in items:
+            stats.append({
+                'backend': backend,
+                'model': model,
+                'state': target['state'],
+                'ewma_latency_ms': round(target['ewma_latency'] * 1000, 1) if target['ewma_latency'] is not None else None,
+                'ewma_error_rate': round(target['ewma_error_rate'], 4),
+                'samples': target['samples'],
+                'consecutive_failures': target['consecutive_failures'],
+                'served_as_failover': target['served_as_failover'],
+            })
+    return {'policy': config.LLM_ROUTING_POLICY, 'targets': stats}
@@ -0,0 +1,155 @@
+import time
+import logging
+import threading
+import config # Import config variables
+
+# Stale-while-revalidate cache for model lists (Ollama /api/tags, provider /models).
+# Fresh entries are served directly; entries past their TTL but within
+# MODEL_CATALOG_MAX_STALE are served immediately while one background thread
+# refreshes them. Only a cold (or too old) entry makes the caller wait, and
+# concurrent cold callers share that one fetch. Failed fetches are remembered
+# for MODEL_CATALOG_ERROR_TTL so an unreachable provider doesn't make every
+# settings-panel open wait through retries again.
+_catalog = {} # backend -> entry, see _get_entry
+_catalog_lock = threading.Lock()
+_catalog_stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'error_hits': 0, 'refreshes': 0, 'refresh_failures': 0, 'invalidations': 0}
+
+# /api/update-endpoints setting -> catalog entries it affects
+SETTING_BACKENDS = {
+    'ollama': ('ollama',),
+    'kobold': ('kobold',),
+    'groqApiKey': ('groq',),
+    'openaiApiKey': ('openai',),
+    'anthropicApiKey': ('anthropic',),
+    'googleApiKey': ('google',),
+    'xaiApiKey': ('xai',),
+    'customModelName': ('custom_external',),
+    'customApiEndpoint': ('custom_external',),
+    'customApiKey': ('custom_external',),
+}
+
+def _get_entry(backend):
+    """Caller holds the lock."""
+    entry = _catalog.get(backend)
+    if entry is None:
+        entry = {
+            'models': None,
+            'error': None, # Exception from the last fetch, if it failed
+            'fetched_at': 0.0,
+            'generation': 0, # Bumped on invalidation; fetches started before it are discarded
+            'refreshing': False,
+            'fetch_done': None, # threading.Event while a foreground fetch is running
+        }
+        _catalog[backend] = entry
+    return entry
+
+def get_ttl(backend):
+    return config.MODEL_CATALOG_TTLS.get(backend, config.MODEL_CATALOG_DEFAULT_TTL)
+
+def _store(backend, generation, models=None, error=None):
+    with _catalog_lock:
+        entry = _get_entry(backend)
+        if entry['generation'] != generation:
+            return False # Invalidated while fetching; the result may belong to old credentials
+        if error is None:
+            entry['models'] = models
+            entry['error'] = None
+        elif entry['models'] is None:
+            entry['error'] = error # Keep serving the last good list over a failed refresh
+        entry['fetched_at'] = time.monotonic()
+        return True
+
+def _refresh_in_background(backend, fetcher, generation):
+    def run():
+        try:
+            models = fetcher()
+            if _store(backend, generation, models=models):
+                logging.debug(f"Refreshed model catalog for {backend} ({len(models)} models).")
+        except Exception as e:
+            logging.warning(f"Background model list refresh for {backend} failed: {e}")
+            with _catalog_lock:
+                _catalog_stats['refresh_failures'] += 1
+            _store(backend, generation, error=e)
+        finally:
+            with _catalog_lock:
+                _get_entry(backend)['refreshing'] = False
+    threading.Thread(target=run, name=f"model-catalog-{backend}", daemon=True).start()
+
+def get_models(backend, fetcher, force_refresh=False):
+    """Returns (models, cache_status) for a backend; cache_status is HIT, STALE or MISS.
+
+    fetcher() returns the model list and raises on failure; the exception is
+    re-raised to the caller of a cold fetch (and to callers within the error TTL).
+    """
+    while True:
+        with _catalog_lock:
+            entry = _get_entry(backend)
+            age = time.monotonic() - entry['fetched_at']
+            if not force_refresh and entry['fetch_done'] is None:
+                if entry['models'] is not None and age <= get_ttl(backend):
+                    _catalog_stats['hits'] += 1
+                    return entry['models'], 'HIT'
+                if entry['models'] is not None and age <= config.MODEL_CATALOG_MAX_STALE:
+                    _catalog_stats['stale_hits'] += 1
+                    if not entry['refreshing']:
+                        entry['refreshing'] = True
+                        _catalog_stats['refreshes'] += 1
+                        _refresh_in_background(backend, fetcher, entry['generation'])
+                    return entry['models'], 'STALE'
+                if entry['error'] is not None and age <= config.MODEL_CATALOG_ERROR_TTL:
+                    _catalog_stats['error_hits'] += 1
+                    raise entry['error']
+            fetch_done = entry['fetch_done']
+            if fetch_done is None: # We fetch; concurrent callers wait for us
+                fetch_done = entry['fetch_done'] = threading.Event()
+                generation = entry['generation']
+                _catalog_stats['misses'] += 1
+                break
+        fetch_done.wait()
+        force_refresh = False # Someone just fetched; use their result
+
+    try:
+        models = fetcher()
+        _store(backend, generation, models=models)
+        return models, 'MISS'
+    except Exception as e:
+        _store(backend, generation, error=e)
+        raise
+    finally:
+        with _catalog_lock:
+            _get_entry(backend)['fetch_done'] = None
+        fetch_done.set()
+
+def invalidate(backends=None):
+    """Drops cached lists (all if backends is None) so the next request refetches."""
+    with _catalog_lock:
+        for backend in (list(_catalog) if backends is None else backends):
+            entry = _get_entry(backend)
+            entry['models'] = None
+            entry['error'] = None
+            entry['fetched_at'] = 0.0
+            entry['generation'] += 1
+            _catalog_stats['invalidations'] += 1
+
+def invalidate_for_settings(updated_keys):
+    """Invalidates the entries affected by /api/update-endpoints settings."""
+    backends = {backend for key in updated_keys for backend in SETTING_BACKENDS.get(key, ())}
+    if backends:
+        invalidate(backends)
+        logging.info(f"Model catalog invalidated for: {', '.join(sorted(backends))}")
+
+def get_catalog_stats():
+    now = time.monotonic()
+    with _catalog_lock:
+        stats = dict(_catalog_stats)
+        stats['entries'] = {
+            backend: {
+                'models': len(entry['models']) if entry['models'] is not None else None,
+                'age_seconds': round(now - entry['fetched_at'], 1) if entry['fetched_at'] else None,
+                'ttl': get_ttl(backend),
+                'error': str(entry['error']) if entry['error'] is not None else None,
+                'refreshing': entry['refreshing'],
+            }
+            for backend, entry in _catalog.items()
+        }
+    return stats
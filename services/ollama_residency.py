@@ -0,0 +1,221 @@
+import math
+import time
+import logging
+import threading
+from datetime import datetime
+import requests
+from utils import make_request_with_retry
+import config # Import config variables
+
+# Keeps the Ollama models people actually use loaded. Ollama unloads a model
+# keep_alive after its last request (5 minutes by default) and the next request
+# pays the full load time. This module pre-warms configured models at startup,
+# tracks a decayed per-model request rate, and each refresh keeps the hottest
+# models resident within OLLAMA_RESIDENCY_BUDGET_BYTES: it loads or extends them
+# via /api/generate with keep_alive, and unloads cold models (keep_alive 0) when
+# the resident set is over budget.
+_residency_lock = threading.Lock()
+_request_scores = {} # model -> (decayed request count, last update monotonic time)
+_resident = {} # model -> /api/ps entry from the last refresh
+_model_sizes = {} # model -> bytes (size on disk from /api/tags, or loaded size from /api/ps)
+_hot_models = [] # Models the last refresh decided to keep resident, hottest first
+_residency_stats = {'warmups': 0, 'keep_alive_refreshes': 0, 'evictions': 0, 'failures': 0, 'refreshes': 0,
+                    'last_refresh': None, 'last_error': None}
+_refresh_thread = None
+_stop_event = threading.Event()
+
+def _decayed_score(score, updated_at, now):
+    return score * math.exp(-(now - updated_at) / config.OLLAMA_RESIDENCY_RATE_WINDOW)
+
+def record_request(model):
+    """Counts a request for an Ollama model towards its hotness."""
+    if not model:
+        return
+    now = time.monotonic()
+    with _residency_lock:
+        score, updated_at = _request_scores.get(model, (0.0, now))
+        _request_scores[model] = (_decayed_score(score, updated_at, now) + 1, now)
+
+def get_request_rate(model):
+    """Recent requests per minute for a model (exponentially decayed)."""
+    now = time.monotonic()
+    with _residency_lock:
+        score, updated_at = _request_scores.get(model, (0.0, now))
+    return _decayed_score(score, updated_at, now) * 60 / config.OLLAMA_RESIDENCY_RATE_WINDOW
+
+def get_keep_alive(model):
+    """keep_alive to send with a generation request for model, or None for Ollama's default."""
+    if not config.OLLAMA_RESIDENCY_ENABLED:
+        return None
+    with _residency_lock:
+        hot = model in _hot_models
+    if hot or model in config.OLLAMA_WARM_MODELS:
+        return config.OLLAMA_KEEP_ALIVE
+    return None
+
+def _set_keep_alive(model, keep_alive, timeout):
+    """Loads (or unloads, with keep_alive 0) a model without generating anything."""
+    url = f"{config.OLLAMA_API}/api/generate"
+    # Same num_ctx as OllamaAdapter, or Ollama reloads the runner on the next real request
+    payload = {'model': model, 'keep_alive': keep_alive, 'options': {'num_ctx': config.OLLAMA_CONTEXT_LIMIT}}
+    make_request_with_retry(url, "POST", json_data=payload, timeout=timeout, retries=1)
+
+def warm_model(model):
+    """Loads model into memory and keeps it there for OLLAMA_KEEP_ALIVE. Returns True on success."""
+    start_time = time.monotonic()
+    try:
+        _set_keep_alive(model, config.OLLAMA_KEEP_ALIVE, config.OLLAMA_WARMUP_TIMEOUT)
+    except requests.RequestException as e:
+        logging.warning(f"Failed to warm Ollama model {model}: {e}")
+        with _residency_lock:
+            _residency_stats['failures'] += 1
+            _residency_stats['last_error'] = f"warm {model}: {e}"
+        return False
+    logging.info(f"Ollama model {model} resident (warm-up took {time.monotonic() - start_time:.1f}s).")
+    with _residency_lock:
+        _residency_stats['warmups'] += 1
+    return True
+
+def _fetch_running_models():
+    """Returns {model: /api/ps entry} for the models Ollama currently has loaded."""
+    response = make_request_with_retry(f"{config.OLLAMA_API}/api/ps", "GET", timeout=10, retries=1)
+    models = response.get('models', []) if isinstance(response, dict) else []
+    return {m['name']: m for m in models if isinstance(m, dict) and m.get('name')}
+
+def _fetch_model_sizes():
+    response = make_request_with_retry(f"{config.OLLAMA_API}/api/tags", "GET", timeout=10, retries=1)
+    models = response.get('models', []) if isinstance(response, dict) else []
+    return {m['name']: m.get('size', 0) for m in models if isinstance(m, dict) and m.get('name')}
+
+def _select_hot_models(candidates, sizes):
+    """Pinned models first, then by request rate, while the total fits the budget."""
+    pinned = [m for m in config.OLLAMA_WARM_MODELS if m in candidates]
+    ranked = sorted((m for m in candidates if m not in pinned and get_request_rate(m) > 0),
+                    key=get_request_rate, reverse=True)
+    hot, used = [], 0
+    for model in pinned + ranked:
+        size = sizes.get(model, 0)
+        if config.OLLAMA_RESIDENCY_BUDGET_BYTES and used + size > config.OLLAMA_RESIDENCY_BUDGET_BYTES and model not in pinned:
+            continue # Smaller, colder models may still fit
+        hot.append(model)
+        used += size
+    return hot
+
+def _expires_soon(entry):
+    """True if a resident model's keep_alive runs out before the next refresh."""
+    expires_at = entry.get('expires_at')
+    if not expires_at:
+        return True
+    try:
+        expires_in = datetime.fromisoformat(expires_at.replace('Z', '+00:00')).timestamp() - time.time()
+    except ValueError:
+        return True
+    return expires_in < 2 * config.OLLAMA_RESIDENCY_INTERVAL
+
+def refresh_residency():
+    """One pass: recompute the hot set, unload cold models over budget, then load or extend the hot ones."""
+    try:
+        resident = _fetch_running_models()
+        sizes = _fetch_model_sizes()
+    except requests.RequestException as e:
+        logging.warning(f"Ollama residency refresh failed: {e}")
+        with _residency_lock:
+            _residency_stats['failures'] += 1
+            _residency_stats['last_error'] = str(e)
+        return
+    for model, entry in resident.items(): # Loaded size (incl. KV cache) is what counts against the budget
+        sizes[model] = entry.get('size') or sizes.get(model, 0)
+
+    hot = _select_hot_models(set(sizes), sizes) # Only installed models can be loaded
+
+    if config.OLLAMA_RESIDENCY_BUDGET_BYTES:
+        # Unload first so the models about to be warmed have room
+        resident_bytes = sum(sizes.get(m, 0) for m in set(resident) | set(hot))
+        cold = sorted((m for m in resident if m not in hot), key=get_request_rate) # Coldest first
+        for model in cold:
+            if resident_bytes <= config.OLLAMA_RESIDENCY_BUDGET_BYTES:
+                break
+            try:
+                _set_keep_alive(model, 0, 30)
+                resident_bytes -= sizes.get(model, 0)
+                logging.info(f"Unloaded cold Ollama model {model} to stay within the residency budget.")
+                with _residency_lock:
+                    _residency_stats['evictions'] += 1
+            except requests.RequestException as e:
+                logging.warning(f"Failed to unload Ollama model {model}: {e}")
+
+    for model in hot:
+        if model not in resident:
+            warm_model(model)
+        elif _expires_soon(resident[model]):
+            try:
+                _set_keep_alive(model, config.OLLAMA_KEEP_ALIVE, config.OLLAMA_WARMUP_TIMEOUT)
+                with _residency_lock:
+                    _residency_stats['keep_alive_refreshes'] += 1
+            except requests.RequestException as e:
+                logging.warning(f"Failed to extend keep_alive for {model}: {e}")
+
+    try:
+        resident = _fetch_running_models()
+    except requests.RequestException:
+        pass # Keep the pre-refresh view
+    with _residency_lock:
+        _resident.clear()
+        _resident.update(resident)
+        _model_sizes.clear()
+        _model_sizes.update(sizes)
+        _hot_models[:] = hot
+        _residency_stats['refreshes'] += 1
+        _residency_stats['last_refresh'] = time.time()
+
+def _run():
+    for model in config.OLLAMA_WARM_MODELS: # Startup warm-up, before the first user request pays for it
+        if _stop_event.is_set():
+            return
+        warm_model(model)
+    while not _stop_event.is_set():
+        refresh_residency()
+        _stop_event.wait(config.OLLAMA_RESIDENCY_INTERVAL)
+
+def start():
+    """Starts the background warm-up/refresh thread (no-op if disabled or already running)."""
+    global _refresh_thread
+    if not config.OLLAMA_RESIDENCY_ENABLED or (_refresh_thread is not None and _refresh_thread.is_alive()):
+        return
+    _stop_event.clear()
+    _refresh_thread = threading.Thread(target=_run, name="ollama-residency", daemon=True)
+    _refresh_thread.start()
+    logging.info(f"Ollama residency manager started (warm: {', '.join(config.OLLAMA_WARM_MODELS) or 'none'}, "
+                 f"keep_alive: {config.OLLAMA_KEEP_ALIVE}, budget: {config.OLLAMA_RESIDENCY_BUDGET_BYTES or 'unlimited'} bytes).")
+
+def stop():
+    _stop_event.set()
+
+def get_residency_state():
+    with _residency_lock:
+        resident = dict(_resident)
+        sizes = dict(_model_sizes)
+        hot = list(_hot_models)
+        stats = dict(_residency_stats)
+        scored = set(_request_scores)
+    models = []
+    for model in sorted(set(resident) | set(hot) | scored | set(config.OLLAMA_WARM_MODELS)):
+        entry = resident.get(model, {})
+        models.append({
+            'name': model,
+            'resident': model in resident,
+            'hot': model in hot,
+            'pinned': model in config.OLLAMA_WARM_MODELS,
+            'requests_per_minute': round(get_request_rate(model), 3),
+            'size': sizes.get(model),
+            'size_vram': entry.get('size_vram'),
+            'expires_at': entry.get('expires_at'),
+        })
+    return {
+        'enabled': config.OLLAMA_RESIDENCY_ENABLED,
+        'keep_alive': config.OLLAMA_KEEP_ALIVE,
+        'budget_bytes': config.OLLAMA_RESIDENCY_BUDGET_BYTES,
+        'resident_bytes': sum(sizes.get(m, 0) or 0 for m in resident),
+        'models': models,
+        **stats,
+    }
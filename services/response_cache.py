@@ -0,0 +1,165 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import config # Import config variables
+from services.llm_backends import BACKEND_SAMPLING_PARAMS
+
+# In-memory LRU tier: key -> (created_at, response_text), most recently used last
+_memory_cache = OrderedDict()
+_memory_bytes = 0
+_cache_lock = threading.Lock()
+_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expired': 0, 'bypassed': 0}
+_disk_stores_since_prune = 0
+
+def make_cache_key(prompt, history, backend, model):
+    """Hashes backend, model, normalized messages and sampling params into a cache key."""
+    if backend == 'custom_external':
+        # The custom backend ignores the requested model; key on what is actually called
+        model = f"{config.CUSTOM_API_ENDPOINT}|{config.CUSTOM_API_MODEL_NAME}"
+    # History is newest first; normalize to chronological role/content pairs
+    messages = [{'role': msg.get('role', 'user'), 'content': (msg.get('content') or '').strip()} for msg in reversed(history)]
+    messages.append({'role': 'user', 'content': (prompt or '').strip()})
+    key_material = {
+        'backend': backend,
+        'model': model,
+        'messages': messages,
+        'params': BACKEND_SAMPLING_PARAMS.get(backend, {}),
+    }
+    encoded = json.dumps(key_material, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+def _disk_path(key):
+    return os.path.join(config.LLM_CACHE_DISK_DIR, key[:2], f"{key}.json")
+
+def _is_expired(created_at):
+    return config.LLM_CACHE_TTL > 0 and time.time() - created_at > config.LLM_CACHE_TTL
+
+def _store_in_memory(key, created_at, response_text):
+    """Inserts into the LRU tier and evicts by entry count and byte size. Caller holds the lock."""
+    global _memory_bytes
+    old = _memory_cache.pop(key, None)
+    if old is not None:
+        _memory_bytes -= len(old[1])
+    _memory_cache[key] = (created_at, response_text)
+    _memory_bytes += len(response_text)
+    while _memory_cache and (len(_memory_cache) > config.LLM_CACHE_MAX_ENTRIES or _memory_bytes > config.LLM_CACHE_MAX_BYTES):
+        _, (_, evicted_text) = _memory_cache.popitem(last=False)
+        _memory_bytes -= len(evicted_text)
+        _stats['evictions'] += 1
+
+def get_cached_response(key):
+    """Returns the cached response text for a key, or None on a miss."""
+    global _memory_bytes
+    with _cache_lock:
+        entry = _memory_cache.get(key)
+        if entry is not None:
+            if not _is_expired(entry[0]):
+                _memory_cache.move_to_end(key)
+                _stats['hits'] += 1
+                return entry[1]
+            _memory_cache.pop(key, None)
+            _memory_bytes -= len(entry[1])
+            _stats['expired'] += 1
+
+    if config.LLM_CACHE_DISK_DIR:
+        path = _disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                disk_entry = json.load(f)
+            if _is_expired(disk_entry['created_at']):
+                os.remove(path)
+                with _cache_lock:
+                    _stats['expired'] += 1
+            else:
+                with _cache_lock:
+                    _store_in_memory(key, disk_entry['created_at'], disk_entry['response'])
+                    _stats['disk_hits'] += 1
+                return disk_entry['response']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable LLM cache file {path}: {e}")
+
+    with _cache_lock:
+        _stats['misses'] += 1
+    return None
+
+def store_response(key, response_text):
+    """Stores a successful response in the memory tier and, if enabled, on disk."""
+    global _disk_stores_since_prune
+    if not response_text:
+        return
+    created_at = time.time()
+    with _cache_lock:
+        _store_in_memory(key, created_at, response_text)
+        _stats['stores'] += 1
+
+    if config.LLM_CACHE_DISK_DIR:
+        path = _disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'created_at': created_at, 'response': response_text}, f)
+            os.replace(tmp_path, path) # Atomic swap so readers never see partial files
+        except OSError as e:
+            logging.warning(f"Could not write LLM cache file {path}: {e}")
+            return
+        with _cache_lock:
+            _disk_stores_since_prune += 1
+            should_prune = _disk_stores_since_prune >= 100
+            if should_prune:
+                _disk_stores_since_prune = 0
+        if should_prune:
+            prune_disk_cache()
+
+def prune_disk_cache():
+    """Drops expired disk entries and the oldest ones beyond LLM_CACHE_DISK_MAX_ENTRIES."""
+    if not config.LLM_CACHE_DISK_DIR or not os.path.isdir(config.LLM_CACHE_DISK_DIR):
+        return
+    entries = []
+    for root, _, files in os.walk(config.LLM_CACHE_DISK_DIR):
+        for name in files:
+            if name.endswith('.json'):
+                path = os.path.join(root, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+    entries.sort()
+    excess = len(entries) - config.LLM_CACHE_DISK_MAX_ENTRIES
+    now = time.time()
+    removed = 0
+    for i, (mtime, path) in enumerate(entries):
+        if i < excess or (config.LLM_CACHE_TTL > 0 and now - mtime > config.LLM_CACHE_TTL):
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    if removed:
+        logging.info(f"Pruned {removed} LLM cache files from {config.LLM_CACHE_DISK_DIR}")
+
+def record_bypass():
+    with _cache_lock:
+        _stats['bypassed'] += 1
+
+def split_for_replay(response_text):
+    """Splits cached text into word-sized chunks so replays look like a live stream."""
+    return re.findall(r'\s*\S+|\s+', response_text)
+
+def get_cache_stats():
+    with _cache_lock:
+        stats = dict(_stats)
+        stats['entries'] = len(_memory_cache)
+        stats['bytes'] = _memory_bytes
+    lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+    stats['hit_rate'] = round((stats['hits'] + stats['disk_hits']) / lookups, 4) if lookups else 0.0
+    stats['enabled'] = config.LLM_CACHE_ENABLED
+    stats['disk_enabled'] = bool(config.LLM_CACHE_DISK_DIR)
+    return stats
@@ -0,0 +1,130 @@
+import re
+import time
+import random
+import threading
+import email.utils
+import requests
+import config # Import config variables
+from services.http_pool import resolve_backend_for_url
+from services import cancellation
+
+class RequestCancelled(requests.exceptions.RequestException):
+    """Raised instead of retrying when the owning task was cancelled during a backoff."""
+
+# Global retry budget (token bucket): every request deposits RETRY_BUDGET_RATIO tokens,
+# every retry spends one, and a small floor refills over time. Keeps retries a bounded
+# fraction of traffic so a failing upstream doesn't turn into a retry storm.
+_budget_tokens = None
+_budget_updated_at = time.monotonic()
+_retry_lock = threading.Lock()
+_retry_stats = {} # backend -> counters, see _get_backend_stats
+
+# Provider rate-limit reset headers; values like "1s", "6m0s", "250ms" or plain seconds
+RATE_LIMIT_RESET_HEADERS = ('retry-after-ms', 'x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens', 'x-ratelimit-reset')
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+
+def _get_backend_stats(backend):
+    """Caller holds the lock."""
+    stats = _retry_stats.get(backend)
+    if stats is None:
+        stats = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'budget_exhausted': 0, 'cancelled': 0}
+        _retry_stats[backend] = stats
+    return stats
+
+def _refill_budget(now):
+    """Caller holds the lock."""
+    global _budget_tokens, _budget_updated_at
+    if _budget_tokens is None:
+        _budget_tokens = float(config.RETRY_BUDGET_MAX)
+    _budget_tokens = min(config.RETRY_BUDGET_MAX, _budget_tokens + (now - _budget_updated_at) * config.RETRY_BUDGET_MIN_PER_SECOND)
+    _budget_updated_at = now
+
+def record_attempt(url):
+    """Counts an initial request and deposits its share of the retry budget."""
+    global _budget_tokens
+    with _retry_lock:
+        _refill_budget(time.monotonic())
+        _budget_tokens = min(config.RETRY_BUDGET_MAX, _budget_tokens + config.RETRY_BUDGET_RATIO)
+        _get_backend_stats(resolve_backend_for_url(url))['requests'] += 1
+
+def try_spend_retry(url):
+    """Takes one token from the retry budget; False means don't retry."""
+    global _budget_tokens
+    with _retry_lock:
+        _refill_budget(time.monotonic())
+        stats = _get_backend_stats(resolve_backend_for_url(url))
+        if _budget_tokens < 1:
+            stats['budget_exhausted'] += 1
+            return False
+        _budget_tokens -= 1
+        stats['retries'] += 1
+        return True
+
+def _record(url, counter):
+    with _retry_lock:
+        _get_backend_stats(resolve_backend_for_url(url))[counter] += 1
+
+def record_rate_limited(url):
+    _record(url, 'rate_limited')
+
+def _parse_duration(value):
+    value = value.strip().lower()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+def parse_retry_after(headers):
+    """Seconds the server asked us to wait (Retry-After or rate-limit reset headers), or None."""
+    if not headers:
+        return None
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        retry_after = retry_after.strip()
+        if retry_after.isdigit():
+            return float(retry_after)
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after) # HTTP-date form
+            return max(0.0, retry_at.timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    for header in RATE_LIMIT_RESET_HEADERS:
+        value = headers.get(header)
+        if value:
+            seconds = _parse_duration(value)
+            if seconds is not None:
+                return seconds / 1000 if header == 'retry-after-ms' else seconds
+    return None
+
+def compute_backoff(attempt, base_delay, retry_after=None):
+    """Delay before retry number attempt (0-based): server hint if given, else full-jitter exponential.
+    Either way at most RETRY_MAX_DELAY (plus jitter)."""
+    if retry_after is not None:
+        # Capped: a 5xx can carry an unrelated long hint (e.g. OpenAI's x-ratelimit-reset-tokens: 6m0s);
+        # 429s with hints over the cap already gave up before getting here
+        return min(retry_after, config.RETRY_MAX_DELAY) + random.uniform(0, min(1.0, base_delay)) # Small jitter so clients don't retry in lockstep
+    return random.uniform(0, min(config.RETRY_MAX_DELAY, base_delay * (2 ** attempt)))
+
+def wait_before_retry(url, delay, cancel_event=None):
+    """Sleeps for delay seconds, waking early and raising RequestCancelled if cancel_event is set."""
+    if cancel_event is None:
+        time.sleep(delay)
+        return
+    if cancel_event.wait(delay):
+        _record(url, 'cancelled')
+        cancellation.record_released(cancel_event)
+        raise RequestCancelled(f"Request to {url} cancelled during retry backoff.")
+
+def get_retry_stats():
+    with _retry_lock:
+        _refill_budget(time.monotonic())
+        return {
+            'budget_tokens': round(_budget_tokens, 2),
+            'budget_max': config.RETRY_BUDGET_MAX,
+            'backends': {backend: dict(stats) for backend, stats in _retry_stats.items()},
+        }
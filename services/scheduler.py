@@ -0,0 +1,175 @@
+import time
+import logging
+import itertools
+import threading
+import contextlib
+import config # Import config variables
+from services import cancellation
+from services.retry_policy import RequestCancelled
+
+# Priority classes, lowest value served first
+PRIORITY_VOICE = 'voice'
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BULK = 'bulk'
+PRIORITY_ORDER = {PRIORITY_VOICE: 0, PRIORITY_INTERACTIVE: 1, PRIORITY_BULK: 2}
+
+class SchedulerRejected(Exception):
+    """Raised when a request can't get a backend slot; routes answer 429."""
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+_queues = {} # backend -> per-backend slot/queue state, see _get_queue
+_scheduler_lock = threading.Lock()
+_sequence = itertools.count()
+
+def _get_queue(backend):
+    """Returns the slot state for a backend. Caller holds the lock."""
+    queue = _queues.get(backend)
+    if queue is None:
+        queue = {
+            'active': 0,
+            'active_bulk': 0,
+            'waiting': [], # (priority rank, sequence) tickets
+            'condition': threading.Condition(_scheduler_lock),
+            'admitted': 0,
+            'rejected_full': 0,
+            'rejected_timeout': 0,
+            'total_wait': 0.0,
+        }
+        _queues[backend] = queue
+    return queue
+
+def get_slot_limit(backend):
+    """Concurrent upstream calls allowed for a backend; 0 means unlimited."""
+    return config.SCHEDULER_SLOTS.get(backend, 0)
+
+def _bulk_limit(queue, slots):
+    """Slots bulk work may hold. Caller holds the lock."""
+    if slots > config.SCHEDULER_RESERVED_SLOTS: # Bulk work never takes the reserved slots
+        return slots - config.SCHEDULER_RESERVED_SLOTS
+    # Every slot is reserved (e.g. the default single Kobold slot): bulk gets one only
+    # while no voice/interactive request is running or queued
+    bulk_rank = PRIORITY_ORDER[PRIORITY_BULK]
+    if queue['active'] > queue['active_bulk'] or any(rank < bulk_rank for rank, _ in queue['waiting']):
+        return 0
+    return 1
+
+def _can_start(queue, ticket, slots):
+    """True if ticket is the highest-priority waiter that fits a free slot. Caller holds the lock."""
+    if queue['active'] >= slots:
+        return False
+    bulk_full = queue['active_bulk'] >= _bulk_limit(queue, slots)
+    for waiting_ticket in sorted(queue['waiting']):
+        if bulk_full and waiting_ticket[0] == PRIORITY_ORDER[PRIORITY_BULK]:
+            continue # Bulk waiters can't use this slot; let interactive/voice behind them through
+        return waiting_ticket == ticket
+    return False
+
+def check_admission(backend):
+    """Rejects immediately if a backend's queue is already at SCHEDULER_MAX_QUEUE_DEPTH."""
+    slots = get_slot_limit(backend)
+    if slots <= 0:
+        return
+    with _scheduler_lock:
+        queue = _get_queue(backend)
+        if len(queue['waiting']) >= config.SCHEDULER_MAX_QUEUE_DEPTH:
+            queue['rejected_full'] += 1
+            raise SchedulerRejected(f"{backend} queue is full ({len(queue['waiting'])} waiting).")
+
+def acquire(backend, priority=PRIORITY_INTERACTIVE, cancel_event=None):
+    """Waits for a backend slot in priority order. Returns True if a slot must be released.
+
+    Raises SchedulerRejected when the queue is full or the priority's queue
+    timeout (SCHEDULER_QUEUE_TIMEOUTS) passes first, and RequestCancelled if
+    cancel_event is set while waiting.
+    """
+    slots = get_slot_limit(backend)
+    if slots <= 0:
+        return False
+    priority = priority if priority in PRIORITY_ORDER else PRIORITY_INTERACTIVE
+    ticket = (PRIORITY_ORDER[priority], next(_sequence))
+    timeout = config.SCHEDULER_QUEUE_TIMEOUTS.get(priority, 30)
+    start_time = time.monotonic()
+
+    def wake():
+        with _scheduler_lock:
+            _get_queue(backend)['condition'].notify_all()
+    # Cancel handles wake the wait directly; plain Events are polled
+    cancel_token = cancel_event.add_callback(wake) if cancellation.supports_abort(cancel_event) else None
+    poll = None if cancel_event is None or cancel_token is not None else 0.1
+
+    with _scheduler_lock:
+        queue = _get_queue(backend)
+        if len(queue['waiting']) >= config.SCHEDULER_MAX_QUEUE_DEPTH:
+            queue['rejected_full'] += 1
+            if cancel_token is not None:
+                cancel_event.remove_callback(cancel_token)
+            raise SchedulerRejected(f"{backend} queue is full ({len(queue['waiting'])} waiting).")
+        queue['waiting'].append(ticket)
+        try:
+            while not _can_start(queue, ticket, slots):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise RequestCancelled(f"Cancelled while waiting for a {backend} slot.")
+                remaining = timeout - (time.monotonic() - start_time)
+                if remaining <= 0:
+                    queue['rejected_timeout'] += 1
+                    logging.warning(f"{priority} request waited {timeout}s for a {backend} slot; rejecting.")
+                    raise SchedulerRejected(f"Timed out after {timeout}s waiting for a {backend} slot.",
+                                            retry_after=max(1, int(timeout / 4)))
+                queue['condition'].wait(remaining if poll is None else min(remaining, poll))
+        finally:
+            queue['waiting'].remove(ticket)
+            queue['condition'].notify_all() # Our departure may unblock a waiter we were shadowing
+            if cancel_token is not None:
+                cancel_event.remove_callback(cancel_token) # Takes only the handle's lock, safe under ours
+
+        queue['active'] += 1
+        if priority == PRIORITY_BULK:
+            queue['active_bulk'] += 1
+        queue['admitted'] += 1
+        queue['total_wait'] += time.monotonic() - start_time
+    return True
+
+def release(backend, priority=PRIORITY_INTERACTIVE):
+    with _scheduler_lock:
+        queue = _get_queue(backend)
+        queue['active'] -= 1
+        if priority == PRIORITY_BULK:
+            queue['active_bulk'] -= 1
+        queue['condition'].notify_all()
+
+@contextlib.contextmanager
+def backend_slot(backend, priority=PRIORITY_INTERACTIVE, cancel_event=None):
+    """Holds a backend slot for the duration of the block (no-op for unlimited backends)."""
+    priority = priority if priority in PRIORITY_ORDER else PRIORITY_INTERACTIVE
+    acquired = acquire(backend, priority, cancel_event)
+    try:
+        yield
+    finally:
+        if acquired:
+            release(backend, priority)
+
+def get_scheduler_stats():
+    with _scheduler_lock:
+        backends = {}
+        for backend, queue in _queues.items():
+            queued = {name: 0 for name in PRIORITY_ORDER}
+            for rank, _ in queue['waiting']:
+                queued[next(name for name, value in PRIORITY_ORDER.items() if value == rank)] += 1
+            backends[backend] = {
+                'slots': get_slot_limit(backend),
+                'active': queue['active'],
+                'active_bulk': queue['active_bulk'],
+                'queued': queued,
+                'admitted': queue['admitted'],
+                'rejected_full': queue['rejected_full'],
+                'rejected_timeout': queue['rejected_timeout'],
+                'avg_wait_ms': round(queue['total_wait'] / queue['admitted'] * 1000, 1) if queue['admitted'] else 0.0,
+            }
+    return {
+        'slots': dict(config.SCHEDULER_SLOTS),
+        'queue_timeouts': dict(config.SCHEDULER_QUEUE_TIMEOUTS),
+        'max_queue_depth': config.SCHEDULER_MAX_QUEUE_DEPTH,
+        'backends': backends,
+    }
@@ -0,0 +1,226 @@
+import logging
+import threading
+import config # Import config variables
+from services import cancellation
+from services.retry_policy import RequestCancelled
+
+_calls = {} # key -> _Flight (non-streaming)
+_streams = {} # key -> _Flight (streaming)
+_flight_lock = threading.Lock()
+_stats = {'calls_started': 0, 'calls_coalesced': 0, 'calls_aborted': 0, 'streams_started': 0, 'streams_coalesced': 0, 'streams_aborted': 0}
+
+class _Flight:
+    """One in-flight upstream request shared by every identical caller."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.done = False
+        self.result = None
+        self.error = None
+        self.chunks = [] # Streaming only: every token so far, replayed to late joiners
+        self.completed = False # Streaming only: the backend signalled the end of its reply
+        self.subscribers = 0
+        self.controller = None # Streaming only: upstream response, closed when nobody is listening
+        self.cancel_event = cancellation.CancelHandle("shared request") # Set when nobody is waiting or listening
+
+def _run_call(key, flight, fn):
+    """Runs the shared upstream call and hands its result (or error) to every waiter."""
+    try:
+        flight.result = fn(flight.cancel_event)
+    except Exception as e:
+        flight.error = e
+    finally:
+        with _flight_lock:
+            if _calls.get(key) is flight:
+                _calls.pop(key)
+        with flight.condition:
+            flight.done = True
+            flight.condition.notify_all()
+
+def _watch_cancel(flight, cancel_event):
+    """Makes a caller's cancel_event wake waits on flight.condition.
+    Returns (callback token, timeout for each wait): handles call back, plain Events are polled."""
+    def wake():
+        with flight.condition:
+            flight.condition.notify_all()
+    token = cancel_event.add_callback(wake) if cancellation.supports_abort(cancel_event) else None
+    return token, None if cancel_event is None or token is not None else 0.1
+
+def _wait_for_call(flight, cancel_event):
+    """Waits for a shared call to finish. Returns False if cancel_event was set first."""
+    token, poll = _watch_cancel(flight, cancel_event)
+    try:
+        with flight.condition:
+            while not flight.done:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                flight.condition.wait(poll)
+        return True
+    finally:
+        if token is not None:
+            cancel_event.remove_callback(token)
+
+def _leave_call(key, flight):
+    with _flight_lock:
+        with flight.condition:
+            flight.subscribers -= 1
+            abandoned = flight.subscribers == 0 and not flight.done
+        if abandoned:
+            _stats['calls_aborted'] += 1
+            if _calls.get(key) is flight: # New callers start a fresh request instead of joining an aborted one
+                _calls.pop(key)
+    if abandoned:
+        logging.info("All callers left a shared request; aborting upstream.")
+        flight.cancel_event.set()
+
+def call(key, fn, cancel_event=None):
+    """Runs fn(shared_cancel_event) once per key among concurrent callers; everyone gets the same result.
+
+    Returns (result, coalesced) where coalesced is True for callers that waited
+    on another caller's upstream request. The call runs in its own thread: a
+    caller whose cancel_event is set stops waiting and gets RequestCancelled,
+    and the shared handle passed to fn is only set once every caller has left.
+    """
+    if not config.SINGLE_FLIGHT_ENABLED:
+        return fn(cancel_event), False
+
+    with _flight_lock:
+        flight = _calls.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            _calls[key] = flight
+            _stats['calls_started'] += 1
+        else:
+            _stats['calls_coalesced'] += 1
+        with flight.condition:
+            flight.subscribers += 1
+
+    if leader:
+        threading.Thread(target=_run_call, args=(key, flight, fn), name="single-flight-call", daemon=True).start()
+
+    try:
+        if not _wait_for_call(flight, cancel_event):
+            raise RequestCancelled("Request cancelled while waiting for a shared upstream call.")
+    finally:
+        _leave_call(key, flight)
+    if flight.error is not None:
+        raise flight.error
+    return flight.result, not leader
+
+def _pump_stream(key, flight, stream_factory):
+    """Reads the single upstream stream into the flight buffer until done or abandoned."""
+    def on_connect(response):
+        with flight.condition:
+            if flight.subscribers == 0:
+                return False # Everyone left before the upstream answered
+            flight.controller = getattr(response, 'raw', response)
+        return True
+
+    def on_complete():
+        flight.completed = True
+
+    upstream = None
+    abandoned = False
+    try:
+        upstream = stream_factory(on_connect, flight.cancel_event, on_complete)
+        for token in upstream:
+            with flight.condition:
+                abandoned = flight.subscribers == 0
+                if abandoned:
+                    break
+                flight.chunks.append(token)
+                flight.condition.notify_all()
+    except Exception as e:
+        flight.error = e
+    finally:
+        if upstream is not None:
+            upstream.close()
+        if abandoned:
+            logging.info("All subscribers left a shared stream; aborted upstream.")
+        with _flight_lock:
+            if _streams.get(key) is flight:
+                _streams.pop(key)
+        with flight.condition:
+            flight.done = True
+            flight.condition.notify_all()
+
+def _leave_stream(key, flight):
+    with _flight_lock:
+        with flight.condition:
+            flight.subscribers -= 1
+            abandoned = flight.subscribers == 0 and not flight.done
+        if abandoned:
+            _stats['streams_aborted'] += 1 # Counted here: the pump may still be waiting for a slot or the first token
+            if _streams.get(key) is flight: # New subscribers start a fresh stream instead of joining an aborted one
+                _streams.pop(key)
+    if not abandoned:
+        return
+    with flight.condition:
+        flight.cancel_event.set() # Also aborts a pending retry backoff
+        if flight.controller is not None:
+            try:
+                flight.controller.close() # Unblocks the pump thread immediately
+            except Exception as e:
+                logging.warning(f"Error closing abandoned shared stream: {e}")
+
+def stream(key, stream_factory, on_complete=None, cancel_event=None):
+    """Fans one upstream token stream out to every identical concurrent subscriber.
+
+    stream_factory(on_connect, cancel_event, on_complete) must return a token
+    generator (e.g. a routed_stream_llm_backend call). Late joiners first replay
+    the tokens already received. The upstream is closed when the last subscriber
+    leaves. Each subscriber's on_complete() is called after its last token if
+    the upstream reported a complete reply. A subscriber whose cancel_event is
+    set stops waiting (also before the first token) with RequestCancelled.
+    """
+    if not config.SINGLE_FLIGHT_ENABLED:
+        yield from stream_factory(None, cancel_event, on_complete)
+        return
+
+    with _flight_lock:
+        flight = _streams.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            _streams[key] = flight
+            _stats['streams_started'] += 1
+        else:
+            _stats['streams_coalesced'] += 1
+        with flight.condition:
+            flight.subscribers += 1
+
+    if leader:
+        threading.Thread(target=_pump_stream, args=(key, flight, stream_factory), name="single-flight-stream", daemon=True).start()
+
+    position = 0
+    token, poll = _watch_cancel(flight, cancel_event)
+    try:
+        while True:
+            with flight.condition:
+                while position >= len(flight.chunks) and not flight.done:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise RequestCancelled("Request cancelled while waiting for a shared upstream stream.")
+                    flight.condition.wait(poll)
+                new_chunks = flight.chunks[position:]
+                position += len(new_chunks)
+                finished = flight.done and position >= len(flight.chunks)
+            for chunk in new_chunks:
+                yield chunk
+            if finished:
+                break
+        if flight.error is not None:
+            raise flight.error
+        if flight.completed and on_complete:
+            on_complete()
+    finally:
+        if token is not None:
+            cancel_event.remove_callback(token)
+        _leave_stream(key, flight)
+
+def get_single_flight_stats():
+    with _flight_lock:
+        stats = dict(_stats)
+        stats['calls_in_flight'] = len(_calls)
+        stats['streams_in_flight'] = len(_streams)
+    stats['enabled'] = config.SINGLE_FLIGHT_ENABLED
+    return stats
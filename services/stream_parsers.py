@@ -0,0 +1,89 @@
+import json
+import logging
+
+STREAM_READ_SIZE = 16384 # Max bytes per socket read; reads return as soon as any data is available
+
+class LineSplitter:
+    """Incrementally splits a byte stream into lines in linear time.
+
+    Only the trailing partial line is carried between chunks, and a chunk
+    without a newline is appended without rescanning what came before.
+    """
+    def __init__(self):
+        self._partial = bytearray()
+
+    def feed(self, chunk):
+        """Returns the complete lines (without line endings) finished by this chunk."""
+        if b'\n' not in chunk:
+            self._partial += chunk
+            return []
+        if self._partial:
+            self._partial += chunk
+            lines = self._partial.split(b'\n')
+        else:
+            lines = chunk.split(b'\n')
+        self._partial = bytearray(lines.pop())
+        return lines
+
+    def flush(self):
+        """Returns the final unterminated line, if any."""
+        if not self._partial:
+            return []
+        line, self._partial = bytes(self._partial), bytearray()
+        return [line]
+
+class StreamDecoder:
+    """Turns raw NDJSON/SSE body chunks into text tokens for one backend.
+
+    parse_line(line) -> (token, done) is the backend adapter's line parser;
+    once it reports done, the rest of the body is ignored.
+    """
+    def __init__(self, backend, parse_line):
+        self.backend = backend
+        self.done = False
+        self._parse_line = parse_line
+        self._splitter = LineSplitter()
+
+    def feed(self, chunk):
+        """Returns the tokens completed by this chunk."""
+        return self._decode_lines(self._splitter.feed(chunk))
+
+    def flush(self):
+        """Returns tokens from a final line the upstream didn't terminate with a newline."""
+        return self._decode_lines(self._splitter.flush())
+
+    def _decode_lines(self, lines):
+        tokens = []
+        for raw_line in lines:
+            if self.done:
+                break
+            raw_line = raw_line.strip() # Also drops the \r of CRLF-delimited SSE
+            if not raw_line:
+                continue
+            line = raw_line.decode('utf-8', errors='replace') # Lines are whole, so multi-byte characters are never split
+            try:
+                token, done = self._parse_line(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Skipping malformed {self.backend} stream line: {line[:200]}")
+                continue
+            if token:
+                tokens.append(token)
+            if done:
+                logging.info(f"{self.backend} stream signalled completion.")
+                self.done = True
+        return tokens
+
+def iter_response_chunks(response, chunk_size=STREAM_READ_SIZE):
+    """Yields a requests streaming response's body bytes as soon as they arrive."""
+    if response.raw.chunked:
+        yield from response.iter_content(chunk_size=None) # One item per HTTP chunk, as it arrives
+        return
+    read1 = getattr(response.raw, 'read1', None) # urllib3 >= 2: returns whatever is buffered, never waits to fill chunk_size
+    if read1 is None:
+        yield from response.iter_content(chunk_size=512)
+        return
+    while True:
+        chunk = read1(chunk_size, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
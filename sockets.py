@@ -9,7 +9,10 @@ from config import state # Import shared state
 from services.stt_service import transcribe_audio
 from services.tts_service import synthesize_speech, get_current_tts_speakers
 from services.audio_utils import convert_audio
-from services.llm_backends import call_llm_backend # For voice-triggered LLM calls
+from services.llm_router import routed_call_llm_backend # For voice-triggered LLM calls
+from services.scheduler import PRIORITY_VOICE, SchedulerRejected
+from services.cancellation import CancelHandle
+import config
 
 # This module needs the 'socketio' instance. We'll pass it during initialization.
 socketio = None
@@ -42,6 +45,10 @@ def register_socket_handlers():
         sid = request.sid
         logging.info(f"Voice Client disconnected: {sid}")
         state["active_voice_clients"].pop(sid, None) # Remove client
+        with state["task_lock"]:
+            voice_task = state["active_tasks"].pop(sid, None)
+        if voice_task and voice_task.get("cancel_event") is not None:
+            voice_task["cancel_event"].set() # Nobody is left to hear the reply; abort the LLM call
         logging.debug(f"Removed client {sid}. Remaining: {list(state['active_voice_clients'].keys())}")
 
     @socketio.on('get_voice_config')
@@ -145,8 +152,25 @@ def register_socket_handlers():
             if transcript:
                 emit('voice_processing', {'message': 'Getting AI response...'}, to=sid)
                 # TODO: Get actual backend/model/history settings for voice interaction
-                llm_backend = "ollama"; llm_model = "llama3"; voice_history = []
-                llm_response_text = call_llm_backend(transcript, voice_history, llm_backend, llm_model)
+                llm_backend = "ollama"; llm_model = config.VOICE_LLM_MODEL; voice_history = [] # Kept warm by ollama_residency
+                # Registered under the socket id so /api/cancel (client_id=sid) or a disconnect aborts the call
+                cancel_event = CancelHandle(f"voice task {sid}")
+                with state["task_lock"]:
+                    state["active_tasks"][sid] = {"type": "voice", "backend": llm_backend, "controller": None, "cancel_event": cancel_event}
+                try:
+                    llm_response_text, _, _ = routed_call_llm_backend(transcript, voice_history, llm_backend, llm_model,
+                                                                      priority=PRIORITY_VOICE, cancel_event=cancel_event)
+                except SchedulerRejected as e_busy:
+                    logging.warning(f"Voice LLM call rejected by scheduler: {e_busy}")
+                    emit('voice_error', {'message': f'LLM backend busy: {e_busy}'}, to=sid)
+                    llm_response_text = ""
+                finally:
+                    with state["task_lock"]:
+                        if state["active_tasks"].get(sid, {}).get("cancel_event") is cancel_event:
+                            state["active_tasks"].pop(sid, None)
+                if cancel_event.is_set():
+                    logging.info(f"Voice LLM call for {sid} was cancelled; skipping TTS.")
+                    llm_response_text = ""
                 logging.info(f"LLM Response for voice: '{llm_response_text[:60]}...'")
             else:
                 logging.warning("Empty transcript after STT, skipping LLM.")
@@ -372,6 +372,40 @@ export async function cancelGeneration() {
     }
 }
 
+/** Fetches one page of a chat's history: its newest messages, or those older than `before`. */
+export async function fetchChatHistoryPage(chatId, before = null) {
+    const params = new URLSearchParams({ limit: cfg.CHAT_HISTORY_PAGE_SIZE });
+    if (before !== null) params.set('before', before);
+    return makeApiRequest(`${cfg.CHAT_HISTORY_API(chatId)}?${params}`, { method: 'GET' });
+}
+
+let olderMessagesRequest = null; // In-flight loadOlderChatMessages() call, shared by concurrent callers
+
+/** Loads and renders the active chat's next page of older messages. Returns the messages added (newest first). */
+export function loadOlderChatMessages() {
+    if (!state.activeChatId || state.activeChatOlderCursor === null) return Promise.resolve([]);
+    if (olderMessagesRequest) return olderMessagesRequest;
+    const chatId = state.activeChatId;
+    olderMessagesRequest = (async () => {
+        try {
+            const response = await fetchChatHistoryPage(chatId, state.activeChatOlderCursor);
+            if (response.status !== 'success' || !response.history) {
+                throw new Error(response.message || 'Failed to load older messages.');
+            }
+            if (chatId !== state.activeChatId) return []; // Switched chats meanwhile
+            const older = response.history.messages || [];
+            state.activeChatMessages.push(...older); // In place: other handlers hold this array
+            state.setActiveChatOlderCursor(response.next_cursor ?? null);
+            ui.prependMessages(older);
+            console.log(`Chat ${chatId}: loaded ${older.length} older message(s).`);
+            return older;
+        } finally {
+            olderMessagesRequest = null;
+        }
+    })();
+    return olderMessagesRequest;
+}
+
 /** Saves the current active chat history (messages + images) to the backend. */
 export async function saveActiveChatHistory() {
     if (!state.activeChatId) {
@@ -383,6 +417,10 @@ export async function saveActiveChatHistory() {
     ui.updateSaveIndicator('saving');
 
     try {
+        // A full save replaces the stored history, so it must include the pages not loaded yet
+        while (state.activeChatOlderCursor !== null) {
+            await loadOlderChatMessages();
+        }
         const payload = {
             messages: state.activeChatMessages,
             images: state.activeChatImages
@@ -404,6 +442,35 @@ export async function saveActiveChatHistory() {
     }
 }
 
+/**
+ * Appends new entries to the active chat on the backend without resending the whole history.
+ * Items are oldest first; they must already be at the front of the state lists (newest first).
+ * Falls back to a full save if the append fails.
+ */
+export async function appendToActiveChatHistory(messages = [], images = []) {
+    if (!state.activeChatId) {
+        console.warn("Attempted to append history with no active chat ID.");
+        return;
+    }
+
+    ui.updateSaveIndicator('saving');
+    try {
+        const response = await makeApiRequest(cfg.CHAT_MESSAGES_API(state.activeChatId), {
+            method: 'POST',
+            body: { messages, images }
+        });
+        if (response.status !== 'success') {
+            throw new Error(response.message || 'Failed to append to history');
+        }
+        console.log(`Chat ${state.activeChatId}: appended ${messages.length} message(s), ${images.length} image(s).`);
+    } catch (error) {
+        console.warn(`Append to chat ${state.activeChatId} failed, saving full history instead:`, error);
+        await saveActiveChatHistory();
+    } finally {
+        setTimeout(() => ui.updateSaveIndicator('idle'), 500);
+    }
+}
+
 
 // --- TTS API Functions ---
 
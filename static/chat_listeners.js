@@ -120,9 +120,10 @@ export async function sendMessage(optionalMessage = null) {
     if (dom.messageInput) dom.messageInput.value = '';
 
     let currentMessages = state.activeChatMessages;
-    currentMessages.unshift({ role: 'user', content: message });
+    const userMessage = { role: 'user', content: message };
+    currentMessages.unshift(userMessage);
     state.setActiveChatMessages(currentMessages);
-    await api.saveActiveChatHistory();
+    await api.appendToActiveChatHistory([userMessage]);
 
     const historyForContext = state.activeChatMessages.slice(1, cfg.HISTORY_CONTEXT_LENGTH * 2 + 1);
     state.setCurrentClientId(crypto.randomUUID());
@@ -138,17 +139,17 @@ export async function sendMessage(optionalMessage = null) {
             model: modelNameForApi,
             prompt: message, // Prompt might be redundant if using messages format, but include for flexibility
             history: historyForContext, // Backend expects newest first for history usually
-            // Stream only for Ollama for now
-            stream: state.currentBackend === 'ollama'
+            // Every backend streams through /api/generate?stream=true
+            stream: true
         };
 
         console.log("Payload being sent to backend:", JSON.stringify(payload));
 
-        if (state.currentBackend === 'ollama' && payload.stream) {
+        if (payload.stream) {
             console.log(`sendMessage: Calling streamOllamaResponse`);
             await streamOllamaResponse(payload); // Stream function handles its own logic
 
-        } else { // Non-streaming backends (Kobold, Groq, OpenAI, Google, Anthropic, xAI, Custom, non-stream Ollama)
+        } else { // Non-streaming fallback
             payload.stream = false; // Ensure stream is false
             console.log(`sendMessage: Calling backend proxy for ${state.currentBackend}`);
             const response = await api.makeApiRequest(cfg.GENERATE_API, { method: 'POST', body: payload });
@@ -159,9 +160,10 @@ export async function sendMessage(optionalMessage = null) {
                     ui.appendMessage(aiResponse, 'received', true); // Render as markdown
                  }
                 let currentMsgs = state.activeChatMessages;
-                currentMsgs.unshift({ role: 'assistant', content: aiResponse });
+                const assistantMessage = { role: 'assistant', content: aiResponse };
+                currentMsgs.unshift(assistantMessage);
                 state.setActiveChatMessages(currentMsgs);
-                await api.saveActiveChatHistory();
+                await api.appendToActiveChatHistory([assistantMessage]);
 
                 // Import triggerTTS from voice_listeners when needed
                  if (state.voiceSettings.enabled && state.voiceSettings.ttsEnabled && state.voiceSettings.interactionMode !== 'text_only') {
@@ -183,7 +185,7 @@ export async function sendMessage(optionalMessage = null) {
     }
 }
 
-/** Handles streaming response from Ollama using Server-Sent Events. */
+/** Handles streaming response from any backend using Server-Sent Events. */
 async function streamOllamaResponse(payload) { // Payload contains backend info, model, prompt, history
     if (!dom.chatArea) {
         console.error("streamOllamaResponse failed: chatArea not found.");
@@ -318,12 +320,15 @@ async function streamOllamaResponse(payload) { // Payload contains backend info,
              // Check if the first message is a placeholder (might happen on rapid interactions)
              if (currentMsgs.length > 0 && currentMsgs[0].role === 'assistant' && currentMsgs[0].content.includes('streaming')) {
                   currentMsgs[0].content = fullResponse; // Update placeholder
+                  state.setActiveChatMessages(currentMsgs);
+                  await api.saveActiveChatHistory(); // Existing message changed: save the full history
              } else {
                   // Add new assistant message
-                  currentMsgs.unshift({ role: 'assistant', content: fullResponse });
+                  const assistantMessage = { role: 'assistant', content: fullResponse };
+                  currentMsgs.unshift(assistantMessage);
+                  state.setActiveChatMessages(currentMsgs);
+                  await api.appendToActiveChatHistory([assistantMessage]); // Only the new turn is sent
              }
-             state.setActiveChatMessages(currentMsgs);
-             await api.saveActiveChatHistory(); // Save updated history
         } else if (!fullResponse && !wasCancelled) {
              console.warn("streamOllamaResponse: Stream ended with empty response.");
              if (messageDiv) messageDiv.innerHTML = "<i>[Empty Response]</i>";
@@ -374,7 +379,7 @@ export async function generateImage(prompt) {
                 let currentImages = state.activeChatImages;
                 currentImages.unshift(response.image_url); // Add to beginning (newest first)
                 state.setActiveChatImages(currentImages);
-                await api.saveActiveChatHistory(); // Save updated history (includes images)
+                await api.appendToActiveChatHistory([], [response.image_url]); // Save just the new image
                 ui.renderImageHistory(state.activeChatId); // Refresh thumbnails
             }
             ui.appendMessage(`Image generated successfully.`, 'received');
@@ -570,12 +575,13 @@ export async function loadChat(chatId, chatElement, event, isNewChat = false) {
              // If it's an existing chat, fetch history from backend
              try {
                  console.log(`loadChat: Fetching history for existing chat ${state.activeChatId}...`);
-                 const response = await api.makeApiRequest(cfg.CHAT_HISTORY_API(state.activeChatId), { method: 'GET' });
+                 const response = await api.fetchChatHistoryPage(state.activeChatId); // Newest page; older ones load on scroll-up
 
                  if (response.status === 'success' && response.history) {
                      // Load messages and images into state
                      state.setActiveChatMessages(response.history.messages || []);
                      state.setActiveChatImages(response.history.images || []);
+                     state.setActiveChatOlderCursor(response.next_cursor ?? null);
                      console.log(`loadChat: Loaded ${state.activeChatMessages.length} msgs, ${state.activeChatImages.length} imgs for ${state.activeChatId}`);
 
                      // Render messages (oldest first)
@@ -742,6 +748,13 @@ export function setupChatEventListeners() {
         }
     }); else console.warn("Message input not found");
 
+     // Load older messages when scrolling near the top of a paged chat
+     if (dom.chatArea) dom.chatArea.addEventListener('scroll', () => {
+         if (dom.chatArea.scrollTop < 100 && state.activeChatOlderCursor !== null) {
+             api.loadOlderChatMessages().catch(error => console.error('Error loading older messages:', error));
+         }
+     });
+
      // Chat List Delegation
      if (dom.chatList) {
          dom.chatList.addEventListener('click', (e) => {
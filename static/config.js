@@ -10,6 +10,7 @@ export const COMFYUI_STATUS_API = `${API_BASE_URL}/comfyui-status`;
 export const COMFYUI_CHECKPOINTS_API = `${API_BASE_URL}/comfyui-checkpoints`;
 export const CHATS_API = `${API_BASE_URL}/chats`; // GET list of chats
 export const CHAT_HISTORY_API = (chatId) => `${API_BASE_URL}/chat/${chatId}`; // GET, POST, DELETE specific chat
+export const CHAT_MESSAGES_API = (chatId) => `${API_BASE_URL}/chat/${chatId}/messages`; // POST: append new turns only
 
 // New TTS API Endpoints
 export const TTS_MODELS_API = `${API_BASE_URL}/tts/models`;
@@ -17,6 +18,7 @@ export const TTS_SET_MODEL_API = `${API_BASE_URL}/tts/set-model`;
 export const TTS_SAMPLE_API = `${API_BASE_URL}/tts/sample`;
 
 export const HISTORY_CONTEXT_LENGTH = 20; // Keep N most recent message pairs sent to backend
+export const CHAT_HISTORY_PAGE_SIZE = 50; // Messages loaded when opening a chat and per scroll-up (covers HISTORY_CONTEXT_LENGTH pairs)
 export const IMAGE_TRIGGER_PHRASE = "send your photo";
 
 // Default ComfyUI workflow structure (can be overridden by upload/state)
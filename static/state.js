@@ -15,6 +15,7 @@ export let isGenerating = false; // Flag for ongoing AI generation (text or imag
 export let lastGeneratedFacePrompt = null; // Last prompt used with 'send your photo'
 export let lastGeneratedImageUrl = null; // URL of last image shown in main view
 export let activeChatId = null; // ID of the currently loaded chat
+export let activeChatOlderCursor = null; // 'before' cursor of the active chat's older messages not loaded yet (null: all loaded)
 // === Updated apiEndpoints with all provider keys ===
 export let apiEndpoints = {
     ollama: 'http://localhost:11435',
@@ -72,7 +73,8 @@ export function setKnownChatList(list) { knownChatList = list; }
 export function setIsGenerating(generating) { isGenerating = generating; }
 export function setLastGeneratedFacePrompt(prompt) { lastGeneratedFacePrompt = prompt; }
 export function setLastGeneratedImageUrl(url) { lastGeneratedImageUrl = url; }
-export function setActiveChatId(id) { activeChatId = id; }
+export function setActiveChatId(id) { activeChatId = id; activeChatOlderCursor = null; }
+export function setActiveChatOlderCursor(cursor) { activeChatOlderCursor = cursor; }
 export function setApiEndpoints(endpoints) { apiEndpoints = endpoints; }
 export function setComfyUIWorkflow(workflow) { comfyUIWorkflow = workflow; }
 export function setComfyUISettings(settings) { comfyUISettings = settings; }
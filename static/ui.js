@@ -24,13 +24,8 @@ export function configureMarked() {
     }
 }
 
-/** Appends a message to the chat area with optional markdown rendering. */
-export function appendMessage(text, type, isMarkdown = false) {
-    if (!dom.chatArea) {
-        console.error("Chat area DOM element not found.");
-        return;
-    }
-
+/** Builds a chat message element with optional markdown rendering. */
+function createMessageElement(text, type, isMarkdown = false) {
     const messageDiv = document.createElement('div');
     messageDiv.className = `message ${type}`; // Types: 'sent', 'received', 'error'
 
@@ -51,7 +46,17 @@ export function appendMessage(text, type, isMarkdown = false) {
          // Basic handling for other messages (replace newlines)
          messageDiv.innerHTML = sanitizedText.replace(/\n/g, '<br>');
     }
+    return messageDiv;
+}
+
+/** Appends a message to the chat area with optional markdown rendering. */
+export function appendMessage(text, type, isMarkdown = false) {
+    if (!dom.chatArea) {
+        console.error("Chat area DOM element not found.");
+        return;
+    }
 
+    const messageDiv = createMessageElement(text, type, isMarkdown);
     dom.chatArea.appendChild(messageDiv);
     // Scroll to bottom after adding message
     setTimeout(() => {
@@ -64,6 +69,18 @@ export function appendMessage(text, type, isMarkdown = false) {
     return messageDiv;
 }
 
+/** Renders older history messages (newest first) above the loaded ones, keeping the visible messages in place. */
+export function prependMessages(messages) {
+    if (!dom.chatArea || messages.length === 0) return;
+    const previousHeight = dom.chatArea.scrollHeight;
+    const fragment = document.createDocumentFragment();
+    messages.slice().reverse().forEach(msg => {
+        fragment.appendChild(createMessageElement(msg.content, msg.role === 'user' ? 'sent' : 'received', msg.role === 'assistant'));
+    });
+    dom.chatArea.insertBefore(fragment, dom.chatArea.firstChild);
+    dom.chatArea.scrollTop += dom.chatArea.scrollHeight - previousHeight;
+}
+
 /** Removes a specific status message (typically italic) */
 export function clearStatusMessage(textToClear) {
     if (!dom.chatArea) return;
@@ -1,10 +1,19 @@
 import requests
 import logging
-import time
-import json
-
-def make_request_with_retry(url, method, json_data=None, params=None, headers=None, retries=3, backoff=1, timeout=60, stream=False):
-    """Generic request function with retries, better error handling, optional streaming, and custom headers."""
+import config # Import config variables
+from services.http_pool import get_session, record_request
+from services.retry_policy import RequestCancelled, record_attempt, try_spend_retry, record_rate_limited, parse_retry_after, \
+                                  compute_backoff, wait_before_retry
+from services import cancellation
+
+def make_request_with_retry(url, method, json_data=None, params=None, headers=None, retries=3, backoff=1, timeout=60, stream=False, cancel_event=None):
+    """Generic request function with retries, better error handling, optional streaming, and custom headers.
+
+    Retries timeouts, connection errors, 5xx and 429 with jittered backoff (or the
+    server's Retry-After), within the global retry budget. Setting cancel_event
+    (e.g. from /api/cancel) aborts a pending backoff with RequestCancelled; a
+    cancellation.CancelHandle also aborts the in-flight request's socket.
+    """
     request_headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
     if headers:
         request_headers.update(headers)
@@ -21,10 +30,18 @@ def make_request_with_retry(url, method, json_data=None, params=None, headers=No
     logging.debug(f"Requesting {method} {url} with timeout {timeout}s (Stream: {stream}) Headers: {logged_headers}")
 
     last_exception = None
+    record_attempt(url)
     for i in range(retries):
+        retry_after = None
+        if cancel_event is not None and cancel_event.is_set():
+            raise RequestCancelled(f"Request to {url} cancelled before it was sent.")
         try:
-            response = requests.request(method, url, headers=request_headers, json=json_data, params=params, timeout=timeout, stream=stream)
+            # Pooled keep-alive session per upstream host (avoids a new TCP/TLS handshake per call);
+            # connections checked out here are registered with the cancel handle.
+            with cancellation.bind(cancel_event):
+                response = get_session(url).request(method, url, headers=request_headers, json=json_data, params=params, timeout=timeout, stream=stream)
             logging.debug(f"Response Status: {response.status_code}")
+            record_request(url, error=not response.ok)
 
             # Raise HTTPError immediately for bad responses (4xx or 5xx)
             response.raise_for_status()
@@ -49,6 +66,7 @@ def make_request_with_retry(url, method, json_data=None, params=None, headers=No
                 return response_text
 
         except requests.exceptions.Timeout as e:
+            record_request(url, error=True)
             logging.warning(f"Attempt {i+1}/{retries} timed out for {method} {url}")
             last_exception = e
         except requests.exceptions.HTTPError as e: # Catch 4xx/5xx specifically
@@ -69,25 +87,39 @@ def make_request_with_retry(url, method, json_data=None, params=None, headers=No
                          error_details += f" | Failed to read response body: {read_err}"
              logging.warning(f"Attempt {i+1}/{retries} for {method} {url} failed: {error_details}")
              last_exception = e
-             # For HTTP errors, often don't retry unless it's a server error (5xx)
-             if e.response is not None and e.response.status_code < 500:
-                 break # Don't retry client errors (4xx)
+             if e.response is not None:
+                 retry_after = parse_retry_after(e.response.headers)
+                 if e.response.status_code == 429:
+                     record_rate_limited(url)
+                     if retry_after is not None and retry_after > config.RETRY_MAX_DELAY:
+                         logging.warning(f"{url} asked to wait {retry_after:.0f}s (over RETRY_MAX_DELAY); not retrying.")
+                         break
+                 elif e.response.status_code < 500:
+                     break # Don't retry other client errors (4xx)
         except requests.exceptions.RequestException as e:
+            record_request(url, error=True)
+            if cancel_event is not None and cancel_event.is_set(): # Socket shut down by the cancel handle
+                cancellation.record_released(cancel_event)
+                logging.info(f"{method} {url} aborted by cancellation.")
+                raise RequestCancelled(f"Request to {url} cancelled while in flight.") from e
             error_details = f"Request Error: {e}"
             logging.warning(f"Attempt {i+1}/{retries} for {method} {url} failed: {error_details}")
             last_exception = e
 
         # Backoff logic
         if i < retries - 1:
-            sleep_time = backoff * (2**i)
-            logging.debug(f"Retrying in {sleep_time}s...")
-            time.sleep(sleep_time)
-        else:
-            logging.error(f"Request failed after {retries} attempts: {method} {url}")
-            if last_exception:
-                raise last_exception # Re-raise the last captured exception
-            # If no specific exception was caught but retries exhausted
-            raise requests.exceptions.RequestException(f"Request failed after {retries} attempts without specific exception detail.")
+            if not try_spend_retry(url):
+                logging.warning(f"Retry budget exhausted; not retrying {method} {url}")
+                break
+            sleep_time = compute_backoff(i, backoff, retry_after)
+            logging.debug(f"Retrying in {sleep_time:.2f}s...")
+            wait_before_retry(url, sleep_time, cancel_event) # Raises RequestCancelled if the task is cancelled
+
+    logging.error(f"Request failed after {i+1} attempt(s): {method} {url}")
+    if last_exception:
+        raise last_exception # Re-raise the last captured exception
+    # If no specific exception was caught but retries exhausted
+    raise requests.exceptions.RequestException(f"Request failed after {retries} attempts without specific exception detail.")
 
 def find_node_errors(prompt_history):
     """Helper to extract node errors from ComfyUI history."""